@@ -0,0 +1,77 @@
+"""Annotation time of MappedCode.get_commented on large generated TikZ codes
+
+Usage:
+    python benchmarks/annotation.py [--lines 2000 20000] [--mappings-per-line 0.5]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from vif_agent.feature import CodeImageMapping, MappedCode
+
+FEATURES = ["wing", "tail", "engine", "window", "cockpit", "wheel", "fuselage"]
+
+
+class _ConstantEmbeddingModel:
+    """stand-in of the sentence transformer, the embeddings are not used by the annotation"""
+
+    def encode(self, sentences):
+        return [[1.0] for _ in sentences]
+
+
+def generate_mapped_code(lines: int, mappings_per_line: float) -> MappedCode:
+    random.seed(0)
+    code_lines = [
+        f"\\draw[fill=blue!{i % 100}] ({i * 0.1:.1f},0) -- ({i * 0.1:.1f},1) -- ({i * 0.2:.1f},2);"
+        for i in range(lines)
+    ]
+    code = "\n".join(
+        ["\\documentclass{standalone}", "\\usepackage{tikz}", "\\begin{document}"]
+        + ["\\begin{tikzpicture}"]
+        + code_lines
+        + ["\\end{tikzpicture}", "\\end{document}"]
+    )
+    line_starts = [0] + [i + 1 for i, char in enumerate(code) if char == "\n"]
+    feature_map = {feature: [] for feature in FEATURES}
+    for _ in range(int(lines * mappings_per_line)):
+        start = random.choice(line_starts)
+        feature_map[random.choice(FEATURES)].append(
+            (CodeImageMapping([(start, start + 10)], (0, 0, 10, 10)), random.random())
+        )
+    return MappedCode(None, code, feature_map, _ConstantEmbeddingModel())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, nargs="+", default=[2000, 20000, 200000])
+    parser.add_argument("--mappings-per-line", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for lines in args.lines:
+        mapped_code = generate_mapped_code(lines, args.mappings_per_line)
+
+        durations = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            mapped_code.get_commented()
+            durations.append(time.perf_counter() - start)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            with open(os.path.join(tmp_dir, "commented.tex"), "w") as output:
+                mapped_code.write_commented(output)
+            streamed = time.perf_counter() - start
+
+        print(
+            f"{lines:7} lines {len(mapped_code.code) / 1e6:6.2f} MB: "
+            f"get_commented {min(durations) * 1000:8.1f} ms, "
+            f"write_commented to a file {streamed * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
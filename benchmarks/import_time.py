@@ -0,0 +1,69 @@
+"""Import time of the vif_agent entry points
+
+Each module is imported in a fresh interpreter, the heavy dependencies it pulled in are reported.
+
+Usage:
+    python benchmarks/import_time.py [--repeat 5] [--max-seconds 1.0]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "vif_agent.renderer.tex_renderer",
+    "vif_agent.mutation.tex_mutant_creator",
+    "vif_agent.feature",
+    "vif_agent.agent",
+]
+HEAVY_MODULES = ["torch", "sentence_transformers", "transformers"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+print(json.dumps({{"seconds": duration, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module: str, repeat: int) -> tuple[float, list[str]]:
+    durations = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        durations.append(result["seconds"])
+        heavy = result["heavy"]
+    return statistics.median(durations), heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=None,
+        help="fails when an import takes longer, or imports a heavy dependency",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        seconds, heavy = measure(module, args.repeat)
+        print(f"{module:45} {seconds * 1000:8.1f} ms  heavy: {', '.join(heavy) or '-'}")
+        if args.max_seconds is not None and (seconds > args.max_seconds or heavy):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
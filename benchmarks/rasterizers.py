@@ -0,0 +1,122 @@
+"""Latency and memory of the pdf rasterizer backends on the bundled figures
+
+Each resources/*/code.tex is compiled once with pdflatex, then each backend rasterizes the pdfs in a fresh
+interpreter, so that its peak memory (of the interpreter and of its subprocesses) is measured on its own.
+
+Usage:
+    python benchmarks/rasterizers.py [--backends pdftoppm pdftocairo pdfium] [--dpi 200] [--repeat 10]
+"""
+
+import argparse
+import glob
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from vif_agent.renderer.rasterizer import DEFAULT_DPI, RASTERIZERS
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "..", "resources")
+
+
+def compile_figures(tmp_dir: str) -> list[str]:
+    """compiles the bundled figures, returns the paths of their pdfs"""
+    pdfs = []
+    for code_file in sorted(glob.glob(os.path.join(RESOURCES, "*", "code.tex"))):
+        name = os.path.basename(os.path.dirname(code_file))
+        tex_file = os.path.join(tmp_dir, name + ".tex")
+        with open(code_file) as code, open(tex_file, "w") as tex:
+            tex.write(code.read())
+        output = subprocess.run(
+            [
+                "pdflatex",
+                "-halt-on-error",
+                "-interaction=nonstopmode",
+                "-output-directory",
+                tmp_dir,
+                tex_file,
+            ],
+            capture_output=True,
+        )
+        if output.returncode != 0:
+            print(f"{name}: does not compile, skipped", file=sys.stderr)
+            continue
+        pdfs.append(os.path.join(tmp_dir, name + ".pdf"))
+    return pdfs
+
+
+def measure(backend: str, pdfs: list[str], dpi: int, repeat: int) -> dict:
+    """rasterizes the pdfs with the backend, in this interpreter"""
+    rasterize = RASTERIZERS[backend]
+    results = {}
+    for pdf_path in pdfs:
+        with open(pdf_path, "rb") as pdf_file:
+            pdf = pdf_file.read()
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            image = rasterize(pdf, 1, 1, dpi, False)[0]
+            durations.append(time.perf_counter() - start)
+        results[os.path.basename(pdf_path)] = {
+            "median_ms": statistics.median(durations) * 1000,
+            "max_ms": max(durations) * 1000,
+            "size": image.size,
+        }
+    # ru_maxrss is in kilobytes on linux
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {"figures": results, "peak_rss_mb": peak_kb / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backends", nargs="+", default=list(RASTERIZERS))
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--measure", help=argparse.SUPPRESS
+    )  # backend measured by a child interpreter
+    parser.add_argument("--pdfs", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.pdfs, args.dpi, args.repeat)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdfs = compile_figures(tmp_dir)
+        sizes = {}
+        for backend in args.backends:
+            output = subprocess.run(
+                [sys.executable, __file__, "--measure", backend, "--dpi", str(args.dpi)]
+                + ["--repeat", str(args.repeat), "--pdfs"]
+                + pdfs,
+                capture_output=True,
+                text=True,
+            )
+            if output.returncode != 0:
+                error = output.stderr.strip().splitlines()[-1:] or ["failed"]
+                print(f"{backend:>10}: unavailable ({error[0]})")
+                continue
+            measured = json.loads(output.stdout)
+            for figure, result in measured["figures"].items():
+                sizes.setdefault(figure, set()).add(tuple(result["size"]))
+                print(
+                    f"{backend:>10} {figure:>16}: median {result['median_ms']:7.1f} ms, "
+                    f"max {result['max_ms']:7.1f} ms, {result['size'][0]}x{result['size'][1]}"
+                )
+            print(f"{backend:>10}: peak memory {measured['peak_rss_mb']:.1f} MB")
+
+        for figure, figure_sizes in sizes.items():
+            if len(figure_sizes) > 1:
+                print(f"{figure}: the backends disagree on the size, {figure_sizes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -123,7 +123,9 @@ function activate(context) {
             }
             vscode.window.showInformationMessage(`Output: ${stdout}`);
             const parsed = JSON.parse(stdout);
-            const mappings = parsed.map(([mapping, [score]]) => {
+            const mappings = parsed.map(([mapping, rawScore]) => {
+                // older versions of the script wrote the score in a one element list
+                const score = Array.isArray(rawScore) ? rawScore[0] : rawScore;
                 return [
                     {
                         spans: mapping.spans,
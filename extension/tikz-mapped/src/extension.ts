@@ -135,9 +135,12 @@ export function activate(context: vscode.ExtensionContext) {
 			vscode.window.showInformationMessage(`Output: ${stdout}`);
 
 
-			const parsed: [CodeImageMapping, [number]][] = JSON.parse(stdout);
+			const parsed: [CodeImageMapping, number | [number]][] = JSON.parse(stdout);
+
+			const mappings: MappingWithScore[] = parsed.map(([mapping, rawScore]): MappingWithScore => {
+				// older versions of the script wrote the score in a one element list
+				const score = Array.isArray(rawScore) ? rawScore[0] : rawScore
 
-			const mappings: MappingWithScore[] = parsed.map(([mapping, [score]]): MappingWithScore => {
 				return [
 					{
 						spans: mapping.spans as Span[],
@@ -0,0 +1,171 @@
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from vif_agent.agent import MutantStream, VifAgent
+from vif_agent.mutation.mutant import CompactTexMutant
+
+
+class FakeEmbeddingModel:
+    def encode(self, sentences):
+        return np.ones((len(sentences), 4))
+
+
+def _agent() -> VifAgent:
+    agent = VifAgent.__new__(VifAgent)
+    agent.debug = False
+    agent._embedding_model = FakeEmbeddingModel()
+    agent.embedding_model_name = None
+    return agent
+
+
+def test_map_features_uses_the_base_image_regions():
+    code = "\\draw (0,0) -- (1,1);\n\\fill (2,2) circle (1);"
+    base_image = Image.new("RGB", (32, 8), "white")
+    mutant_image = base_image.copy()
+    mutant_image.paste((0, 0, 0), (20, 2, 24, 6))
+
+    mutant = CompactTexMutant(22, code, [(22, 45)])
+    mutant.image = mutant_image
+    # region computed by the creator against a render differing from the base image
+    mutant.changed_region = (0, 0, 4, 4)
+    other_resolution = CompactTexMutant(0, code, [(0, 21)])
+    other_resolution.image = Image.new("RGB", (16, 4), "white")
+
+    mapped_code = _agent()._map_features(
+        code,
+        base_image,
+        [{"label": "circle", "box_2d": (16, 0, 32, 8)}],
+        [mutant, other_resolution],
+    )
+    ((mapping, score),) = mapped_code.feature_map["circle"]
+    assert mapping.spans == [(22, 45)] and score > 0
+
+
+def test_map_features_reuses_the_regions_of_the_base_image():
+    code = "\\draw (0,0) -- (1,1);\n\\fill (2,2) circle (1);"
+    base_image = Image.new("RGB", (32, 8), "white")
+    mutant_image = base_image.copy()
+    mutant_image.paste((0, 0, 0), (20, 2, 24, 6))
+    boxes = [{"label": "circle", "box_2d": (16, 0, 32, 8)}]
+
+    def mutant(original_image):
+        mutant = CompactTexMutant(22, code, [(22, 45)])
+        mutant.image = mutant_image
+        mutant.original_image = original_image
+        mutant.changed_region = (0, 0, 4, 4)  # outside of the box, noticed when reused
+        return mutant
+
+    mapped_code = _agent()._map_features(
+        code, base_image, boxes, [mutant(base_image.copy())]
+    )
+    assert mapped_code.feature_map["circle"] == []
+
+    other_render = base_image.copy()
+    other_render.putpixel((0, 0), (0, 0, 0))
+    mapped_code = _agent()._map_features(
+        code, base_image, boxes, [mutant(other_render)]
+    )
+    assert len(mapped_code.feature_map["circle"]) == 1
+
+
+def test_equivalent_mutants_are_annotated_separately():
+    code = "\\draw (0,0) -- (1,1);\n\\fill (2,2) circle (1);\n\\draw (0,0) -- (1,1);"
+    base_image = Image.new("RGB", (32, 8), "white")
+    mutant = CompactTexMutant(0, code, [(0, 20)])
+    mutant.image = base_image.copy()
+    mutant.image.paste((0, 0, 0), (20, 2, 24, 6))
+    mutant.equivalent_spans.append([(45, 65)])  # collapsed by the creator
+
+    mapped_code = _agent()._map_features(
+        code,
+        base_image,
+        [
+            {"label": "a", "box_2d": (16, 0, 32, 8)},
+            {"label": "b", "box_2d": (0, 0, 8, 8)},
+        ],
+        [mutant],
+    )
+    assert [mapping.spans for mapping, _ in mapped_code.feature_map["a"]] == [
+        [(0, 20)],
+        [(45, 65)],
+    ]
+    commented = mapped_code.get_commented()
+    assert commented.index("%a\n") == 0
+    assert commented.count("%a\n") == 2
+
+
+def test_closed_mutant_stream_stops_the_creation():
+    produced = []
+    closed = threading.Event()
+
+    def mutants():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    stream = MutantStream(max_buffered=2)
+    producer = threading.Thread(target=stream.produce, args=(mutants(),))
+    producer.start()
+    assert next(iter(stream)) == 0
+    stream.close()
+    producer.join(5)
+    assert not producer.is_alive() and closed.is_set()
+    assert len(produced) <= 4  # stopped once the queue is full
+
+
+def test_mutant_stream_raises_creation_errors():
+    def mutants():
+        yield 0
+        raise ValueError("creation failed")
+
+    stream = MutantStream()
+    stream.produce(mutants())
+    consumed = []
+    with pytest.raises(ValueError):
+        for mutant in stream:
+            consumed.append(mutant)
+    assert consumed == [0]
+
+
+class EndlessCreator:
+    uses_boxes = False
+
+    def __init__(self):
+        self.stopped = threading.Event()
+
+    def iter_mutants(self, code, boxes=None):
+        try:
+            while True:
+                mutant = CompactTexMutant(0, code, [(0, 1)])
+                mutant.image = Image.new("RGB", (8, 8), "white")
+                yield mutant
+        finally:
+            self.stopped.set()
+
+
+def test_failed_mapping_stops_the_background_creation():
+    agent = _agent()
+    agent.overlap_mutant_creation = True
+    agent.max_buffered_mutants = 4
+    agent.mutant_creator = EndlessCreator()
+    agent._mutant_executor = None
+    agent.code_renderer = lambda code: Image.new("RGB", (8, 8), "white")
+    agent.search_client = None
+    agent.search_model = "model"
+    agent.search_model_temperature = 0
+    unparseable = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="no features"))]
+    )
+    agent._complete = lambda client, request: unparseable
+
+    code, _ = agent.identify_features("\\draw (0,0) -- (1,1);")
+    assert agent.mutant_creator.stopped.wait(5)
+    # the executor is free for the next code
+    assert agent._mutant_executor.submit(lambda: code).result(timeout=5) == code
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+from vif_agent.async_agent import AsyncVifAgent, EndpointLimiter
+from vif_agent.mutation.mutant import CompactTexMutant
+
+
+def test_endpoint_limiter():
+    async def run():
+        limiter = EndpointLimiter(max_concurrency=2, requests_per_minute=600)
+        running = 0
+        max_running = 0
+
+        async def request():
+            nonlocal running, max_running
+            async with limiter.slot():
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.25)
+                running -= 1
+
+        start = time.monotonic()
+        await asyncio.gather(*(request() for _ in range(5)))
+        return max_running, time.monotonic() - start
+
+    max_running, duration = asyncio.run(run())
+    assert max_running == 2
+    assert duration >= 0.4  # one request started every 0.1s
+
+
+def test_map_codes_yields_as_finished():
+    agent = AsyncVifAgent.__new__(AsyncVifAgent)
+    agent.max_concurrent_codes = 2
+
+    async def identify_features(code):
+        await asyncio.sleep(float(code))
+        if code == "0.02":
+            raise ValueError(code)
+        return code
+
+    agent.identify_features = identify_features
+
+    async def run():
+        return [result async for result in agent.map_codes(["0.1", "0.02", "0.01"])]
+
+    results = asyncio.run(run())
+    assert [index for index, _ in results] == [1, 2, 0]
+    assert isinstance(results[0][1], ValueError)
+    assert results[1:] == [(2, "0.01"), (0, "0.1")]
+
+
+def test_failed_mapping_stops_the_mutant_creation():
+    stopped = threading.Event()
+
+    class EndlessCreator:
+        uses_boxes = False
+
+        def iter_mutants(self, code, boxes=None):
+            try:
+                while True:
+                    mutant = CompactTexMutant(0, code, [(0, 1)])
+                    mutant.image = Image.new("RGB", (8, 8), "white")
+                    yield mutant
+            finally:
+                stopped.set()
+
+    agent = AsyncVifAgent.__new__(AsyncVifAgent)
+    agent.debug = False
+    agent.mutant_creator = EndlessCreator()
+    agent.max_buffered_mutants = 4
+    agent.code_renderer = lambda code: Image.new("RGB", (8, 8), "white")
+    agent.search_client = None
+    agent.search_model = "model"
+    agent.search_model_temperature = 0
+
+    async def complete(client, request):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="no features"))]
+        )
+
+    agent._complete = complete
+    asyncio.run(agent.identify_features("\\draw (0,0) -- (1,1);"))
+    assert stopped.wait(5)
+
+
+def test_cancelled_mapping_stops_the_scoring():
+    scoring = threading.Event()
+
+    class SlowCreator:
+        uses_boxes = False
+
+        def iter_mutants(self, code, boxes=None):
+            while True:
+                time.sleep(0.2)
+                mutant = CompactTexMutant(0, code, [(0, 1)])
+                mutant.image = Image.new("RGB", (8, 8), "white")
+                yield mutant
+
+    def map_features(code, base_image, detected_boxes, mutants):
+        scoring.set()
+        return [mutant for mutant in mutants]
+
+    agent = AsyncVifAgent.__new__(AsyncVifAgent)
+    agent.debug = False
+    agent.mutant_creator = SlowCreator()
+    agent.max_buffered_mutants = 4
+    agent.code_renderer = lambda code: Image.new("RGB", (8, 8), "white")
+    agent.search_client = agent.identification_client = None
+    agent._search_request = agent._identification_request = lambda *args: None
+    agent._parse_features = lambda response: ["feature"]
+    agent._parse_boxes = lambda response, image: [{"box_2d": [0, 0, 8, 8]}]
+    agent._map_features = map_features
+
+    async def complete(client, request):
+        return None
+
+    agent._complete = complete
+
+    async def run():
+        task = asyncio.create_task(agent.identify_features("\\draw (0,0) -- (1,1);"))
+        await asyncio.to_thread(scoring.wait, 5)
+        await asyncio.sleep(0.5)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    # asyncio.run waits for the scoring thread of the default executor at shutdown
+    runner = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+    runner.start()
+    runner.join(10)
+    assert not runner.is_alive()
@@ -0,0 +1,90 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from vif_agent.mutation.mutant import CompactTexMutant
+from vif_agent.mutation.tex_mutant_creator import TexRegMutantCreator
+from vif_agent.renderer.batch import (
+    BATCH_MARKER,
+    build_batch_document,
+    parse_batch_log,
+    split_document,
+)
+
+
+def test_split_document():
+    code = "\\tikzset{a/.style={red}}\n\\begin{document}\n\\tikz\\draw (0,0);\n\\end{document}\n"
+    assert split_document(code) == (
+        "\\tikzset{a/.style={red}}\n",
+        "\n\\tikz\\draw (0,0);\n",
+    )
+    assert split_document("\\usepackage{x}\\begin{document}\\end{document}") is None
+    assert split_document("\\tikz\\draw (0,0);") is None
+
+
+def test_build_batch_document():
+    document = build_batch_document(
+        "\\documentclass{standalone}\n", [("", "FIRST"), ("\\def\\x{1}", "SECOND")]
+    )
+    assert document.count("\\begingroup") == 2
+    assert (
+        document.index("FIRST")
+        < document.index("\\def\\x{1}")
+        < document.index("SECOND")
+    )
+    assert document.endswith("\\end{document}\n")
+
+
+def test_parse_batch_log():
+    log = "\n".join(
+        [
+            "This is pdfTeX",
+            f"{BATCH_MARKER}:begin:0:0:1:document",
+            f"{BATCH_MARKER}:end:0:1:1:document",
+            f"{BATCH_MARKER}:begin:1:1:1:document",
+            "! Undefined control sequence.",
+            "l.12 \\dra",
+            f"{BATCH_MARKER}:end:1:1:1:document",
+            f"{BATCH_MARKER}:begin:2:1:1:document",
+            f"{BATCH_MARKER}:end:2:2:2:scope",
+            f"{BATCH_MARKER}:begin:3:2:1:document",
+            "! Emergency stop.",
+        ]
+    )
+    first, second, third, fourth, fifth = parse_batch_log(log, 5)
+    assert first.closed and first.balanced and not first.has_error
+    assert (first.start_page, first.end_page) == (0, 1)
+    assert second.has_error
+    assert not third.balanced
+    assert not fourth.closed and fourth.has_error
+    assert fifth is None
+
+
+@pytest.mark.skipif(
+    shutil.which("pdflatex") is None, reason="pdflatex is not installed"
+)
+def test_batched_mutant_deleting_a_definition():
+    code = (
+        "\\documentclass[tikz]{standalone}\n\\begin{document}\n\\begin{tikzpicture}\n"
+        "\\coordinate (a) at (1,1);\n\\draw (0,0) -- (a);\n\\fill (2,0) circle (0.5);\n"
+        "\\end{tikzpicture}\n\\end{document}\n"
+    )
+    start = code.index("\\coordinate")
+    end = code.index("\\draw")
+    fill = code.index("\\fill")
+    mutants = [
+        CompactTexMutant(fill, code, [(fill, code.index(";", fill) + 1)]),
+        CompactTexMutant(start, code, [(start, end)]),
+    ]
+    creator = TexRegMutantCreator(workers=1, batch_size=8)
+    batched = creator._render_codes(creator.renderer, mutants)
+    standalone = [
+        creator.renderer.from_strings_to_images([mutant.code])[0] for mutant in mutants
+    ]
+    for batched_result, standalone_result in zip(batched, standalone):
+        assert type(batched_result) is type(standalone_result)
+        if not isinstance(standalone_result, Exception):
+            assert np.array_equal(
+                np.asarray(batched_result), np.asarray(standalone_result)
+            )
@@ -0,0 +1,49 @@
+import os
+
+from vif_agent.disk_cache import DiskLRU
+
+
+def write_bytes(size: int):
+    def write_file(path: str):
+        with open(path, "wb") as file:
+            file.write(b"x" * size)
+
+    return write_file
+
+
+def test_disk_lru_accounting(tmp_path):
+    disk = DiskLRU(str(tmp_path), max_bytes=100)
+    for _ in range(3):
+        disk.write(disk.path("a"), write_bytes(40))
+    assert disk.disk_bytes == 40
+
+    # a file being written is neither counted nor evicted
+    (tmp_path / "b.1.tmp").write_bytes(b"x" * 10)
+    disk.write(disk.path("c"), write_bytes(40))
+    os.utime(disk.path("a"), (0, 0))
+    disk.write(disk.path("d"), write_bytes(40))
+    assert not os.path.exists(disk.path("a"))
+    assert os.path.exists(tmp_path / "b.1.tmp")
+    assert (disk.disk_bytes, disk.evictions) == (80, 1)
+    assert DiskLRU(str(tmp_path), max_bytes=100).disk_bytes == 80
+
+    disk.remove(disk.path("c"))
+    assert disk.disk_bytes == 40
+
+
+def test_disk_lru_evicts_below_the_budget(tmp_path):
+    disk = DiskLRU(str(tmp_path), max_bytes=1000)
+    scans = 0
+    scan = disk._scan
+
+    def counting_scan():
+        nonlocal scans
+        scans += 1
+        return scan()
+
+    disk._scan = counting_scan
+    for index in range(200):
+        disk.write(disk.path(str(index)), write_bytes(10))
+        assert disk.disk_bytes <= 1000
+    # once full, one eviction every ten writes instead of one per write
+    assert scans == 10
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from vif_agent.embedding import query_embedding
+from vif_agent.feature import CodeImageMapping, MappedCode
+
+
+class FakeEmbeddingModel:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, sentences):
+        if isinstance(sentences, str):
+            self.encoded.append(sentences)
+            return self._embed(sentences)
+        return np.array([self._embed(sentence) for sentence in sentences])
+
+    @staticmethod
+    def _embed(sentence: str) -> np.ndarray:
+        rng = np.random.default_rng(sum(map(ord, sentence)))
+        return rng.normal(size=8).astype(np.float32)
+
+
+@pytest.fixture
+def mapped_code():
+    rng = np.random.default_rng(0)
+    feature_map = {
+        name: [
+            (CodeImageMapping([(i, i + 1)], (0, 0, 1, 1)), float(rng.random()))
+            for i in range(5)
+        ]
+        for name in ["ears", "nose", "mouth", "tail"]
+    }
+    return MappedCode(None, "", feature_map, FakeEmbeddingModel())
+
+
+def expected_mappings(mapped_code: MappedCode, feature: str):
+    keys = mapped_code.key_embeddings
+    query = FakeEmbeddingModel._embed(feature)
+    similarities = keys @ query / (np.linalg.norm(keys, axis=1) * np.linalg.norm(query))
+    similarities = (similarities - similarities.min()) / (
+        similarities.max() - similarities.min() + 1e-8
+    )
+    mappings = [
+        (mapping, prob * similarity**10)
+        for (_, prob_mappings), similarity in zip(
+            mapped_code.feature_map.items(), similarities
+        )
+        for mapping, prob in prob_mappings
+    ]
+    return sorted(mappings, key=lambda mapping: mapping[1], reverse=True)
+
+
+def test_get_cimappings(mapped_code):
+    expected = expected_mappings(mapped_code, "ear")
+    mappings = mapped_code.get_cimappings("ear")
+    assert [mapping for mapping, _ in mappings] == [mapping for mapping, _ in expected]
+    np.testing.assert_allclose(
+        [score for _, score in mappings], [score for _, score in expected], rtol=1e-5
+    )
+
+    assert mapped_code.get_cimappings("ear", top_k=3) == mappings[:3]
+    threshold = mappings[6][1]
+    assert mapped_code.get_cimappings("ear", threshold=threshold) == mappings[:7]
+    # the query embedding is cached
+    assert mapped_code.embedding_model.encoded == ["ear"]
+
+
+def reference_commented(code: str, feature_map: dict, comment_character: str) -> str:
+    """previous implementation of get_commented, inserting each comment in the whole code"""
+    char_id_feature: dict = {}
+    for feature_name, prob_mappings in feature_map.items():
+        for mapping, prob in prob_mappings:
+            features_for_char = char_id_feature.get(mapping.spans[0][0], [])
+            features_for_char.append((feature_name, prob))
+            char_id_feature[mapping.spans[0][0]] = sorted(
+                features_for_char, key=lambda x: x[1], reverse=True
+            )
+    annotated_code = code
+    for characted_index, labels in sorted(char_id_feature.items(), reverse=True):
+        if len(labels) == len(feature_map):
+            continue
+        annotated_code = (
+            annotated_code[:characted_index]
+            + comment_character
+            + labels[0][0]
+            + "\n"
+            + annotated_code[characted_index:]
+        )
+    return annotated_code
+
+
+def test_get_commented_matches_reference():
+    rng = np.random.default_rng(0)
+    code = "\n".join(f"\\draw ({i},0) -- ({i},1);" for i in range(200))
+    starts = [line_start for line_start in range(0, len(code), 20)] + [len(code)]
+    feature_map = {
+        name: [
+            (
+                CodeImageMapping([(int(start), int(start) + 3)], (0, 0, 1, 1)),
+                float(rng.integers(0, 4)),  # ties between the features
+            )
+            for start in rng.choice(starts, 40)
+        ]
+        for name in ["ears", "nose", "mouth"]
+    }
+    mapped_code = MappedCode(None, code, feature_map, FakeEmbeddingModel())
+    assert mapped_code.get_commented("%") == reference_commented(code, feature_map, "%")
+
+
+def test_get_cimappings_top_k_ties():
+    rng = np.random.default_rng(0)
+    feature_map = {
+        name: [
+            (CodeImageMapping([(i, i + 1)], (0, 0, 1, 1)), float(rng.integers(1, 4)))
+            for i in range(200)
+        ]
+        for name in ["ears", "nose"]
+    }
+    mapped_code = MappedCode(None, "", feature_map, FakeEmbeddingModel())
+    mappings = mapped_code.get_cimappings("ear")
+    for top_k in range(1, 400, 7):
+        assert mapped_code.get_cimappings("ear", top_k=top_k) == mappings[:top_k]
+
+
+def test_query_embeddings_are_cached_per_model():
+    first, second = FakeEmbeddingModel(), FakeEmbeddingModel()
+    second._embed = lambda sentence: np.ones(8, dtype=np.float32)
+    query_embedding(first, "ear")
+    np.testing.assert_allclose(query_embedding(second, "ear"), np.ones(8) / np.sqrt(8))
+    assert first.encoded == ["ear"] and second.encoded == ["ear"]
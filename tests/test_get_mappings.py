@@ -0,0 +1,53 @@
+import io
+import json
+import os
+import pickle
+
+from vif_agent.feature import CodeImageMapping
+from vif_agent.script.get_mappings import MappingStore, serve
+
+
+class FakeMappedCode:
+    def __init__(self, label: str):
+        self.label = label
+
+    def get_cimappings(self, feature: str, top_k=None, threshold=None):
+        return [(CodeImageMapping([(0, 4)], (0, 0, 10, 10)), f"{self.label}:{feature}")]
+
+
+def query(store, requests: list[dict], mappingfile=None) -> list[dict]:
+    responses = io.StringIO()
+    serve(
+        store,
+        mappingfile,
+        io.StringIO("\n".join(json.dumps(request) for request in requests)),
+        responses,
+    )
+    return [json.loads(line) for line in responses.getvalue().splitlines()]
+
+
+def test_serve_reloads_changed_mappings(tmp_path):
+    path = str(tmp_path / "p.pickle")
+    with open(path, "wb") as mp:
+        pickle.dump(FakeMappedCode("first"), mp)
+    store = MappingStore()
+
+    request = {"jsonrpc": "2.0", "id": 1, "method": "get_cimappings"}
+    [response] = query(store, [{**request, "params": {"feature": "ears"}}], path)
+    assert response["result"] == [[{"spans": [[0, 4]], "zone": [0, 0, 10, 10]}, "first:ears"]]
+
+    with open(path, "wb") as mp:
+        pickle.dump(FakeMappedCode("second"), mp)
+    os.utime(path, ns=(0, 10**9))
+    responses = query(
+        store,
+        [
+            {**request, "params": {"feature": "nose", "mappingfile": path}},
+            {"jsonrpc": "2.0", "id": 2, "method": "unknown"},
+            {"jsonrpc": "2.0", "id": 3, "method": "shutdown"},
+            {**request, "id": 4, "params": {"feature": "nose", "mappingfile": path}},
+        ],
+    )
+    assert responses[0]["result"][0][1] == "second:nose"
+    assert responses[1]["error"]["code"] == -32601
+    assert [response["id"] for response in responses] == [1, 2, 3]
@@ -0,0 +1,22 @@
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "module", ["vif_agent.mutation.tex_mutant_creator", "vif_agent.agent"]
+)
+def test_import_skips_heavy_dependencies(module):
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; "
+            "print([m for m in ('torch', 'sentence_transformers', 'openai') if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert output.stdout.strip() == "[]"
@@ -0,0 +1,74 @@
+import json
+import os
+import time
+
+from openai.types.chat import ChatCompletion
+
+from vif_agent.llm_cache import LLMResponseCache
+
+
+def make_response(content: str) -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": "1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "model",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+        }
+    )
+
+
+def make_request(image: str, temperature: float = 0.0) -> dict:
+    return {
+        "model": "model",
+        "temperature": temperature,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "features?"},
+                    {"type": "image_url", "image_url": {"url": image}},
+                ],
+            }
+        ],
+    }
+
+
+def test_llm_cache_roundtrip(tmp_path):
+    cache = LLMResponseCache(cache_dir=str(tmp_path))
+    key = LLMResponseCache.key("https://api", make_request("data:a"))
+    assert key != LLMResponseCache.key("https://api", make_request("data:b"))
+    assert key != LLMResponseCache.key("https://api", make_request("data:a", 0.3))
+    assert key != LLMResponseCache.key("https://other", make_request("data:a"))
+    assert cache.get(key) is None
+
+    cache.put(key, make_response("square"))
+    cached = LLMResponseCache(cache_dir=str(tmp_path)).get(key)
+    assert cached.choices[0].message.content == "square"
+
+
+def test_llm_cache_ttl_and_eviction(tmp_path):
+    cache = LLMResponseCache(cache_dir=str(tmp_path), ttl=60)
+    cache.put("old", make_response("old"))
+    path = os.path.join(str(tmp_path), "old.json")
+    with open(path) as entry_file:
+        entry = json.load(entry_file)
+    entry["created"] -= 120
+    with open(path, "w") as entry_file:
+        json.dump(entry, entry_file)
+    assert cache.get("old") is None
+    assert not os.path.exists(path)
+
+    cache = LLMResponseCache(cache_dir=str(tmp_path), max_bytes=1)
+    cache.put("a", make_response("a"))
+    time.sleep(0.01)
+    cache.put("b", make_response("b"))
+    assert cache.get("a") is None
+    assert cache.evictions >= 1
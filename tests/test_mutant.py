@@ -0,0 +1,267 @@
+import re
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from vif_agent.mutation.mutant import CompactTexMutant
+from vif_agent.mutation.tex_mutant_creator import (
+    TexBisectionMutantCreator,
+    TexRegBrutalMutantCreator,
+    TexRegMutantCreator,
+)
+
+
+def test_compact_mutant_code():
+    code = "\\draw (0,0) -- (1,1);\n\\fill (a) circle (1);\n\\node at (b) {x};"
+    mutant = CompactTexMutant(22, code, [(22, 43), (0, 6)])
+    assert mutant.code == "(0,0) -- (1,1);\n\n\\node at (b) {x};"
+    assert mutant.original_code is code
+    assert mutant.removed_char_nb() == 27
+    assert not hasattr(mutant, "__dict__")
+
+    # the semicolon is removed without being part of the mapped span
+    mutant = CompactTexMutant(0, code, [(0, 20)], removed_spans=[(0, 21)])
+    assert mutant.code == code[21:]
+    assert mutant.deleted_spans == [(0, 20)]
+
+
+class LengthRenderer:
+    """renders a code as an image with a line as long as the code"""
+
+    def from_string_to_image(self, code):
+        image = Image.new("RGB", (256, 8), "white")
+        image.paste((0, 0, 0), (0, 0, len(code), 8))
+        return image
+
+    def from_strings_to_images(self, codes):
+        return [self.from_string_to_image(code) for code in codes]
+
+
+def test_iter_mutants_budgets():
+    code = "\n".join(f"\\draw (0,{i}) -- ({'1' * (i + 1)},{i});" for i in range(8))
+    creator = TexRegMutantCreator(workers=2, batch_size=2, renderer=LengthRenderer())
+
+    mutants = creator.create_mutants(code)
+    assert len(mutants) == 8
+    assert all(
+        mutant.changed_region == (len(mutant.code), 0, len(code), 8)
+        for mutant in mutants
+    )
+
+    assert [m.char_mutant for m in creator.iter_mutants(code, max_count=3)] == [
+        m.char_mutant for m in mutants[:3]
+    ]
+    assert len(list(creator.iter_mutants(code, max_image_bytes=256 * 8 * 3 * 5))) == 5
+    assert list(creator.iter_mutants(code, max_render_time=0)) == []
+
+    stream = creator.iter_mutants(code)
+    assert next(stream).char_mutant == 0
+    stream.close()  # stopping early
+
+
+def test_mutants_deleting_definitions_are_rendered_alone():
+    code = "\\coordinate (a) at (1,1);\n\\draw (0,0) -- (a);\n\\fill (0,0) circle (1);"
+    calls = []
+
+    class RecordingRenderer(LengthRenderer):
+        def from_strings_to_images(self, codes):
+            calls.append(len(codes))
+            return super().from_strings_to_images(codes)
+
+    creator = TexRegMutantCreator(workers=1, batch_size=8, renderer=RecordingRenderer())
+    mutants = [
+        CompactTexMutant(0, code, [(0, 24)]),  # deletes the coordinate definition
+        CompactTexMutant(26, code, [(26, 43)]),
+        CompactTexMutant(45, code, [(45, 67)]),
+    ]
+    creator._render_codes(creator.renderer, mutants)
+    assert sorted(calls) == [1, 2]
+
+
+def test_mutants_get_the_baseline_of_their_original():
+    baselines = []
+
+    class TimedRenderer(LengthRenderer):
+        def render_original(self, code):
+            return self.from_string_to_image(code), len(code) / 100
+
+        def from_strings_to_images(self, codes, baseline=None, original_code=None):
+            baselines.append(baseline)
+            return super().from_strings_to_images(codes)
+
+    creator = TexRegMutantCreator(workers=1, renderer=TimedRenderer())
+    short_code = "\\draw (0,0) -- (1,1);\n\\draw (0,1) -- (1,1);"
+    long_code = "\n".join(f"\\draw (0,{i}) -- (1,{i});" for i in range(8))
+    creator.create_mutants(short_code)
+    assert set(baselines) == {len(short_code) / 100}
+    baselines.clear()
+    creator.create_mutants(long_code)
+    assert set(baselines) == {len(long_code) / 100}
+
+
+def test_render_workers_shared_by_concurrent_creations():
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    class SlowRenderer(LengthRenderer):
+        def from_strings_to_images(self, codes):
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            time.sleep(0.01)
+            with lock:
+                running -= 1
+            return super().from_strings_to_images(codes)
+
+    code = "\n".join(f"\\draw (0,{i}) -- ({'1' * (i + 1)},{i});" for i in range(8))
+    creator = TexRegMutantCreator(workers=2, renderer=SlowRenderer())
+    creations = [
+        threading.Thread(target=creator.create_mutants, args=(code,)) for _ in range(3)
+    ]
+    for creation in creations:
+        creation.start()
+    for creation in creations:
+        creation.join()
+    assert max_running == 2
+
+
+def test_brutal_mutants_ranking():
+    code = "\n".join(f"\\draw (0,{i}) -- ({'1' * (i + 1)},{i});" for i in range(4))
+    creator = TexRegBrutalMutantCreator(
+        max_mutants=6, workers=1, renderer=LengthRenderer()
+    )
+    mutants = creator.create_mutants(code)
+    # every statement is deleted on its own before the deletions of two statements
+    assert [code.count(";") - mutant.code.count(";") for mutant in mutants] == [
+        1,
+        1,
+        1,
+        2,
+        2,
+        3,
+    ]
+
+
+def test_equivalent_mutants_deduplication():
+    # the first and last statements have the same length, so their mutants render the same image
+    code = "\\draw (0,0) -- (1,1);\n\\draw (0,0) -- (11,1);\n\\fill (1,0) -- (0,1);"
+    mutants = TexRegMutantCreator(workers=1, renderer=LengthRenderer()).create_mutants(
+        code
+    )
+    assert [(mutant.deleted_spans, mutant.equivalent_spans) for mutant in mutants] == [
+        ([(0, 20)], [[(45, 65)]]),
+        ([(22, 43)], []),
+    ]
+    assert mutants[0].code == code[21:]  # the code of the first mutant is kept
+
+    mutants = TexRegMutantCreator(
+        workers=1, renderer=LengthRenderer(), deduplicate=False
+    ).create_mutants(code)
+    assert len(mutants) == 3
+
+
+class ColumnRenderer:
+    """renders each \\draw (x); statement as a black column at x, counting the rendered codes"""
+
+    def __init__(self, scale: int = 1):
+        self.scale = scale
+        self.rendered = 0
+
+    def from_string_to_image(self, code):
+        self.rendered += 1
+        image = Image.new("L", (64 * self.scale, 8 * self.scale), 255)
+        for column in re.findall(r"\\draw \((\d+)\);", code):
+            x = int(column) * self.scale
+            image.paste(0, (x, 0, x + self.scale, 8 * self.scale))
+        return image
+
+    def from_strings_to_images(self, codes):
+        return [self.from_string_to_image(code) for code in codes]
+
+
+def test_bisection_mutants():
+    statements = [f"\\coordinate (c{i});" for i in range(32)]
+    statements[5] = "\\draw (5);"
+    statements[20] = "\\draw (20);"
+    code = "\n".join(statements)
+
+    renderer = ColumnRenderer()
+    creator = TexBisectionMutantCreator(workers=2, renderer=renderer)
+    mutants = creator.create_mutants(code)
+    reg_mutants = TexRegMutantCreator(
+        workers=1, renderer=ColumnRenderer()
+    ).create_mutants(code)
+    assert [(m.deleted_spans, m.code) for m in mutants] == [
+        (m.deleted_spans, m.code) for m in reg_mutants if m.changed_region[2] > 0
+    ]
+    assert renderer.rendered < 32
+
+    # only the statements changing the boxes are searched
+    mutants = list(creator.iter_mutants(code, boxes=[(18, 0, 24, 8)]))
+    assert [mutant.code.count("draw") for mutant in mutants] == [1]
+    assert "\\draw (5);" in mutants[0].code
+
+
+class OcclusionRenderer(ColumnRenderer):
+    """ColumnRenderer where \\erase (x); paints the column x drawn before it in white"""
+
+    def from_string_to_image(self, code):
+        image = super().from_string_to_image(code)
+        for statement, column in re.findall(r"\\(draw|erase) \((\d+)\);", code):
+            color = 0 if statement == "draw" else 255
+            image.paste(color, (int(column), 0, int(column) + 1, 8))
+        return image
+
+
+def test_bisection_misses_occluded_statements():
+    statements = [f"\\coordinate (c{i});" for i in range(8)]
+    statements[2] = "\\draw (2);"
+    statements[3] = "\\erase (2);"
+    code = "\n".join(statements)
+
+    reg_mutants = TexRegMutantCreator(
+        workers=1, renderer=OcclusionRenderer()
+    ).create_mutants(code)
+    assert [m.code.count("erase") for m in reg_mutants if m.changed_region[2] > 0] == [
+        0
+    ]
+    # deleting the draw and the erase together leaves the image unchanged, the search stops there
+    mutants = TexBisectionMutantCreator(
+        workers=1, renderer=OcclusionRenderer()
+    ).create_mutants(code)
+    assert mutants == []
+
+
+def test_screened_mutants():
+    statements = [f"\\coordinate (c{i});" for i in range(16)]
+    statements[5] = "\\draw (5);"
+    statements[12] = "\\draw (12);"
+    code = "\n".join(statements)
+
+    renderer = ColumnRenderer(scale=4)
+    creator = TexRegMutantCreator(
+        workers=1, renderer=renderer, screening_renderer=ColumnRenderer()
+    )
+    mutants = creator.create_mutants(code)
+    assert [mutant.changed_region for mutant in mutants] == [
+        (20, 0, 24, 32),
+        (48, 0, 52, 32),
+    ]
+    assert renderer.rendered == 3  # the original code and the changing candidates
+
+    renderer.rendered = 0
+    creator = TexBisectionMutantCreator(
+        workers=1, renderer=renderer, screening_renderer=ColumnRenderer()
+    )
+    mutants = list(creator.iter_mutants(code, boxes=[(40, 0, 60, 32)]))
+    assert [mutant.changed_region for mutant in mutants] == [(48, 0, 52, 32)]
+    assert renderer.rendered < 16
+
+    grayscale_renderer = ColumnRenderer()
+    grayscale_renderer.grayscale = True
+    with pytest.raises(ValueError):
+        TexRegMutantCreator(screening_renderer=grayscale_renderer)
@@ -0,0 +1,52 @@
+import threading
+import time
+
+from vif_agent.renderer.preamble_format import PreambleFormatStore, split_preamble
+
+
+def test_split_preamble():
+    code = (
+        "\\documentclass[tikz,border=5]{standalone}\n"
+        "\\usepackage[\n"
+        "prefix=]{xcolor-material}\n"
+        "\n"
+        "\\usetikzlibrary{calc}\n"
+        "\\tikzset{a/.style={red}}\n"
+        "\\begin{document}\n"
+        "\\usepackage{late}\n"
+    )
+    preamble, rest = split_preamble(code)
+    assert preamble.endswith("\\usetikzlibrary{calc}\n")
+    assert rest.startswith("\\tikzset")
+    assert preamble + rest == code
+
+
+def test_split_preamble_without_documentclass():
+    code = "\\begin{tikzpicture}\\end{tikzpicture}"
+    assert split_preamble(code) == ("", code)
+
+
+def test_format_dump_does_not_block_other_preambles(tmp_path):
+    store = PreambleFormatStore(str(tmp_path))
+    release = threading.Event()
+    builds = []
+
+    def build(format_name, preamble):
+        builds.append(preamble)
+        if preamble == "slow":
+            release.wait(10)
+        return format_name
+
+    store._build = build
+    slow_thread = threading.Thread(target=store.get_format, args=("slow",))
+    slow_thread.start()
+    while not builds:
+        time.sleep(0.01)
+
+    start = time.monotonic()
+    assert store.get_format("fast") is not None
+    assert time.monotonic() - start < 5
+    release.set()
+    slow_thread.join()
+    assert store.get_format("slow") is not None
+    assert sorted(builds) == ["fast", "slow"]
@@ -0,0 +1,114 @@
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from pdf2image.exceptions import PDFPageCountError
+from PIL import Image
+
+from vif_agent.renderer.rasterizer import RASTERIZERS, parse_pnm_stream
+from vif_agent.renderer.tex_renderer import TexRenderer
+
+
+def test_parse_pnm_stream():
+    stream = BytesIO()
+    Image.new("RGB", (3, 2), (10, 20, 30)).save(stream, format="PPM")
+    Image.new("L", (4, 5), 7).save(stream, format="PPM")
+
+    first, second = parse_pnm_stream(stream.getvalue())
+    assert (first.mode, first.size, first.getpixel((2, 1))) == (
+        "RGB",
+        (3, 2),
+        (10, 20, 30),
+    )
+    assert (second.mode, second.size, second.getpixel((3, 4))) == ("L", (4, 5), 7)
+
+
+@pytest.mark.parametrize("backend", list(RASTERIZERS))
+def test_rasterizer_geometry(backend):
+    if backend == "pdfium":
+        pytest.importorskip("pypdfium2")
+    elif shutil.which(backend) is None:
+        pytest.skip(f"{backend} is not installed")
+    pdf = BytesIO()
+    # two pages of 100x50 pt
+    Image.new("RGB", (100, 50), (255, 0, 0)).save(
+        pdf,
+        format="PDF",
+        resolution=72,
+        save_all=True,
+        append_images=[Image.new("RGB", (100, 50), (0, 0, 255))],
+    )
+
+    pages = RASTERIZERS[backend](pdf.getvalue(), 1, 2, 150, False)
+    assert [(page.mode, page.size) for page in pages] == [("RGB", (209, 105))] * 2
+    assert pages[1].getpixel((100, 50))[2] > 200
+
+    (page,) = RASTERIZERS[backend](pdf.getvalue(), 2, 2, 150, True)
+    assert (page.mode, page.size) == ("L", (209, 105))
+
+    with pytest.raises(PDFPageCountError):
+        RASTERIZERS[backend](b"not a pdf", 1, 1, 150, False)
+
+
+def test_unknown_rasterizer():
+    with pytest.raises(ValueError):
+        TexRenderer(rasterizer="ghostscript")
+    assert TexRenderer().settings() == {
+        "compiler": "pdflatex",
+        "rasterizer": "pdf2image",
+    }
+    assert TexRenderer(rasterizer="pdfium", dpi=50).settings()["rasterizer"] == "pdfium"
+
+
+def test_dvi_fallback_to_pdf():
+    preamble = "\\documentclass{standalone}\n\\usepackage{tikz}\n"
+    code = preamble + "\\begin{document}\\tikz\\draw (0,0) -- (1,1);\\end{document}"
+    faded = code.replace(
+        "\\begin{document}", "\\usetikzlibrary{fadings}\n\\begin{document}"
+    ).replace("\\draw", "\\draw[path fading=south]")
+    # mutant deleting the only faded path
+    faded_mutant = faded.replace("\\draw[path fading=south] (0,0) -- (1,1);", "")
+
+    renderer = TexRenderer(dvi=True)
+    assert renderer.uses_dvi(code)
+    # decided by the preamble, whatever the renders before
+    assert not renderer.uses_dvi(faded_mutant)
+    assert not renderer.uses_dvi(faded)
+    assert renderer.uses_dvi(code)
+    assert not renderer.uses_dvi(code.replace("{tikz}", "{tikz,graphicx}"))
+    assert renderer.settings(dvi=True)["compiler"] == "latex"
+
+    assert not TexRenderer().uses_dvi(code)
+
+
+def test_dvi_fallback_for_body_primitives():
+    code = (
+        "\\documentclass{standalone}\n\\usepackage{tikz}\n\\begin{document}\n"
+        "\\pdfliteral{0 0 m 10 10 l S}\n\\tikz\\draw (0,0) -- (1,1);\n\\end{document}"
+    )
+    # mutant deleting the primitive, compiled like its original
+    mutant = code.replace("\\pdfliteral{0 0 m 10 10 l S}", "")
+    renderer = TexRenderer(dvi=True)
+    assert not renderer.uses_dvi(code)
+    assert renderer.uses_dvi(mutant)
+    assert not renderer.uses_dvi(mutant, original_code=code)
+
+    calls = []
+    renderer._render = lambda input_string, baseline=None, dvi=None: calls.append(dvi)
+    renderer.from_strings_to_images([mutant], original_code=code)
+    assert calls == [False]
+
+
+def test_pdfium_concurrent_renders():
+    pytest.importorskip("pypdfium2")
+    pdf = BytesIO()
+    Image.new("RGB", (100, 50), (255, 0, 0)).save(pdf, format="PDF", resolution=72)
+    with ThreadPoolExecutor(8) as executor:
+        pages = list(
+            executor.map(
+                lambda _: RASTERIZERS["pdfium"](pdf.getvalue(), 1, 1, 150, False)[0],
+                range(32),
+            )
+        )
+    assert all(page.tobytes() == pages[0].tobytes() for page in pages)
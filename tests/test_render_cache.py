@@ -0,0 +1,60 @@
+import os
+
+from PIL import Image
+import pytest
+
+from vif_agent.renderer.render_cache import RenderCache, RenderFailure
+from vif_agent.renderer.tex_renderer import TexRenderer, TexRendererException
+
+
+def test_cache_roundtrip(tmp_path):
+    cache = RenderCache(cache_dir=str(tmp_path))
+    key = RenderCache.key("\\draw (0,0) -- (1,1);", {"dpi": 200})
+    assert cache.get(key) is None
+
+    image = Image.new("RGB", (10, 10), (255, 0, 0))
+    cache.put(key, image)
+    assert cache.get(key).getpixel((0, 0)) == (255, 0, 0)
+
+    # a fresh cache only has the disk entries
+    cache = RenderCache(cache_dir=str(tmp_path))
+    assert cache.get(key).getpixel((0, 0)) == (255, 0, 0)
+    assert cache.stats()["hits"] == 1
+
+
+def test_cache_key_depends_on_settings():
+    assert RenderCache.key("a", {"dpi": 200}) != RenderCache.key("a", {"dpi": 100})
+
+
+def test_cache_eviction(tmp_path):
+    cache = RenderCache(cache_dir=str(tmp_path), max_bytes=1, max_memory_bytes=1)
+    for i in range(3):
+        cache.put(str(i), Image.new("RGB", (10, 10)))
+    assert cache.evictions >= 2
+    assert cache.get("0") is None
+
+
+def test_cache_overwrite_accounting(tmp_path):
+    cache = RenderCache(cache_dir=str(tmp_path))
+    for _ in range(3):
+        cache.put("key", Image.new("RGB", (10, 10)))
+    assert cache.stats()["disk_bytes"] == os.path.getsize(tmp_path / "key.png")
+
+
+def test_renderer_caches_failures(tmp_path):
+    renderer = TexRenderer(cache=RenderCache(cache_dir=str(tmp_path)))
+    calls = []
+
+    def failing_render(input_string, baseline=None, dvi=None):
+        calls.append(input_string)
+        raise TexRendererException("! Undefined control sequence.")
+
+    renderer._render = failing_render
+    for _ in range(2):
+        with pytest.raises(TexRendererException):
+            renderer.from_string_to_image("\\broken")
+    assert len(calls) == 1
+    assert isinstance(
+        renderer.cache.get(RenderCache.key("\\broken", renderer.settings())),
+        RenderFailure,
+    )
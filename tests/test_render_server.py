@@ -0,0 +1,131 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from vif_agent.renderer.render_server import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    RenderClient,
+    RenderServer,
+    decode_result,
+    encode_result,
+)
+from vif_agent.renderer.tex_renderer import (
+    ImageRenderingException,
+    RenderingTimeoutException,
+    TexRendererException,
+)
+
+
+class FakeRenderer:
+    """renders a code as an image as wide as the code, the codes starting with "fail" do not compile"""
+
+    def __init__(self):
+        self.rendered: list[str] = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def from_strings_to_images(self, codes, baseline=None, original_code=None):
+        self.started.set()
+        self.release.wait(5)
+        self.rendered += codes
+        return [
+            (
+                TexRendererException(f"! Undefined control sequence in {code}")
+                if code.startswith("fail")
+                else Image.new("L", (len(code), 4), 255)
+            )
+            for code in codes
+        ]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    socket_path = str(tmp_path / "render.sock")
+    server = RenderServer(socket_path, workers=1, renderer=FakeRenderer())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(socket_path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    yield server
+    server.renderer.release.set()
+    server.shutdown()
+
+
+def test_result_encoding_round_trip():
+    for image in [
+        Image.new("RGB", (3, 2), (10, 20, 30)),
+        Image.new("L", (2, 5), 128),
+    ]:
+        decoded = decode_result(json.loads(json.dumps(encode_result(image))))
+        assert (decoded.mode, decoded.size) == (image.mode, image.size)
+        assert decoded.tobytes() == image.tobytes()
+
+    for exception in [
+        TexRendererException("! Undefined control sequence."),
+        RenderingTimeoutException("Timeout reached"),
+        ImageRenderingException("Document has no pages"),
+    ]:
+        decoded = decode_result(json.loads(json.dumps(encode_result(exception))))
+        assert type(decoded) is type(exception)
+        assert decoded.message == exception.message
+
+
+def test_interactive_jobs_go_first(server):
+    server.renderer.release.clear()  # the worker blocks in the first job
+    first = threading.Thread(
+        target=RenderClient(server.socket_path, PRIORITY_BULK).from_strings_to_images,
+        args=(["first"],),
+    )
+    first.start()
+    assert server.renderer.started.wait(5)
+
+    bulk = threading.Thread(
+        target=RenderClient(server.socket_path, PRIORITY_BULK).from_strings_to_images,
+        args=(["bulk"],),
+    )
+    bulk.start()
+    while server.jobs.qsize() < 1:
+        time.sleep(0.01)
+    interactive = threading.Thread(
+        target=RenderClient(server.socket_path, PRIORITY_INTERACTIVE).__call__,
+        args=("interactive",),
+    )
+    interactive.start()
+    while server.jobs.qsize() < 2:
+        time.sleep(0.01)
+
+    server.renderer.release.set()
+    for thread in [first, bulk, interactive]:
+        thread.join(5)
+    assert server.renderer.rendered == ["first", "interactive", "bulk"]
+
+
+def test_client_raises_the_server_exception(server):
+    client = RenderClient(server.socket_path, timeout=5)
+    assert client("abc").size == (3, 4)
+    with pytest.raises(TexRendererException, match="Undefined control sequence"):
+        client.from_string_to_image("fail")
+
+
+def test_malformed_request_gets_an_error_response(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(5)
+        connection.connect(server.socket_path)
+        with connection.makefile("rb") as responses:
+            connection.sendall(b"{not json\n")
+            assert "malformed request" in json.loads(responses.readline())["error"]
+            # the connection is still served
+            connection.sendall(json.dumps({"id": 1, "codes": ["ab"]}).encode() + b"\n")
+            response = json.loads(responses.readline())
+    assert response["id"] == 1
+    assert decode_result(response["results"][0]).size == (2, 4)
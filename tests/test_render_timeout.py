@@ -0,0 +1,104 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from vif_agent.renderer.tex_renderer import (
+    LIMIT_RETURNCODES,
+    RenderingTimeoutException,
+    TexRenderer,
+    TexRendererException,
+)
+
+
+def test_adaptive_timeout():
+    renderer = TexRenderer(rendering_timeout=30, timeout_factor=3, min_timeout=2)
+    assert renderer.timeout() == 30  # no baseline
+
+    assert renderer.timeout(0.5) == 2
+    assert renderer.timeout(0.5, codes=4) == 6
+    assert renderer.timeout(0.5, codes=100) == 30
+    assert TexRenderer(rendering_timeout=30).timeout(0.5) == 30
+
+
+def test_adaptive_timeout_only_applies_to_the_given_baseline():
+    renderer = TexRenderer(rendering_timeout=30, timeout_factor=3, min_timeout=2)
+    timeouts = []
+
+    def run_limited(command, env, timeout):
+        timeouts.append(timeout)
+        return subprocess.CompletedProcess(command, 1, b"", b"")
+
+    renderer._run_limited = run_limited
+    code = "\\documentclass{standalone}\n\\begin{document}\nx\n\\end{document}\n"
+    with pytest.raises(TexRendererException):
+        renderer.render_original(code)
+    renderer.from_strings_to_images([code.replace("x", "y")], baseline=0.5)
+    # another original with the same preamble is not limited by the previous baselines
+    with pytest.raises(TexRendererException):
+        renderer.from_string_to_image(code.replace("x", "z"))
+    assert timeouts == [30, 2, 30]
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_timeout_kills_process_group(tmp_path):
+    pid_path = tmp_path / "pid"
+    # the background sleep outlives its shell unless the whole group is killed
+    command = ["sh", "-c", f"sleep 30 & echo $! > {pid_path}; wait"]
+    start = time.monotonic()
+    assert TexRenderer()._run_limited(command, os.environ.copy(), 0.5) is None
+    assert time.monotonic() - start < 10
+
+    background_pid = int(pid_path.read_text())
+    deadline = time.monotonic() + 5
+    while _is_running(background_pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _is_running(background_pid)
+
+
+def test_memory_limit():
+    renderer = TexRenderer(memory_limit=512 * 1024**2)
+    command = [sys.executable, "-c", "bytearray(2 * 1024**3)"]
+    output = renderer._run_limited(command, os.environ.copy(), 30)
+    assert output is not None and output.returncode != 0
+    assert b"MemoryError" in output.stderr
+
+
+def test_cpu_time_limit():
+    renderer = TexRenderer(cpu_time_limit=1)
+    # the limits are set before the command runs
+    command = [
+        sys.executable,
+        "-c",
+        "import resource; print(resource.getrlimit(resource.RLIMIT_CPU))",
+    ]
+    output = renderer._run_limited(command, os.environ.copy(), 30)
+    assert output.stdout.strip() == b"(1, 2)"
+
+    output = renderer._run_limited(
+        [sys.executable, "-c", "while True: pass"], os.environ.copy(), 30
+    )
+    assert output.returncode == -signal.SIGXCPU
+    assert output.returncode in LIMIT_RETURNCODES
+
+
+def test_killed_compilations_are_timeouts():
+    renderer = TexRenderer()
+    renderer._run_pdflatex = lambda *args, **kwargs: subprocess.CompletedProcess(
+        [], -signal.SIGKILL, b"", b""
+    )
+    code = "\\documentclass{standalone}\n\\begin{document}\nx\n\\end{document}\n"
+    with pytest.raises(RenderingTimeoutException):
+        renderer.from_string_to_image(code)
+    results = renderer.from_strings_to_images([code, code.replace("x", "y")])
+    assert all(isinstance(result, RenderingTimeoutException) for result in results)
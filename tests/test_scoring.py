@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+from PIL import Image
+
+from vif_agent.scoring import (
+    BoxScorer,
+    RegionIndex,
+    changed_region,
+    image_fingerprint,
+)
+from vif_agent.utils import norm_mse
+
+
+def test_box_scorer_matches_norm_mse():
+    rng = np.random.default_rng(0)
+    base = np.full((120, 160, 3), 255, dtype=np.uint8)
+    base[80:120, 0:40] = 10  # box whose normalization value comes from the mutant
+    base[20:50, 30:90] = rng.integers(0, 200, (30, 60, 3))
+    base_image = Image.fromarray(base)
+    boxes = [(0, 0, 160, 120), (25, 15, 95, 55), (0, 80, 40, 120), (140, 100, 170, 130)]
+
+    mutants = []
+    for _ in range(10):
+        mutant = base.copy()
+        y, x = rng.integers(0, 110), rng.integers(0, 150)
+        mutant[y : y + 10, x : x + 10] = rng.integers(0, 256, (10, 10, 3))
+        mutants.append(Image.fromarray(mutant))
+    mutants.append(base_image.copy())
+
+    scorer = BoxScorer(base_image, boxes)
+    for mutant in mutants:
+        scores = scorer.score(mutant)
+        for box, score in zip(boxes, scores):
+            expected = norm_mse(base_image.crop(box), mutant.crop(box)) / math.prod(
+                base_image.crop(box).size
+            )
+            assert (score == 0) == (expected == 0)
+            assert math.isclose(score, expected, rel_tol=1e-5)
+
+
+def test_changed_region_scoring():
+    rng = np.random.default_rng(1)
+    base = rng.integers(0, 256, (100, 130, 3), dtype=np.uint8)
+    base_image = Image.fromarray(base)
+    boxes = [(0, 0, 50, 50), (40, 40, 130, 100), (100, 0, 130, 30)]
+    scorer = BoxScorer(base_image, boxes)
+
+    mutant = base.copy()
+    mutant[45:60, 20:48] = 0
+    mutant_image = Image.fromarray(mutant)
+    region = changed_region(base, mutant_image)
+    assert region == (20, 45, 48, 60)
+    assert changed_region(base, base_image) == (0, 0, 0, 0)
+
+    index = RegionIndex([region, (0, 0, 0, 0), (110, 5, 120, 10)], cell_size=16)
+    assert [index.query(box) for box in boxes] == [[0], [0], [2]]
+
+    np.testing.assert_allclose(
+        scorer.score(mutant_image, region, [0, 1]),
+        scorer.score(mutant_image),
+    )
+
+
+def test_image_fingerprint():
+    base = Image.new("L", (32, 32), 255)
+    first = base.copy()
+    first.paste(0, (8, 8, 24, 24))
+    second = first.copy()
+    second.putpixel((8, 8), 10)  # antialiasing difference
+    region = changed_region(np.asarray(base), first)
+
+    assert image_fingerprint(first, region) == image_fingerprint(first.copy(), region)
+    assert image_fingerprint(first, region) != image_fingerprint(second, region)
+    assert image_fingerprint(first, region, perceptual=True) == image_fingerprint(
+        second, region, perceptual=True
+    )
+    assert image_fingerprint(base, (0, 0, 0, 0)) == image_fingerprint(
+        base.copy(), (0, 0, 0, 0)
+    )
@@ -0,0 +1,51 @@
+from vif_agent.mutation.tikz_index import TikzIndex
+
+CODE = "\n".join(
+    [
+        "\\begin{tikzpicture}",
+        "\\coordinate (a) at (0,0);",
+        "\\clip (0,0) rectangle (2,2);",
+        "\\begin{scope}[shift={(1,0)}]",
+        "\\draw (a) -- (1,1); % \\fill (b);",
+        "\\end{scope}",
+        "\\scoped{\\node[red] (b) at (a) {50\\%};}",
+        "\\end{tikzpicture}",
+    ]
+)
+
+
+def test_tikz_index():
+    index = TikzIndex(CODE)
+
+    assert [(d.name, CODE[d.start : d.end]) for d in index.definitions] == [
+        ("a", "\\coordinate (a)"),
+        ("b", "\\node[red] (b)"),
+    ]
+    draws = index.commands_named(["draw", "fill"])
+    assert [CODE[c.start : index.terminator(c.start)] for c in draws] == [
+        "\\draw (a) -- (1,1)"
+    ]  # the commented command is skipped
+
+    scope_start = CODE.index("\\begin{scope}")
+    scoped_start = CODE.index("\\scoped")
+    assert index.scopes == [
+        (scope_start, CODE.index("\\end{scope}") + len("\\end{scope}")),
+        (scoped_start, CODE.index("}\n\\end{tikzpicture}") + 1),
+    ]
+
+    # statements run from the last line starting with a command, the clip statement is skipped
+    assert [CODE[start:end] for start, end in index.statements()] == [
+        "\\coordinate (a) at (0,0)",
+        "\\draw (a) -- (1,1)",
+        "\\scoped{\\node[red] (b) at (a) {50\\%}",
+    ]
+
+
+def test_name_usages():
+    code = "\\coordinate (a) at (0,0);\n\\draw (a) -- (b.north) -- (a);\n\\fill (b) circle (1);\n\\node (c) at (a) {};"
+    usages = TikzIndex(code).name_usages(["draw", "fill"])
+    assert {name: [c.name for c in commands] for name, commands in usages.items()} == {
+        "a": ["draw"],
+        "b": ["draw", "fill"],
+        "1": ["fill"],
+    }
@@ -1,14 +1,20 @@
-import math
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
 import os
+import queue
 import shutil
-from typing import Iterable
-from openai import OpenAI
-from collections.abc import Callable
+import threading
+from typing import TYPE_CHECKING, Iterable
+from collections.abc import Callable, Iterator
 from PIL import Image
-from sentence_transformers import SentenceTransformer
+from vif_agent.embedding import DEFAULT_EMBEDDING_MODEL, get_embedding_model
 from vif_agent.feature import CodeImageMapping, MappedCode
-from vif_agent.mutation.mutant import TexMutant
-from vif_agent.utils import adjust_bbox, encode_image, norm_mse
+from vif_agent.llm_cache import LLMResponseCache
+from vif_agent.mutation.mutant import CompactTexMutant
+from vif_agent.scoring import BoxScorer, RegionIndex, changed_region
+import numpy as np
+from vif_agent.utils import adjust_bbox, encode_image
 from vif_agent.prompt import *
 from vif_agent.mutation.tex_mutant_creator import (
     TexMappingMutantCreator,
@@ -23,12 +29,73 @@ from loguru import logger
 import uuid
 import sys
 
+if TYPE_CHECKING:
+    from openai import OpenAI
+
 type Spans = tuple[list[tuple[int, int]], float]  # for lisibiilty
 
 logger.remove()
 logger.add(sys.stderr, level="INFO")
 
 
+class MutantStream:
+    """Mutants created in a background thread, buffered in a bounded queue until they are consumed
+
+    Closing the stream stops the creation at the next mutant, e.g. when the mapping of the code fails.
+    """
+
+    def __init__(self, max_buffered: int = 16):
+        """
+        Args:
+            max_buffered (int, optional): maximum number of created mutants waiting to be consumed
+        """
+        self._queue: queue.Queue = queue.Queue(max_buffered)
+        self._stopped = threading.Event()
+
+    def produce(self, mutants: Iterator[CompactTexMutant]):
+        """Puts the mutants in the stream until they are exhausted or the stream is closed, closing the iterator"""
+        try:
+            for mutant in mutants:
+                if not self._put(mutant):
+                    return
+        except Exception as e:
+            self._put(e)
+        finally:
+            if hasattr(mutants, "close"):
+                mutants.close()  # stops the renders of the creator
+        self._put(None)  # end of the mutants
+
+    def close(self):
+        self._stopped.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._stopped.is_set()
+
+    def __iter__(self) -> Iterator[CompactTexMutant]:
+        """Yields the mutants until they are exhausted or the stream is closed, re-raising the creation errors"""
+        while not self._stopped.is_set():
+            try:
+                mutant = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue  # checks again whether the stream was closed, e.g. by a cancelled mapping
+            if mutant is None:
+                return
+            if isinstance(mutant, Exception):
+                raise mutant
+            yield mutant
+
+    def _put(self, item) -> bool:
+        """waits for room in the queue, False when the stream is closed meanwhile"""
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
 class VifAgent:
     def __init__(
         self,
@@ -46,7 +113,22 @@ class VifAgent:
         clarify_instruction=True,
         debug_folder=".tmp/debug",
         mutant_creator=TexMappingMutantCreator(),
+        overlap_mutant_creation=True,
+        response_cache: LLMResponseCache = None,
+        embedding_model_name: str = DEFAULT_EMBEDDING_MODEL,
+        max_buffered_mutants: int = 64,
     ):
+        """
+        Args:
+            overlap_mutant_creation (bool, optional): creates the mutants in a background thread while waiting for the
+                feature search and identification responses, instead of after them.
+            max_buffered_mutants (int, optional): maximum number of mutants created in the background before the scoring
+                starts consuming them, bounding the memory of their images. The creation pauses when it is reached.
+            response_cache (LLMResponseCache, optional): cache of the responses of the models, to reuse them
+                when the same request is sent again. Disabled by default.
+            embedding_model_name (str, optional): sentence transformer embedding the feature names,
+                loaded when the first code is mapped and shared by the agents of the process.
+        """
         self.client = client
         self.model = model
         self.code_renderer = code_renderer
@@ -64,8 +146,24 @@ class VifAgent:
         self.clarify_instruction = clarify_instruction
 
         self.mutant_creator = mutant_creator
+        self.overlap_mutant_creation = overlap_mutant_creation
+        self._mutant_executor: ThreadPoolExecutor = None
+        self.max_buffered_mutants = max_buffered_mutants
+        self.response_cache = response_cache
 
-        self.embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+        self.embedding_model_name = embedding_model_name
+        self._embedding_model = None
+
+    @property
+    def embedding_model(self):
+        if self._embedding_model is None:
+            self._embedding_model = get_embedding_model(self.embedding_model_name)
+        return self._embedding_model
+
+    @embedding_model.setter
+    def embedding_model(self, embedding_model):
+        self._embedding_model = embedding_model
+        self.embedding_model_name = None  # unknown, pickled with the mapped codes
 
     def apply_instruction(self, code: str, instruction: str):
         """DEBUG"""
@@ -87,7 +185,228 @@ class VifAgent:
             instruction = self.apply_clarification(instruction, base_image)
 
         logger.info("applying the instruction")
-        response = self.client.chat.completions.create(
+        response = self._complete(
+            self.client, self._generation_request(user_instruction)
+        )
+        return response.choices[-1].message.content
+
+    def apply_clarification(self, instruction: str, base_image: Image.Image):
+        encoded_image = encode_image(image=base_image)
+
+        response = self._complete(
+            self.client, self._clarification_request(instruction, encoded_image)
+        )
+
+        new_instruction = response.choices[-1].message.content
+        if self.debug:
+            open(
+                os.path.join(self.debug_folder, self.debug_id, "new_instruction.txt"),
+                "w",
+            ).write(new_instruction)
+
+        return new_instruction
+
+    def identify_features(self, code: str) -> MappedCode:
+        """Identifies the features within the code by commenting it
+
+        Args:
+            code (str): The code where the features need to be identified
+            comment_character (str): the character used to comment the code
+        Returns:
+            dict[str, list[Spans]]: a dictionnary associating the feature with a list of probable spans
+        """
+        """DEBUG"""
+        if self.debug and not hasattr(self, "debug_id"):
+            self.debug_id = str(uuid.uuid4())
+            os.mkdir(os.path.join(self.debug_folder, self.debug_id))
+        """"""
+
+        # unifying the code for easier parsing in mutant creation
+        code = "\n".join(line.strip() for line in code.split("\n"))
+        # the mutants only depend on the code, they are rendered during the VLM requests
+        mutants_stream = self._start_mutant_creation(code)
+        try:
+            # render image
+            base_image = self.code_renderer(code)
+            # VLM to get features
+            logger.info("Searching for features")
+            encoded_image = encode_image(image=base_image)
+            response = self._complete(
+                self.search_client, self._search_request(encoded_image)
+            )
+            features = self._parse_features(response)
+            if features is None:
+                return code, base_image
+            # Segmentation via google ai spatial
+            logger.info("Identifying features")
+            response = self._complete(
+                self.identification_client,
+                self._identification_request(features, encoded_image),
+            )
+            detected_boxes = self._parse_boxes(response, base_image)
+            if detected_boxes is None:
+                return code, base_image
+            # create mutants of the code, the ones not created yet are scored as they arrive
+            mutants = (
+                mutants_stream
+                if mutants_stream is not None
+                else self.mutant_creator.iter_mutants(
+                    code, boxes=[box["box_2d"] for box in detected_boxes]
+                )
+            )
+            return self._map_features(code, base_image, detected_boxes, mutants)
+        finally:
+            if mutants_stream is not None:
+                # stops the creation when the mapping failed, frees the executor for the next code
+                mutants_stream.close()
+
+    def _map_features(
+        self,
+        code: str,
+        base_image: Image.Image,
+        detected_boxes: list[dict],
+        mutants: Iterable[CompactTexMutant],
+    ) -> MappedCode:
+        """Maps the detected features to the mutants changing them
+
+        Args:
+            code (str): normalized code
+            base_image (Image.Image): image of the code
+            detected_boxes (list[dict]): detected features, with their "label" and "box_2d"
+            mutants (Iterable[CompactTexMutant]): rendered mutants of the code, scored as they are iterated
+
+        Returns:
+            MappedCode: the code with its feature map
+        """
+
+        # Check what has been modified by each mutant
+        feature_map: dict[str, list[tuple[CodeImageMapping, float]]] = (
+            {}
+        )  # mapping between the feature and a list of possible spans of the part of the code of the feature and their "probability" of being the right span
+
+        """DEBUG"""
+        if self.debug:
+            base_image.save(
+                os.path.join(self.debug_folder, self.debug_id, "base_image.png")
+            )
+            shutil.rmtree(
+                os.path.join(self.debug_folder, self.debug_id, "features/"),
+                ignore_errors=True,
+            )
+            os.mkdir(os.path.join(self.debug_folder, self.debug_id, "features"))
+        """"""
+        # scores of each mutant for each box, each mutant image is compared once for all the boxes it can change,
+        # as soon as it is created, and only its spans and scores are kept
+        boxes = [box["box_2d"] for box in detected_boxes]
+        scorer = BoxScorer(base_image, boxes)
+        base_array = np.asarray(base_image)
+        box_index = RegionIndex(scorer.regions)
+        # the equivalent spans of a mutant are completed while the next mutants are created, read once they are all scored
+        mutant_scores: list[
+            tuple[np.ndarray, list[tuple[int, int]], list[list[tuple[int, int]]]]
+        ] = []
+        scored_pairs = 0
+        mismatched = 0
+        # whether the original image of the creator, by id, is the base image
+        same_originals: dict[int, bool] = {}
+        for mutant in mutants:
+            if (
+                mutant.image.size != base_image.size
+                or mutant.image.mode != base_image.mode
+            ):
+                mismatched += 1  # rendered with other settings than the base image
+                continue
+            # the region set by the creator is relative to its own render of the code, which can differ from the base image
+            original_image = mutant.original_image
+            if original_image is not None and id(original_image) not in same_originals:
+                same_originals[id(original_image)] = (
+                    original_image.size == base_image.size
+                    and original_image.mode == base_image.mode
+                    and np.array_equal(np.asarray(original_image), base_array)
+                )
+            region = (
+                mutant.changed_region
+                if mutant.changed_region is not None
+                and same_originals.get(id(original_image), False)
+                else changed_region(base_array, mutant.image)
+            )
+            box_indexes = box_index.query(region)
+            scored_pairs += len(box_indexes)
+            scores = (
+                scorer.score(mutant.image, region, box_indexes)
+                if box_indexes
+                else np.zeros(len(boxes))
+            )
+            mutant_scores.append(
+                (scores, mutant.deleted_spans, mutant.equivalent_spans)
+            )
+        logger.info(
+            f"scoring {scored_pairs} of {len(mutant_scores) * len(boxes)} mutant/box pairs"
+        )
+        if mismatched:
+            logger.warning(
+                f"{mismatched} mutants not rendered like the base image, skipped. "
+                "Render the mutants and the code with the same settings."
+            )
+
+        for box_index, box in enumerate(detected_boxes):
+            """DEBUG"""
+            if self.debug:
+                base_image.crop(box["box_2d"]).save(
+                    os.path.join(
+                        self.debug_folder,
+                        self.debug_id,
+                        "features/" + box["label"] + ".png",
+                    )
+                )
+            """"""
+            # one mapping for each of the equivalent mutants, annotated like distinct mutants rendering the same image
+            cur_mse_map: list[tuple[float, list[tuple[int, int]]]] = [
+                (
+                    float(scores[box_index]),
+                    spans,
+                )  # normalized MSE divided by the size of the image, to favoritize small specific features
+                for scores, deleted_spans, equivalent_spans in mutant_scores
+                for spans in [deleted_spans, *equivalent_spans]
+            ]
+
+            sorted_mse_map: list[tuple[float, list[tuple[int, int]]]] = sorted(
+                filter(lambda m: m[0] != 0, cur_mse_map),
+                key=lambda m: m[0],
+                reverse=True,
+            )
+
+            mappings_for_features: list[tuple[CodeImageMapping, float]] = [
+                (CodeImageMapping(deleted_spans, box["box_2d"]), mse_value)
+                for mse_value, deleted_spans in sorted_mse_map
+            ]
+
+            feature_map[box["label"]] = mappings_for_features
+
+        mapped_code = MappedCode(
+            base_image,
+            code,
+            feature_map,
+            self.embedding_model,
+            self.embedding_model_name,
+        )
+        return mapped_code
+
+    def _complete(self, client: OpenAI, request: dict):
+        """Sends a chat completion request, through the response cache when there is one"""
+        if self.response_cache is None:
+            return client.chat.completions.create(**request)
+        key = LLMResponseCache.key(str(client.base_url), request)
+        response = self.response_cache.get(key)
+        if response is not None:
+            logger.info(f"reusing the cached response of {request['model']}")
+            return response
+        response = client.chat.completions.create(**request)
+        self.response_cache.put(key, response)
+        return response
+
+    def _generation_request(self, user_instruction: str) -> dict:
+        return dict(
             model=self.model,
             temperature=self.temperature,
             messages=[
@@ -98,12 +417,9 @@ class VifAgent:
                 {"role": "user", "content": user_instruction},
             ],
         )
-        return response.choices[-1].message.content
 
-    def apply_clarification(self, instruction: str, base_image: Image.Image):
-        encoded_image = encode_image(image=base_image)
-
-        response = self.client.chat.completions.create(
+    def _clarification_request(self, instruction: str, encoded_image: str) -> dict:
+        return dict(
             model=self.model,
             temperature=self.temperature,
             messages=[
@@ -129,38 +445,8 @@ class VifAgent:
             ],
         )
 
-        new_instruction = response.choices[-1].message.content
-        if self.debug:
-            open(
-                os.path.join(self.debug_folder, self.debug_id, "new_instruction.txt"),
-                "w",
-            ).write(new_instruction)
-
-        return new_instruction
-
-    def identify_features(self, code: str) -> MappedCode:
-        """Identifies the features within the code by commenting it
-
-        Args:
-            code (str): The code where the features need to be identified
-            comment_character (str): the character used to comment the code
-        Returns:
-            dict[str, list[Spans]]: a dictionnary associating the feature with a list of probable spans
-        """
-        """DEBUG"""
-        if self.debug and not hasattr(self, "debug_id"):
-            self.debug_id = str(uuid.uuid4())
-            os.mkdir(os.path.join(self.debug_folder, self.debug_id))
-        """"""
-
-        # unifying the code for easier parsing in mutant creation
-        code = "\n".join(line.strip() for line in code.split("\n"))
-        # render image
-        base_image = self.code_renderer(code)
-        # VLM to get features
-        logger.info("Searching for features")
-        encoded_image = encode_image(image=base_image)
-        response = self.search_client.chat.completions.create(
+    def _search_request(self, encoded_image: str) -> dict:
+        return dict(
             model=self.search_model,
             temperature=self.search_model_temperature,
             messages=[
@@ -181,17 +467,18 @@ class VifAgent:
                 }
             ],
         )
+
+    def _parse_features(self, response) -> dict | None:
         pattern = r"```(?:\w+)?\n([\s\S]+?)```"
         search_match = re.search(pattern, response.choices[0].message.content)
         if not search_match:
             logger.warning(
                 f"Feature search failed, using un-commented code, unparseable response {response.choices[0].message.content}"
             )
-            return code, base_image
+            return None
 
         features_match = search_match.group(1)
         features = json.loads(features_match)
-        self.features = features
         """DEBUG"""
         if self.debug:
             json.dump(
@@ -201,9 +488,10 @@ class VifAgent:
                 ),
             )
         """"""
-        # Segmentation via google ai spatial
-        logger.info("Identifying features")
-        response = self.identification_client.chat.completions.create(
+        return features
+
+    def _identification_request(self, features: dict, encoded_image: str) -> dict:
+        return dict(
             model=self.identification_model,
             temperature=self.identification_model_temperature,
             messages=[
@@ -226,6 +514,8 @@ class VifAgent:
                 }
             ],
         )
+
+    def _parse_boxes(self, response, base_image: Image.Image) -> list[dict] | None:
         pattern = r"```(?:\w+)?\n([\s\S]+?)```"
         id_match = re.search(pattern, response.choices[0].message.content)
 
@@ -233,12 +523,11 @@ class VifAgent:
             logger.warning(
                 f"Feature identification failed, using un-commented code, unparseable response {response.choices[0].message.content}"
             )
-            return code, base_image
+            return None
 
         json_boxes = id_match.group(1)
         detected_boxes = json.loads(json_boxes)
         detected_boxes = [adjust_bbox(box, base_image) for box in detected_boxes]
-        self.detected_boxes = detected_boxes
         """DEBUG"""
         if self.debug:
             json.dump(
@@ -246,65 +535,30 @@ class VifAgent:
                 open(os.path.join(self.debug_folder, self.debug_id, "boxes.json"), "w"),
             )
         """"""
-        # create mutants of the code
-        mutants = self.mutant_creator.create_mutants(code)
+        return detected_boxes
 
-        # Check what has been modified by each mutant
-        feature_map: dict[str, list[tuple[CodeImageMapping, float]]] = (
-            {}
-        )  # mapping between the feature and a list of possible spans of the part of the code of the feature and their "probability" of being the right span
+    def _start_mutant_creation(self, code: str) -> MutantStream | None:
+        """Starts creating the mutants of the code in the background
 
-        """DEBUG"""
-        if self.debug:
-            base_image.save(
-                os.path.join(self.debug_folder, self.debug_id, "base_image.png")
-            )
-            shutil.rmtree(
-                os.path.join(self.debug_folder, self.debug_id, "features/"),
-                ignore_errors=True,
-            )
-            os.mkdir(os.path.join(self.debug_folder, self.debug_id, "features"))
-        """"""
-        for box in detected_boxes:
-            base_image_mask = base_image.crop(box["box_2d"])
-            """DEBUG"""
-            if self.debug:
-                base_image_mask.save(
-                    os.path.join(
-                        self.debug_folder,
-                        self.debug_id,
-                        "features/" + box["label"] + ".png",
-                    )
-                )
-            """"""
-            cur_mse_map: list[tuple[float, TexMutant]] = []
-            for mutant in mutants:
-                mutant_image_mask = mutant.image.crop(box["box_2d"])
-                cur_mse_map.append(
-                    (
-                        norm_mse(base_image_mask, mutant_image_mask)
-                        / math.prod(base_image_mask.size),
-                        mutant,
-                    )#normalized MSE divided by the size of the image, to favoritize small specific features
-                )
-
-            sorted_mse_map: list[tuple[float, TexMutant]] = sorted(
-                filter(lambda m: m[0] != 0, cur_mse_map),
-                key=lambda m: m[0],
-                reverse=True,
+        Returns:
+            MutantStream | None: the mutants, yielded as they are created, to close when they are not consumed.
+                None when the mutants are not created in the background, or depend on the detected boxes
+        """
+        if not self.overlap_mutant_creation or self.mutant_creator.uses_boxes:
+            return None
+        if self._mutant_executor is None:
+            self._mutant_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="mutant-creation"
             )
+        stream = MutantStream(self.max_buffered_mutants)
 
-            mappings_for_features: list[tuple[CodeImageMapping, float]] = [
-                (CodeImageMapping(mutant.deleted_spans, box["box_2d"]), mse_value)
-                for mse_value, mutant in sorted_mse_map
-            ]
-
-            feature_map[box["label"]] = mappings_for_features
+        def create():
+            # the mapping may have failed while waiting for the executor
+            if not stream.closed:
+                stream.produce(self.mutant_creator.iter_mutants(code))
 
-            mapped_code = MappedCode(
-                base_image, code, feature_map, self.embedding_model
-            )
-        return mapped_code
+        self._mutant_executor.submit(create)
+        return stream
 
     def __str__(self):
         return (
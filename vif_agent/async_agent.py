@@ -0,0 +1,261 @@
+"""Asynchronous agent, to map many codes concurrently
+
+The LLM requests of all the codes run concurrently on AsyncOpenAI clients, within the limits of their endpoint,
+while the renders, mutant creations and scorings run in threads.
+"""
+
+import asyncio
+import os
+import threading
+import uuid
+from collections.abc import AsyncIterator, Callable, Iterable
+from contextlib import asynccontextmanager
+
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI
+from PIL import Image
+
+from vif_agent.agent import MutantStream, VifAgent
+from vif_agent.feature import MappedCode
+from vif_agent.llm_cache import LLMResponseCache
+from vif_agent.prompt import IT_PROMPT
+from vif_agent.utils import encode_image
+
+
+class EndpointLimiter:
+    """Limits the concurrent requests and the request rate of an endpoint"""
+
+    def __init__(self, max_concurrency: int = 8, requests_per_minute: float = None):
+        """
+        Args:
+            max_concurrency (int, optional): maximum number of requests waiting for a response
+            requests_per_minute (float, optional): maximum number of requests started per minute, unlimited by default
+        """
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._interval = 60 / requests_per_minute if requests_per_minute else 0
+        self._next_start = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._semaphore:
+            if self._interval:
+                # requests are started at regular intervals, in the order they reserve their start
+                now = asyncio.get_running_loop().time()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+                await asyncio.sleep(start - now)
+            yield
+
+
+def create_async_client(
+    api_key: str = None, base_url: str = None, max_connections: int = 64
+) -> AsyncOpenAI:
+    """Creates an AsyncOpenAI client keeping up to max_connections connections to its endpoint alive
+
+    Share the client between the agents using the same endpoint, so that they reuse its connections.
+    """
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(600, connect=10),
+        ),
+    )
+
+
+class AsyncVifAgent(VifAgent):
+    """VifAgent with AsyncOpenAI clients, mapping codes concurrently
+
+    Usage:
+        agent = AsyncVifAgent(renderer, client=create_async_client(...), model="...")
+        async for index, mapped_code in agent.map_codes(codes):
+            ...
+    """
+
+    def __init__(
+        self,
+        code_renderer: Callable[[str], Image.Image],
+        client: AsyncOpenAI,
+        model: str,
+        endpoint_limits: dict[str, EndpointLimiter] = None,
+        max_concurrency: int = 8,
+        requests_per_minute: float = None,
+        max_concurrent_codes: int = 16,
+        **kwargs,
+    ):
+        """
+        Args:
+            code_renderer (Callable[[str], Image.Image]): renderer of the codes, called from several threads
+            client (AsyncOpenAI): client of the customization model, and of the other models by default
+            model (str): customization model
+            endpoint_limits (dict[str, EndpointLimiter], optional): limits of the endpoints, by base url
+            max_concurrency (int, optional): maximum concurrent requests of the endpoints without limits
+            requests_per_minute (float, optional): maximum request rate of the endpoints without limits
+            max_concurrent_codes (int, optional): maximum number of codes mapped at the same time by map_codes
+            **kwargs: other options, see VifAgent. search_client and identification_client must be AsyncOpenAI clients.
+        """
+        super().__init__(
+            code_renderer,
+            client,
+            model,
+            overlap_mutant_creation=False,  # mutants are created in threads of the event loop
+            **kwargs,
+        )
+        self.endpoint_limits = dict(endpoint_limits or {})
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrent_codes = max_concurrent_codes
+
+    async def map_codes(
+        self, codes: Iterable[str]
+    ) -> AsyncIterator[tuple[int, MappedCode | Exception]]:
+        """Identifies the features of many codes concurrently
+
+        Args:
+            codes (Iterable[str]): codes to map, consumed as the mapping goes
+
+        Yields:
+            tuple[int, MappedCode | Exception]: index of the code and its mapped code, or the exception
+                raised while mapping it, in the order the mappings finish
+        """
+        codes = iter(enumerate(codes))
+        running: dict[asyncio.Task, int] = {}
+
+        def start_next() -> bool:
+            next_code = next(codes, None)
+            if next_code is None:
+                return False
+            index, code = next_code
+            running[asyncio.create_task(self.identify_features(code))] = index
+            return True
+
+        while len(running) < self.max_concurrent_codes and start_next():
+            pass
+        try:
+            while running:
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    index = running.pop(task)
+                    if task.exception() is not None:
+                        logger.warning(
+                            f"mapping of code {index} failed: {task.exception()!r}"
+                        )
+                        yield index, task.exception()
+                    else:
+                        yield index, task.result()
+                    start_next()
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def identify_features(self, code: str) -> MappedCode:
+        """DEBUG"""
+        if self.debug and not hasattr(self, "debug_id"):
+            self.debug_id = str(uuid.uuid4())
+            os.mkdir(os.path.join(self.debug_folder, self.debug_id))
+        """"""
+        code = "\n".join(line.strip() for line in code.split("\n"))
+        # the mutants depending on the detected boxes are created with the mapping
+        mutants_stream = None
+        if not self.mutant_creator.uses_boxes:
+            mutants_stream = MutantStream(self.max_buffered_mutants)
+            # in its own thread, blocking while its buffer is full without holding a thread of the event loop executor
+            threading.Thread(
+                target=mutants_stream.produce,
+                args=(self.mutant_creator.iter_mutants(code),),
+                name="mutant-creation",
+                daemon=True,
+            ).start()
+        try:
+            base_image = await asyncio.to_thread(self.code_renderer, code)
+            logger.info("Searching for features")
+            encoded_image = encode_image(image=base_image)
+            response = await self._complete(
+                self.search_client, self._search_request(encoded_image)
+            )
+            features = self._parse_features(response)
+            if features is None:
+                return code, base_image
+            logger.info("Identifying features")
+            response = await self._complete(
+                self.identification_client,
+                self._identification_request(features, encoded_image),
+            )
+            detected_boxes = self._parse_boxes(response, base_image)
+            if detected_boxes is None:
+                return code, base_image
+            mutants = (
+                mutants_stream
+                if mutants_stream is not None
+                else self.mutant_creator.iter_mutants(
+                    code, boxes=[box["box_2d"] for box in detected_boxes]
+                )
+            )
+            return await asyncio.to_thread(
+                self._map_features, code, base_image, detected_boxes, mutants
+            )
+        finally:
+            if mutants_stream is not None:
+                # stops the creation when the mapping failed or was cancelled
+                mutants_stream.close()
+
+    async def apply_instruction(self, code: str, instruction: str) -> str:
+        mapped_code = await self.identify_features(code)
+        annotated_code = (
+            mapped_code.get_commented()
+            if isinstance(mapped_code, MappedCode)
+            else code
+        )
+        base_image = await asyncio.to_thread(self.code_renderer, code)
+
+        if self.clarify_instruction:
+            logger.info("clarifying the instruction")
+            instruction = await self.apply_clarification(instruction, base_image)
+        user_instruction = IT_PROMPT.format(
+            instruction=instruction, content=annotated_code
+        )
+
+        logger.info("applying the instruction")
+        response = await self._complete(
+            self.client, self._generation_request(user_instruction)
+        )
+        return response.choices[-1].message.content
+
+    async def apply_clarification(
+        self, instruction: str, base_image: Image.Image
+    ) -> str:
+        encoded_image = encode_image(image=base_image)
+        response = await self._complete(
+            self.client, self._clarification_request(instruction, encoded_image)
+        )
+        return response.choices[-1].message.content
+
+    async def _complete(self, client: AsyncOpenAI, request: dict):
+        if self.response_cache is not None:
+            key = LLMResponseCache.key(str(client.base_url), request)
+            response = self.response_cache.get(key)
+            if response is not None:
+                logger.info(f"reusing the cached response of {request['model']}")
+                return response
+        async with self._limiter(client).slot():
+            response = await client.chat.completions.create(**request)
+        if self.response_cache is not None:
+            self.response_cache.put(key, response)
+        return response
+
+    def _limiter(self, client: AsyncOpenAI) -> EndpointLimiter:
+        endpoint = str(client.base_url)
+        if endpoint not in self.endpoint_limits:
+            self.endpoint_limits[endpoint] = EndpointLimiter(
+                self.max_concurrency, self.requests_per_minute
+            )
+        return self.endpoint_limits[endpoint]
@@ -0,0 +1,99 @@
+import os
+import threading
+from collections.abc import Callable
+
+TMP_SUFFIX = ".tmp"
+# fraction of the budget left after an eviction, so that the next writes do not scan the directory again
+EVICTION_TARGET = 0.9
+
+
+class DiskLRU:
+    """Directory of cache files, evicted in least recently used order when over a budget of bytes
+
+    Files are written through a temporary file replacing them atomically, and the lru order is their mtime,
+    refreshed with touch when they are read. Once over budget, files are evicted down to EVICTION_TARGET of it.
+    Shared by the render cache and the response cache.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Args:
+            cache_dir (str): directory of the files, created if needed
+            max_bytes (int): budget of the directory, in bytes
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self.disk_bytes = sum(size for _, size, _ in self._scan())
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def write(self, path: str, write_file: Callable[[str], None]):
+        """Writes a file of the cache, evicting the least recently used files if the budget is exceeded
+
+        Args:
+            path (str): path of the file, in the cache directory
+            write_file (Callable[[str], None]): writes the content of the file to the given path
+        """
+        tmp_path = f"{path}.{threading.get_ident()}{TMP_SUFFIX}"
+        write_file(tmp_path)
+        with self._lock:
+            try:
+                replaced_bytes = os.path.getsize(path)
+            except OSError:
+                replaced_bytes = 0
+            os.replace(tmp_path, path)
+            self.disk_bytes += os.path.getsize(path) - replaced_bytes
+            if self.disk_bytes > self.max_bytes:
+                self._evict()
+
+    @staticmethod
+    def touch(path: str):
+        """Marks a file as recently used"""
+        os.utime(path)
+
+    def remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return  # removed concurrently
+        with self._lock:
+            self.disk_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in self._scan():
+                os.path.exists(path) and os.remove(path)
+            self.disk_bytes = 0
+
+    def _scan(self) -> list[tuple[str, int, float]]:
+        """lists the (path, size, mtime) of the cached files, without the files being written"""
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.is_file() and not entry.name.endswith(TMP_SUFFIX):
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+            except OSError:
+                continue  # removed concurrently
+        return files
+
+    def _evict(self):
+        """removes the least recently used files down to EVICTION_TARGET of the budget, caller must hold the lock"""
+        files = sorted(self._scan(), key=lambda file: file[2])
+        self.disk_bytes = sum(size for _, size, _ in files)
+        target_bytes = self.max_bytes * EVICTION_TARGET
+        for path, size, _ in files:
+            if self.disk_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+            self.evictions += 1
@@ -0,0 +1,69 @@
+"""Embedding models shared by the agents and mapped codes of the process
+
+sentence_transformers (and torch) are only imported when a model is first needed.
+"""
+
+from __future__ import annotations
+
+import threading
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+import numpy as np
+from loguru import logger
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+QUERY_CACHE_SIZE = 1024
+
+_models: dict[str, SentenceTransformer] = {}
+_lock = threading.Lock()
+# per model, released with it, so that a model created later at the same address does not get its embeddings
+_query_embeddings: weakref.WeakKeyDictionary[
+    SentenceTransformer, OrderedDict[str, np.ndarray]
+] = weakref.WeakKeyDictionary()
+_query_lock = threading.Lock()
+
+
+def get_embedding_model(name: str = DEFAULT_EMBEDDING_MODEL) -> SentenceTransformer:
+    """Gets the embedding model of the given name, loaded once per process"""
+    with _lock:
+        if name not in _models:
+            from sentence_transformers import SentenceTransformer
+
+            logger.info(f"loading the embedding model {name}")
+            _models[name] = SentenceTransformer(name)
+        return _models[name]
+
+
+def normalize_embeddings(embeddings) -> np.ndarray:
+    """Converts embeddings to float32 arrays of unit norm, so that their dot product is their cosine similarity"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def query_embedding(model: SentenceTransformer, query: str) -> np.ndarray:
+    """Gets the normalized embedding of a query, the last QUERY_CACHE_SIZE queries of each model are kept in memory"""
+    with _query_lock:
+        try:
+            embeddings = _query_embeddings.setdefault(model, OrderedDict())
+        except TypeError:
+            embeddings = None  # model without weak references, not cached
+        embedding = embeddings.get(query) if embeddings is not None else None
+        if embedding is not None:
+            embeddings.move_to_end(query)
+            return embedding
+
+    embedding = normalize_embeddings(model.encode(query))
+    embedding.flags.writeable = False
+    if embeddings is not None:
+        with _query_lock:
+            embeddings[query] = embedding
+            while len(embeddings) > QUERY_CACHE_SIZE:
+                embeddings.popitem(last=False)
+    return embedding
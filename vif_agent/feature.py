@@ -1,8 +1,21 @@
+from __future__ import annotations
+
+import io
+from collections import defaultdict
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, TextIO
+
+import numpy as np
 from PIL import Image
 
-from sentence_transformers import SentenceTransformer
-import torch
+from vif_agent.embedding import (
+    get_embedding_model,
+    normalize_embeddings,
+    query_embedding,
+)
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 type Box2D = tuple[float, float, float, float]
 type Span = tuple[int, int]
@@ -23,81 +36,137 @@ class MappedCode:
         code: str,
         feature_map: dict[str, list[tuple[CodeImageMapping, float]]],
         embedding_model: SentenceTransformer,
+        embedding_model_name: str = None,
     ):
+        """
+        Args:
+            embedding_model_name (str, optional): name of the embedding model, see get_embedding_model.
+                When given, the model is not pickled with the mapped code but loaded again by name.
+        """
         self.image = image
         self.code = code
         self.feature_map = feature_map
         self.embedding_model = embedding_model
+        self.embedding_model_name = embedding_model_name
 
         self.key_embeddings = embedding_model.encode(list(self.feature_map.keys()))
+        self._build_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get("embedding_model_name") is not None:
+            state["embedding_model"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.embedding_model is None:
+            self.embedding_model = get_embedding_model(self.embedding_model_name)
 
     def get_commented(self, comment_character: str = "%") -> str:
-        char_id_feature: dict = (
-            {}
-        )  # mapping between the character index and the detected feature
+        """Annotates the code with the detected features, see write_commented"""
+        annotated_code = io.StringIO()
+        self.write_commented(annotated_code, comment_character)
+        return annotated_code.getvalue()
+
+    def write_commented(self, output: TextIO, comment_character: str = "%"):
+        """Writes the code annotated with the detected features
+
+        Before the first deleted span of each mapping, a comment line names its most probable feature,
+        unless the mappings at this position cover all the features.
 
+        Args:
+            output (TextIO): stream the annotated code is written to, e.g. an opened file
+            comment_character (str, optional): the character used to comment the code
+        """
+        labels_at: dict[int, list[tuple[str, float]]] = defaultdict(list)
         for feature_name, prob_mappings in self.feature_map.items():
             for mapping, prob in prob_mappings:
-                features_for_char: list = char_id_feature.get(
-                    mapping.spans[0][0], []
-                )  # getting the first start char nb of the first tuple
-                features_for_char.append((feature_name, prob))
-                char_id_feature[mapping.spans[0][0]] = sorted(
-                    features_for_char, key=lambda x: x[1], reverse=True
-                )  # order the labels by the mse
-
-        annotated_code = self.code
-        # Annotate the code
-        for characted_index, labels in sorted(char_id_feature.items(), reverse=True):
-            labels = [label[0] for label in labels]  # removing the mse
+                # getting the first start char nb of the first tuple
+                labels_at[mapping.spans[0][0]].append((feature_name, prob))
+
+        code_length = len(self.code)
+        insertions: list[tuple[int, int, str]] = []
+        for characted_index, labels in labels_at.items():
             if len(labels) == len(
                 self.feature_map
             ):  # all features have been detected for the modifications of this mutant, skipping
                 continue
-            selected_features = labels[0]  #
-            annotated_code = (
-                annotated_code[:characted_index]
-                + comment_character
-                + selected_features
-                + "\n"
-                + annotated_code[characted_index:]
-            )
-        return annotated_code
-
-    def get_cimappings(self, feature: str) -> list[tuple[CodeImageMapping, float]]:
+            # first label of highest mse, the labels are in feature order
+            selected_feature = max(labels, key=lambda label: label[1])[0]
+            position = slice(characted_index, None).indices(code_length)[0]
+            insertions.append((position, characted_index, selected_feature))
+        insertions.sort()
+
+        # Annotate the code in one pass
+        position = 0
+        for insertion_position, _, selected_feature in insertions:
+            output.write(self.code[position:insertion_position])
+            output.write(comment_character + selected_feature + "\n")
+            position = insertion_position
+        output.write(self.code[position:])
+
+    def get_cimappings(
+        self, feature: str, top_k: int = None, threshold: float = None
+    ) -> list[tuple[CodeImageMapping, float]]:
         """Gets a CodeImageMapping(parts of the code and the associated part of the image)
         from a string, i.e. given a string, computes which feature_names are the most similar,
         and return a list of the most probable CodeImageMapping
 
+        The probability of each mapping is weighted by the cosine similarity of its feature name with the string,
+        min-max normalized over the feature names and raised to the power 10.
+
         Args:
             feature (str): Any string
+            top_k (int, optional): maximum number of returned mappings, all of them by default
+            threshold (float, optional): minimum weighted probability of the returned mappings
 
         Returns:
             list[tuple[CodeImageMapping, float]]: Most probable part of the code/Image that the feature is in
         """
-        asked_feature_embedding = self.embedding_model.encode(feature)
-        similarities: torch.Tensor = self.embedding_model.similarity(
-            self.key_embeddings, asked_feature_embedding
+        if not hasattr(self, "_mapping_probs"):
+            self._build_index()  # mapped code pickled before the index existed
+        if len(self._mappings) == 0:
+            return []
+
+        similarities = self._normalized_keys @ query_embedding(
+            self.embedding_model, feature
         )
         # normalize similarities
         min_sim = similarities.min()
         max_sim = similarities.max()
         similarities = (similarities - min_sim) / (max_sim - min_sim + 1e-8)
+        scores = self._mapping_probs * similarities[self._mapping_features] ** 10
 
-        adjusted_map:dict[str, list[tuple[CodeImageMapping, float]]] = {}
-
-        for (feature_name, prob_mappings), similarity in zip(
-            self.feature_map.items(), similarities
-        ):
-            adjusted_mappings = []
+        selected = (
+            np.arange(len(scores))
+            if threshold is None
+            else np.flatnonzero(scores >= threshold)
+        )
+        if top_k is not None and top_k < len(selected):
+            selected_scores = scores[selected]
+            cutoff = np.partition(selected_scores, len(selected) - top_k)[
+                len(selected) - top_k
+            ]
+            # the ties at the cutoff are taken in feature order, as in the full sort
+            ties = selected[selected_scores == cutoff]
+            above = selected[selected_scores > cutoff]
+            selected = np.sort(np.concatenate([above, ties[: top_k - len(above)]]))
+        ordered = selected[np.argsort(-scores[selected], kind="stable")]
+        return [(self._mappings[index], float(scores[index])) for index in ordered]
+
+    def _build_index(self):
+        """flattens the feature map into arrays of mapping probabilities and feature ids"""
+        self._normalized_keys = normalize_embeddings(self.key_embeddings).reshape(
+            len(self.feature_map), -1
+        )
+        self._mappings: list[CodeImageMapping] = []
+        probs = []
+        features = []
+        for feature_id, prob_mappings in enumerate(self.feature_map.values()):
             for mapping, prob in prob_mappings:
-                adjusted_mappings.append([mapping,prob*(similarity**10)])
-                
-            adjusted_map[feature_name] = adjusted_mappings
-
-        all_mappings: list[tuple[CodeImageMapping, float]] = []
-        
-        for prob_map in adjusted_map.values():
-            all_mappings = all_mappings +  prob_map
-
-        return sorted(all_mappings, key=lambda x: x[1], reverse=True)
+                self._mappings.append(mapping)
+                probs.append(float(prob))
+                features.append(feature_id)
+        self._mapping_probs = np.array(probs, dtype=np.float64)
+        self._mapping_features = np.array(features, dtype=np.intp)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from loguru import logger
+
+from vif_agent.disk_cache import DiskLRU
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletion
+
+
+class LLMResponseCache:
+    """On-disk cache of chat completion responses
+
+    Entries are keyed on the endpoint, the model, the temperature and the messages of the request,
+    with the images of the messages replaced by their hash. Entries older than the ttl are ignored,
+    and when the disk budget is exceeded the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        ttl: float = 30 * 24 * 3600,
+        max_bytes: int = 256 * 1024**2,
+    ):
+        """
+        Args:
+            cache_dir (str, optional): directory of the cache, defaults to ~/.cache/varbench/llm_cache
+            ttl (float, optional): time during which a response is reused, in seconds. None to reuse responses forever.
+            max_bytes (int, optional): budget of the cache, in bytes
+        """
+        self.cache_dir = cache_dir or os.path.join(
+            os.environ.get("HOME"), ".cache/varbench", "llm_cache"
+        )
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._disk = DiskLRU(self.cache_dir, max_bytes)
+
+    @property
+    def evictions(self) -> int:
+        return self._disk.evictions
+
+    @staticmethod
+    def key(endpoint: str, request: dict) -> str:
+        """Computes the cache key of a chat completion request sent to an endpoint
+
+        Args:
+            endpoint (str): base url of the client
+            request (dict): arguments of chat.completions.create
+
+        Returns:
+            str: the key
+        """
+        settings = {
+            "endpoint": endpoint,
+            "model": request.get("model"),
+            "temperature": request.get("temperature"),
+            "messages": [_hash_images(message) for message in request["messages"]],
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> ChatCompletion | None:
+        """Gets a cached response, None if the key is not cached or has expired"""
+        from openai.types.chat import ChatCompletion  # openai is slow to import
+
+        path = self._path(key)
+        try:
+            with open(path) as entry_file:
+                entry = json.load(entry_file)
+            if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+                self._disk.remove(path)
+                response = None
+            else:
+                response = ChatCompletion.model_validate(entry["response"])
+                self._disk.touch(path)
+        except FileNotFoundError:
+            response = None
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug(f"unreadable llm cache entry {key}: {e!r}")
+            response = None
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, key: str, response: ChatCompletion):
+        """Stores a response in the cache"""
+        entry = {"created": time.time(), "response": response.model_dump(mode="json")}
+
+        def write_entry(tmp_path: str):
+            with open(tmp_path, "w") as entry_file:
+                json.dump(entry, entry_file)
+
+        self._disk.write(self._path(key), write_entry)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_bytes": self._disk.disk_bytes,
+        }
+
+    def clear(self):
+        self._disk.clear()
+
+    def _path(self, key: str) -> str:
+        return self._disk.path(f"{key}.json")
+
+
+def _hash_images(value):
+    """replaces the image urls of a message by the hash of the image"""
+    if isinstance(value, dict):
+        if value.get("type") == "image_url":
+            url = value["image_url"]["url"]
+            return {
+                "type": "image_url",
+                "image_sha256": hashlib.sha256(url.encode()).hexdigest(),
+            }
+        return {key: _hash_images(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_hash_images(item) for item in value]
+    return value
@@ -13,3 +13,67 @@ class TexMutant:
 
     def removed_char_nb(self):
         return sum([sp[1] - sp[0] for sp in self.deleted_spans])
+
+
+class CompactTexMutant:
+    """Mutant storing its deleted spans and a reference to the original code, shared by all the mutants of a code
+
+    The mutated code is built each time it is accessed, so that the memory of a set of candidate mutants
+    scales with their number of spans instead of their number times the length of the code.
+    """
+
+    __slots__ = (
+        "char_mutant",
+        "original_code",
+        "deleted_spans",
+        "equivalent_spans",
+        "image",
+        "original_image",
+        "changed_region",
+        "_removed_spans",
+    )
+
+    def __init__(
+        self,
+        char_mutant: int,
+        original_code: str,
+        deleted_spans: list[tuple[int, int]],
+        removed_spans: list[tuple[int, int]] = None,
+    ):
+        """
+        Args:
+            char_mutant (int): index of the character identifying the mutant
+            original_code (str): code the mutant is created from
+            deleted_spans (list[tuple[int, int]]): spans of the original code mapped to the mutant
+            removed_spans (list[tuple[int, int]], optional): spans removed from the original code to build the mutated code,
+                defaults to the deleted spans.
+        """
+        self.char_mutant = char_mutant
+        self.original_code = original_code
+        self.deleted_spans = deleted_spans
+        # deleted spans of the equivalent mutants collapsed into this one, one list per mutant
+        self.equivalent_spans: list[list[tuple[int, int]]] = []
+        self.image: Image.Image = None
+        # image of the original code the changed region is computed against, shared by the mutants of a code
+        self.original_image: Image.Image = None
+        self.changed_region: tuple[int, int, int, int] = None
+        self._removed_spans = (
+            removed_spans if removed_spans is not None else list(deleted_spans)
+        )
+
+    @property
+    def code(self) -> str:
+        chunks = []
+        position = 0
+        for start, end in sorted(self._removed_spans):
+            if start > position:
+                chunks.append(self.original_code[position:start])
+            position = max(position, end)
+        chunks.append(self.original_code[position:])
+        return "".join(chunks)
+
+    def removed_char_nb(self):
+        return sum([sp[1] - sp[0] for sp in self.deleted_spans])
+
+    def __repr__(self):
+        return f"CompactTexMutant(char_mutant={self.char_mutant}, deleted_spans={self.deleted_spans})"
@@ -1,314 +1,677 @@
+import bisect
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+import math
+import os
+import threading
+import time
+import weakref
 from PIL import Image
 from loguru import logger
-from vif_agent.mutation.mutant import TexMutant
+from vif_agent.mutation.mutant import CompactTexMutant
+from vif_agent.mutation.tikz_index import (
+    DEFINITION_PATTERNS,
+    PATH_COMMANDS,
+    TikzIndex,
+)
 from vif_agent.renderer.tex_renderer import TexRenderer, TexRendererException
+from vif_agent.feature import Box2D
+from vif_agent.scoring import changed_region, image_fingerprint, intersection
+import numpy as np
 import re
 
+# deleted code defining state that outlives the group of a batch page: pgf node/coordinate names, counters, \gdef...
+BATCH_UNSAFE_PATTERN = re.compile(
+    r"\b(?:node|coordinate|pic)\b|\bname\s*="
+    r"|\\(?:gdef|xdef|global|setcounter|addtocounter|stepcounter|refstepcounter|newcounter)\b"
+)
+
 
 class TexMutantCreator:
-    def __init__(self):
-        self.renderer = TexRenderer()
+    uses_boxes = False  # whether the created mutants depend on the boxes of the detected features
 
-    def create_mutants(self, code: str) -> list[TexMutant]:
+    def __init__(
+        self,
+        workers: int = None,
+        renderer: TexRenderer = None,
+        batch_size: int = 1,
+        max_count: int = None,
+        max_render_time: float = None,
+        max_image_bytes: int = None,
+        deduplicate: bool = True,
+        perceptual_deduplication: bool = False,
+        screening_renderer: TexRenderer = None,
+    ):
+        """
+        Args:
+            workers (int, optional): number of concurrent renders, defaults to the number of cores. Set to 1 to render serially.
+                The limit is shared by the mutant creations running at the same time, e.g. for the codes of an AsyncVifAgent.
+            renderer (TexRenderer, optional): renderer of the mutants, defaults to TexRenderer(). It also renders the original code
+                the mutants are compared to, it should render it like the renderer of the agent, e.g. use
+                TexRenderer(preamble_format=True) for both to compile against a format dumped from the preamble.
+            batch_size (int, optional): maximum number of mutants compiled as the pages of a single document, 1 (default)
+                compiles each mutant on its own. Global definitions, e.g. the names of the nodes, persist across the pages,
+                the mutants deleting one, see BATCH_UNSAFE_PATTERN, are always compiled on their own.
+            max_count (int, optional): default maximum number of created mutants, unlimited by default. See iter_mutants.
+            max_render_time (float, optional): default budget of render time of the mutants, in seconds, unlimited by default.
+            max_image_bytes (int, optional): default budget of memory of the mutant images, in bytes, unlimited by default.
+            deduplicate (bool, optional): collapses the mutants rendering the same image into the first of them,
+                which keeps the deleted spans of the others in its equivalent_spans.
+            perceptual_deduplication (bool, optional): also collapses the mutants changing the same region of the image
+                with the same perceptual hash, e.g. differing only by antialiasing. See image_fingerprint.
+            screening_renderer (TexRenderer, optional): low resolution renderer screening the candidates, e.g.
+                TexRenderer(dpi=50). Only the candidates whose screening image changes (inside a detected box when
+                the boxes are given) are rendered by the renderer. Screening is lossy, see _screen. It renders in color,
+                a grayscale screening renderer is refused. No screening by default.
+        """
+        self.renderer = renderer or TexRenderer()
+        self.workers = workers or os.cpu_count() or 1
+        self._render_slots = threading.BoundedSemaphore(self.workers)
+        self.batch_size = batch_size
+        self.max_count = max_count
+        self.max_render_time = max_render_time
+        self.max_image_bytes = max_image_bytes
+        self.deduplicate = deduplicate
+        self.perceptual_deduplication = perceptual_deduplication
+        if getattr(screening_renderer, "grayscale", False):
+            raise ValueError(
+                "grayscale screening misses the deletions revealing a color of the same luminance"
+            )
+        self.screening_renderer = screening_renderer
+        # screening images of the original codes and their compilation times,
+        # by id of their full resolution image while it is alive
+        self._screening_originals: dict[int, tuple[Image.Image, float | None]] = {}
+        self._screening_lock = threading.Lock()
+        # compilation times of the original codes, baselines of the timeouts of their mutants, by id of their image
+        self._baselines: dict[int, float] = {}
+
+    def create_mutants(self, code: str) -> list[CompactTexMutant]:
         """creates mutants based on a latex code
 
         Args:
             code (str): input latex code
 
         Returns:
-            list[tuple[str, Image.Image, int, int]]: list of created mutants, with the image generated from it, the start of the match where the mutant has been deleted and the length of the deleted sequence.
+            list[CompactTexMutant]: list of created mutants, with the image generated from it and the span deleted from the code.
         """
-        pass
+        return list(self.iter_mutants(code))
 
+    def iter_mutants(
+        self,
+        code: str,
+        max_count: int = None,
+        max_render_time: float = None,
+        max_image_bytes: int = None,
+        boxes: list[Box2D] = None,
+    ) -> Iterator[CompactTexMutant]:
+        """creates mutants based on a latex code, lazily and in priority order
 
-class TexMappingMutantCreator(TexMutantCreator):
-
-    def __init__(self):
+        The candidates are rendered as the mutants are consumed, a few batches ahead, and the creation stops
+        as soon as one of the budgets is exhausted. Closing the iterator stops the creation as well.
 
-        self.definitions = [
-            r"\\coordinate(?:[\[[a-zA-Z0-9]+\])?\s\(([a-zA-Z0-9]+)\)",
-            r"\\node(?:[\[[a-zA-Z0-9]+\])?\s\(([[a-zA-Z0-9]+)\)",
-        ]
-        self.commands = [
-            r"\\fill",
-            r"\\draw",
-            r"\\filldraw",
-            r"\\shade",
-            r"\\shadedraw",
-        ]
+        When deduplicating, a mutant equivalent to an already yielded one is not yielded, its deleted spans are appended
+        to the equivalent_spans of the yielded mutant instead.
 
-        super().__init__()
+        Args:
+            code (str): input latex code
+            max_count (int, optional): maximum number of yielded mutants, defaults to self.max_count
+            max_render_time (float, optional): time after which no more candidate is rendered, in seconds,
+                defaults to self.max_render_time
+            max_image_bytes (int, optional): maximum size of the images of the yielded mutants, in bytes,
+                defaults to self.max_image_bytes
+            boxes (list[Box2D], optional): (left, upper, right, lower) boxes of the detected features,
+                used by the creators with uses_boxes set to restrict the search to the mutants changing them
+
+        Yields:
+            CompactTexMutant: valid mutants, with their image and changed region set
+        """
+        max_count = max_count if max_count is not None else self.max_count
+        max_render_time = (
+            max_render_time if max_render_time is not None else self.max_render_time
+        )
+        max_image_bytes = (
+            max_image_bytes if max_image_bytes is not None else self.max_image_bytes
+        )
 
-    def create_mutants(self, code) -> list[TexMutant]:
         code = "\n".join(line.strip() for line in code.split("\n"))
-        original_image = self.renderer.from_string_to_image(code)
+        start_time = time.monotonic()
+        original_image = self._render_original(code)
+        deadline = None if max_render_time is None else start_time + max_render_time
+
+        count = 0
+        image_bytes = 0
+        rendered_char_mutants: set[int] = set()
+        # equivalent spans of the yielded mutants by image fingerprint, the images are not kept
+        equivalent_spans: dict[bytes, list[list[tuple[int, int]]]] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for mutant in self._iter_valid_mutants(
+                code, original_image, executor, deadline, rendered_char_mutants, boxes
+            ):
+                if self.deduplicate:
+                    fingerprint = image_fingerprint(
+                        mutant.image,
+                        mutant.changed_region,
+                        self.perceptual_deduplication,
+                    )
+                    spans = equivalent_spans.get(fingerprint)
+                    if spans is not None:
+                        spans.append(mutant.deleted_spans)
+                        rendered_char_mutants.add(mutant.char_mutant)
+                        continue
+                    equivalent_spans[fingerprint] = mutant.equivalent_spans
+                if max_count is not None and count >= max_count:
+                    logger.info(f"mutant count budget of {max_count} reached")
+                    return
+                mutant_bytes = _image_bytes(mutant.image)
+                if (
+                    max_image_bytes is not None
+                    and image_bytes + mutant_bytes > max_image_bytes
+                ):
+                    logger.info(
+                        f"mutant memory budget of {max_image_bytes} bytes reached"
+                    )
+                    return
+                count += 1
+                image_bytes += mutant_bytes
+                rendered_char_mutants.add(mutant.char_mutant)
+                yield mutant
 
-        all_possible_mutants: list[list[tuple[int, int]]] = []
+    def _iter_valid_mutants(
+        self,
+        code: str,
+        original_image: Image.Image,
+        executor: ThreadPoolExecutor,
+        deadline: float,
+        rendered_char_mutants: set[int],
+        boxes: list[Box2D] = None,
+    ) -> Iterator[CompactTexMutant]:
+        """renders the candidate stages of the code and yields the valid mutants, see _candidate_stages
 
-        # get definitions
-        ex_definitions: list[re.Match] = []
-        for definition in self.definitions:
-            ex_definitions += list(re.finditer(definition, code))
+        Args:
+            code (str): normalized latex code
+            original_image (Image.Image): image of the code
+            executor (ThreadPoolExecutor): executor rendering the candidates
+            deadline (float): time.monotonic() after which no more candidate is rendered, None for no deadline
+            rendered_char_mutants (set[int]): char_mutant of the valid mutants yielded so far, updated by the caller
+            boxes (list[Box2D], optional): boxes of the detected features, unused by default
+
+        Yields:
+            CompactTexMutant: valid mutants, with their image and changed region set
+        """
+        for candidates in self._candidate_stages(code, rendered_char_mutants):
+            yield from self._iter_rendered(
+                candidates, original_image, executor, deadline, boxes
+            )
+            if _past(deadline):
+                logger.info("mutant render time budget reached")
+                return
 
-        # get all commands
-        ex_commands: list[re.Match] = []
-        for command in self.commands:
-            ex_commands += list(re.finditer(command, code))
+    def _candidate_stages(
+        self, code: str, rendered_char_mutants: set[int]
+    ) -> Iterator[list[CompactTexMutant]]:
+        """generates the candidate mutants of the code, in priority order
 
-        # find commands using definitions
-        for match in ex_definitions:
-            cur_defined_variable: str = match.group(1)
-            commands_using_variable: list[re.Match] = []
-            for command in ex_commands:
-                after_command_str = code[command.start() :]
-                full_command = code[
-                    command.start() : command.start() + after_command_str.find(";")
-                ]
-                cur_coordinates = [
-                    r.split(".")[0] for r in re.findall(r"\((.*?)\)", full_command)
-                ]
-                if cur_defined_variable in cur_coordinates:
-                    commands_using_variable.append(command)
-            all_possible_mutants.append(
-                [(v.span()) for v in [match] + commands_using_variable]
-            )
+        The candidates are grouped in stages, a stage is only generated once the previous ones are rendered,
+        so that it can depend on their valid mutants.
 
-        # find standalone commands
-        for command in ex_commands:
-            after_command_str = code[command.start() :]
-            all_possible_mutants.append(
-                [(command.start(), command.start() + after_command_str.find(";"))]
-            )
+        Args:
+            code (str): normalized latex code
+            rendered_char_mutants (set[int]): char_mutant of the valid mutants rendered so far, updated during the iteration
 
-        # Find scopes
-        all_possible_mutants += self._find_scopes(code)
+        Yields:
+            list[CompactTexMutant]: candidate mutants, without image
+        """
+        yield from ()
 
-        # find valid mutants among all of them
-        valid_mutants: list[TexMutant] = []
+    def _iter_rendered(
+        self,
+        mutants: list[CompactTexMutant],
+        original_image: Image.Image,
+        executor: ThreadPoolExecutor,
+        deadline: float = None,
+        boxes: list[Box2D] = None,
+    ) -> Iterator[CompactTexMutant]:
+        """renders the candidate mutants and yields the valid ones, in the order of the candidates
 
-        for mutant in all_possible_mutants:
-            possible_code_mutant, char_mutant = TexMappingMutantCreator._create_mutant(
-                mutant, code
+        A candidate is invalid when it does not compile or when its image does not have the size of the original image.
+        With a screening renderer, the candidates rejected by _screen are not rendered at full resolution.
+        Candidates are rendered in batches of up to `self.batch_size` mutants, at most `self.workers` batches at once,
+        a batch is only submitted when the results of the batches before the last `self.workers` ones are consumed.
+
+        Args:
+            mutants (list[CompactTexMutant]): candidate mutants, without image
+            original_image (Image.Image): image of the original code
+            executor (ThreadPoolExecutor): executor rendering the batches
+            deadline (float, optional): time.monotonic() after which no more batch is submitted
+            boxes (list[Box2D], optional): boxes of the detected features, restricting the screened candidates
+
+        Yields:
+            CompactTexMutant: valid mutants, with their image and changed region set
+        """
+        original_array = np.asarray(original_image)
+
+        def render(batch: list[CompactTexMutant]) -> list[CompactTexMutant]:
+            if self.screening_renderer is not None:
+                batch = self._screen(batch, original_image, boxes)
+                if not batch:
+                    return []
+            images = self._render_codes(
+                self.renderer, batch, self._baselines.get(id(original_image))
             )
-            try:
-                image = self.renderer.from_string_to_image(possible_code_mutant)
+            valid_batch = []
+            for mutant, image in zip(batch, images):
+                if isinstance(image, TexRendererException):
+                    logger.info("non valid mutant, skipping")
+                    continue
                 if (
                     image.width != original_image.width
                     or image.height != original_image.height
                 ):
                     # if the new image has a different size the mutant gets ignored for now
                     continue
-                valid_mutants.append(
-                    TexMutant(char_mutant, possible_code_mutant, image, code, mutant)
-                )
-            except TexRendererException as e:
-                logger.info("non valid mutant, skipping")
-                continue
+                mutant.image = image
+                mutant.original_image = original_image
+                mutant.changed_region = changed_region(original_array, image)
+                valid_batch.append(mutant)
+            return valid_batch
+
+        # keeping every worker busy when there are few mutants
+        batch_size = max(
+            1, min(self.batch_size, math.ceil(len(mutants) / self.workers))
+        )
+        batches = (
+            mutants[i : i + batch_size] for i in range(0, len(mutants), batch_size)
+        )
+        pending: deque[Future] = deque()
+        try:
+            for batch in batches:
+                if _past(deadline):
+                    break
+                pending.append(executor.submit(render, batch))
+                if len(pending) > self.workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _screen(
+        self,
+        mutants: list[CompactTexMutant],
+        original_image: Image.Image,
+        boxes: list[Box2D] = None,
+    ) -> list[CompactTexMutant]:
+        """renders the candidates with the screening renderer and keeps the ones worth a full resolution render
+
+        A candidate is kept when its screening image renders, has the size of the screening image of the original code,
+        and differs from it; inside one of the boxes when they are given, with a margin of one screening pixel.
+        The candidates not kept that render get the empty changed region, without image.
 
-        valid_mutants = valid_mutants + self._find_remaining_mutants(
-            valid_mutants, code, original_image
+        Screening is lossy: a change covering less than about one screening pixel can vanish in the antialiasing
+        of the screening image, the candidate is then dropped (and a group of TexBisectionMutantCreator is not split)
+        although it would score at full resolution. The finer the screening renderer, the fewer such candidates.
+
+        Args:
+            mutants (list[CompactTexMutant]): candidate mutants, without image
+            original_image (Image.Image): full resolution image of the original code
+            boxes (list[Box2D], optional): boxes of the detected features, in full resolution pixels
+
+        Returns:
+            list[CompactTexMutant]: the kept candidates, in order
+        """
+        screening_original, screening_baseline = self._screening_original(
+            mutants[0].original_code, original_image
         )
-        return valid_mutants
-
-    #Probaly optimizable, but not a bottleneck
-    def _find_scopes(self, code: str) -> list[list[tuple[int, int]]]:
-
-        possible_scope_mutant: list[list[tuple[int, int]]] = []
-
-        scope_stack = []
-        index_scoped = code.find(r"\scoped{")
-        index_scope = code.find(r"\begin{scope}")
-        if index_scope == -1 and index_scoped == -1:
-            return []
-        i = min(index_scope, index_scoped)
-
-        while i < len(code):
-            current_code = code[i:]
-            if current_code.startswith(r"\scoped{"):
-                scope_stack.append(("scoped", i))
-                i += 8
-                continue
-            if current_code.startswith(r"\begin{scope}"):
-                scope_stack.append(("begin_scope", i))
-                i += 13
-                continue
-            if current_code.startswith("{"):
-                scope_stack.append(("ignored", i))
-                i += 1
-                continue
-            if len(scope_stack) > 0:
-                if current_code.startswith(r"}"):
-                    entering_scope = scope_stack.pop()
-                    i += 1
-                    if entering_scope[0] != "ignored":
-                        possible_scope_mutant.append([(entering_scope[1], i)])
-                    continue
-                if current_code.startswith(r"\end{scope}"):
-                    entering_scope = scope_stack.pop()
-                    i += 11
-                    possible_scope_mutant.append([(entering_scope[1], i)])
+        screening_array = np.asarray(screening_original)
+        scale_x = original_image.width / screening_original.width
+        scale_y = original_image.height / screening_original.height
+        images = self._render_codes(
+            self.screening_renderer, mutants, screening_baseline
+        )
+        kept = []
+        for mutant, image in zip(mutants, images):
+            if (
+                isinstance(image, TexRendererException)
+                or image.size != screening_original.size
+            ):
+                continue  # does not render at any resolution
+            left, upper, right, lower = changed_region(screening_array, image)
+            if left < right and upper < lower:
+                region = (
+                    math.floor((left - 1) * scale_x),
+                    math.floor((upper - 1) * scale_y),
+                    math.ceil((right + 1) * scale_x),
+                    math.ceil((lower + 1) * scale_y),
+                )
+                if boxes is None or any(intersection(region, box) for box in boxes):
+                    kept.append(mutant)
                     continue
-            i += 1
-        return possible_scope_mutant
+            mutant.changed_region = 0, 0, 0, 0  # renders, without changing the boxes
+        logger.debug(f"screening kept {len(kept)} of {len(mutants)} candidates")
+        return kept
 
-    def _find_remaining_mutants(
+    def _render_codes(
         self,
-        current_valid_mutants: list[TexMutant],
-        code: str,
-        original_image: Image.Image,
-    ):
-        """uses a more basic tikz mutant search to find possible remaining mutants
+        renderer: TexRenderer,
+        mutants: list[CompactTexMutant],
+        baseline: float = None,
+    ) -> list[Image.Image | TexRendererException]:
+        """renders the codes of the mutants as one batch, except the ones deleting a global definition
+
+        A page of a batch sees the global definitions of the pages before it, a mutant deleting the definition
+        of a node still used would compile against the definition of a previous page instead of failing.
+        At most `self.workers` calls render at once, across the mutant creations of the creator.
+        The baseline, compilation time of the original code of the mutants, bounds their timeouts, see render_original.
+        The renderers with render_original also get the original code, compiling the mutants like it, see uses_dvi.
+        """
+        kwargs = (
+            {"baseline": baseline, "original_code": mutants[0].original_code}
+            if hasattr(renderer, "render_original")
+            else {}
+        )
+        alone = [
+            any(
+                BATCH_UNSAFE_PATTERN.search(mutant.original_code, start, end)
+                for start, end in mutant.deleted_spans
+            )
+            for mutant in mutants
+        ]
+        batched_codes = [
+            mutant.code for mutant, unsafe in zip(mutants, alone) if not unsafe
+        ]
+        with self._render_slots:
+            batched = iter(
+                renderer.from_strings_to_images(batched_codes, **kwargs)
+                if batched_codes
+                else []
+            )
+            return [
+                (
+                    renderer.from_strings_to_images([mutant.code], **kwargs)[0]
+                    if unsafe
+                    else next(batched)
+                )
+                for mutant, unsafe in zip(mutants, alone)
+            ]
+
+    def _render_original(self, code: str) -> Image.Image:
+        """renders the original code, keeping its compilation time as the baseline of the timeouts of its mutants"""
+        original_image, baseline = _render_original(self.renderer, code)
+        if baseline is not None:
+            key = id(original_image)
+            self._baselines[key] = baseline
+            weakref.finalize(original_image, self._baselines.pop, key, None)
+        return original_image
+
+    def _screening_original(
+        self, code: str, original_image: Image.Image
+    ) -> tuple[Image.Image, float | None]:
+        """screening image of the original code and its compilation time, rendered once per original image"""
+        key = id(original_image)
+        with self._screening_lock:
+            screening_original = self._screening_originals.get(key)
+        if screening_original is None:
+            screening_original = _render_original(self.screening_renderer, code)
+            with self._screening_lock:
+                if key not in self._screening_originals:
+                    self._screening_originals[key] = screening_original
+                    weakref.finalize(
+                        original_image, self._screening_originals.pop, key, None
+                    )
+        return screening_original
+
+    def _render_mutants(
+        self, mutants: list[CompactTexMutant], original_image: Image.Image
+    ) -> list[CompactTexMutant]:
+        """renders the candidate mutants and keeps the valid ones, see _iter_rendered
 
         Args:
-            current_valid_mutant (list[Mutant]): already found mutants
-            code (str): original code
+            mutants (list[CompactTexMutant]): candidate mutants, without image
+            original_image (Image.Image): image of the original code
 
         Returns:
-            list[Mutant]: list of new mutants not considered originally
+            list[CompactTexMutant]: valid mutants, with their image and changed region set
         """
-        # finding all commands
-        all_command_spans: list[tuple[int, int]] = []
-        for m in re.finditer(";", code):
-            end = m.start()
-            start = code.rfind("\n\\", 0, end)
-            if "clip" in code[start : (start + 6)]:
-                continue  # skip clip statement
-            all_command_spans.append((start + 1, end))
-
-        # removing the ones already pointed to in the current valid mutnats
-        covered_char_nb = [mutant.char_mutant for mutant in current_valid_mutants]
-        all_command_mutants = [
-            TexMutant(span[0], (code[: span[0]] + code[span[1] :]), None, code, [span])
-            for span in all_command_spans
-            if span[0] not in covered_char_nb and span[0] != -1
-        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(self._iter_rendered(mutants, original_image, executor))
 
-        command_valid_mutants = []
-        for cmd_mutant in all_command_mutants:
-            try:
-                image = self.renderer.from_string_to_image(cmd_mutant.code)
-                if (
-                    image.width != original_image.width
-                    or image.height != original_image.height
+
+class TexBisectionMutantCreator(TexMutantCreator):
+    """Statement mutant creator searching the statements changing the detected features by group deletion
+
+    Groups of statements are deleted and rendered together, a group is split in two only when deleting it
+    changes pixels inside a detected box (or anywhere without boxes), or when it does not render.
+    The statements changing the boxes are found with about k*log(n) renders for k such statements among n,
+    instead of n renders. The search is approximate: when statements occlude each other, e.g. a white fill
+    over a path or a \\clip, deleting a whole group can leave the image unchanged while deleting one of its
+    statements does not, and the mutants of that group are missed. TexRegMutantCreator renders every statement.
+    """
+
+    uses_boxes = True
+
+    def _iter_valid_mutants(
+        self,
+        code: str,
+        original_image: Image.Image,
+        executor: ThreadPoolExecutor,
+        deadline: float,
+        rendered_char_mutants: set[int],
+        boxes: list[Box2D] = None,
+    ) -> Iterator[CompactTexMutant]:
+        spans = TikzIndex(code).statements()
+        original_array = np.asarray(original_image)
+        groups = [spans] if spans else []
+        render_count = 0
+        while groups:
+            if _past(deadline):
+                logger.info("mutant render time budget reached")
+                return
+            # the semicolons are removed from the code but not mapped
+            candidates = [
+                CompactTexMutant(
+                    group[0][0],
+                    code,
+                    list(group),
+                    removed_spans=[(start, end + 1) for start, end in group],
+                )
+                for group in groups
+            ]
+            render_count += len(candidates)
+            valid = {
+                id(mutant)
+                for mutant in self._iter_rendered(
+                    candidates, original_image, executor, deadline
+                )
+            }
+
+            split_groups = []
+            for group, candidate in zip(groups, candidates):
+                # the changed region is set when the group renders, even when it is screened out
+                if candidate.changed_region is not None and not _changes_boxes(
+                    original_array, candidate, boxes
                 ):
-                    # if the new image has a different size the mutant gets ignored for now
+                    continue  # none of the statements of the group changes a box
+                if len(group) == 1:
+                    if id(candidate) in valid:
+                        yield candidate
                     continue
+                # groups that do not render are split as well, one of their statements may break the code
+                half = len(group) // 2
+                split_groups += [group[:half], group[half:]]
+            groups = split_groups
+        logger.info(f"{render_count} group renders for {len(spans)} statements")
+
+
+def _changes_boxes(
+    original_array: np.ndarray, mutant: CompactTexMutant, boxes: list[Box2D] = None
+) -> bool:
+    """whether the image of the mutant differs from the original image inside one of the boxes, or anywhere without boxes"""
+    left, upper, right, lower = mutant.changed_region
+    if boxes is None or left >= right or upper >= lower:
+        return left < right and upper < lower
+    mutant_array = np.asarray(mutant.image)
+    for box in boxes:
+        changed = intersection(mutant.changed_region, tuple(int(x) for x in box))
+        if changed is None:
+            continue
+        left, upper, right, lower = changed
+        if np.any(
+            original_array[upper:lower, left:right]
+            != mutant_array[upper:lower, left:right]
+        ):
+            return True
+    return False
+
+
+def _render_original(
+    renderer: TexRenderer, code: str
+) -> tuple[Image.Image, float | None]:
+    """image of the code and its compilation time, None for the renderers without render_original"""
+    if hasattr(renderer, "render_original"):
+        return renderer.render_original(code)
+    return renderer.from_string_to_image(code), None
+
+
+def _image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _past(deadline: float) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+class TexMappingMutantCreator(TexMutantCreator):
+
+    def __init__(self, **kwargs):
+
+        self.definitions = DEFINITION_PATTERNS
+        self.commands = PATH_COMMANDS
+
+        super().__init__(**kwargs)
+
+    def _candidate_stages(
+        self, code: str, rendered_char_mutants: set[int]
+    ) -> Iterator[list[CompactTexMutant]]:
+        """definition groups, standalone commands and scopes first, then the statements they do not cover"""
+        index = TikzIndex(code, self.definitions)
+
+        all_possible_mutants: list[list[tuple[int, int]]] = []
+
+        # get all commands, with the span of their name and the position of their ";"
+        ex_commands = [
+            (command, index.terminator(command.start))
+            for command in index.commands_named(self.commands)
+        ]
+        ex_commands = [(command, end) for command, end in ex_commands if end != -1]
+
+        # find commands using definitions
+        usages = index.name_usages(self.commands)
+        for definition in index.definitions:
+            commands_using_variable = [
+                (command.start, command.end)
+                for command in usages.get(definition.name, [])
+            ]
+            all_possible_mutants.append(
+                [(definition.start, definition.end)] + commands_using_variable
+            )
+
+        # find standalone commands
+        for command, end in ex_commands:
+            all_possible_mutants.append([(command.start, end)])
+
+        # Find scopes
+        all_possible_mutants += [[scope] for scope in index.scopes]
+
+        yield [
+            CompactTexMutant(max(start for start, _ in mutant), code, mutant)
+            for mutant in all_possible_mutants
+        ]
+        yield self._remaining_candidates(code, rendered_char_mutants, index)
 
-                cmd_mutant.image = image
-                command_valid_mutants.append(cmd_mutant)
-            except TexRendererException as e:
-                logger.info("non valid mutant, skipping")
-                continue
-        return command_valid_mutants
+    def _remaining_candidates(
+        self, code: str, covered_char_nb: set[int], index: TikzIndex = None
+    ) -> list[CompactTexMutant]:
+        """uses a more basic tikz mutant search to find possible remaining mutants
+
+        Args:
+            code (str): original code
+            covered_char_nb (set[int]): char_mutant of the already found mutants
+            index (TikzIndex, optional): index of the code, built when not given
 
-    @staticmethod
-    def _create_mutant(possible_mutant: list[tuple[int, int]], code: str) -> str:
-        sorted_spans = sorted(possible_mutant, key=lambda x: x[0], reverse=True)
-        for start, end in sorted_spans:
-            code = code[:start] + code[end:]
-        return code, sorted_spans[0][0]
+        Returns:
+            list[CompactTexMutant]: candidate mutants not considered originally
+        """
+        index = index or TikzIndex(code, self.definitions)
+        return [
+            CompactTexMutant(span[0], code, [span])
+            for span in index.statements()
+            if span[0] not in covered_char_nb
+        ]
 
 
 class TexRegMutantCreator(TexMutantCreator):
     """Regex-based latex mutant creator"""
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
 
-    def create_mutants(self, code: str) -> list[TexMutant]:
-        mutants: list[TexMutant] = []
-        code = "\n".join(line.strip() for line in code.split("\n"))
-        original_image = self.renderer.from_string_to_image(code)
-        for m in re.finditer(";", code):
-            end = m.start()
-            start = code.rfind("\n\\", 0, end)
-            if "clip" in code[start : (start + 6)]:
-                continue  # skip clip statement
-            start = start + 1
-            if start != -1:
-                try:
-                    current_possible_mutant = code[:start] + code[m.end() :]
-                    image = self.renderer.from_string_to_image(current_possible_mutant)
-                    if (
-                        image.width != original_image.width
-                        or image.height != original_image.height
-                    ):
-                        # if the new image has a different size the mutant gets ignored for now
-                        continue
-                    mutants.append(
-                        TexMutant(
-                            start, current_possible_mutant, image, code, [(start, end)]
-                        )
-                    )
-                except TexRendererException as e:
-                    logger.info("non valid mutant, skipping")
-                    continue
-
-        return mutants
+    def _candidate_stages(
+        self, code: str, rendered_char_mutants: set[int]
+    ) -> Iterator[list[CompactTexMutant]]:
+        # the semicolon is removed from the code but not mapped
+        yield [
+            CompactTexMutant(
+                start, code, [(start, end)], removed_spans=[(start, end + 1)]
+            )
+            for start, end in TikzIndex(code).statements()
+        ]
 
 
 class TexRegBrutalMutantCreator(TexRegMutantCreator):
     """Regex-based latex mutant creator"""
 
-    def __init__(self, max_mutants: int = 1000):
+    def __init__(self, max_mutants: int = 1000, **kwargs):
         """
         Args:
-            max_mutants (int): maximum number of mutants generated
+            max_mutants (int): maximum number of candidate mutants, the shortest deletions are kept
+            **kwargs: rendering options, see TexMutantCreator
         """
 
         self.max_mutants = max_mutants
-        super().__init__()
+        super().__init__(**kwargs)
 
-    def create_mutants(self, code: str) -> list[tuple[str, Image.Image, int, int]]:
-        """creates mutants based on a latex code
+    def _candidate_stages(
+        self, code: str, rendered_char_mutants: set[int]
+    ) -> Iterator[list[CompactTexMutant]]:
+        """every statement start paired with the following ";", shortest deletions first
 
-        Args:
-            code (str): input latex code
-
-        Returns:
-            list[tuple[str, Image.Image, int, int]]: list of created mutants, with the image generated from it, the start of the match where the mutant has been deleted and the length of the deleted sequence.
+        The candidates are ranked by the number of ";" they delete, so that each start gets its shortest
+        deletions before any start gets a longer one, up to `self.max_mutants` candidates.
         """
-        valid_mutants = []
-        code = "\n".join(line.strip() for line in code.split("\n"))
-        original_image = self.renderer.from_string_to_image(code)
-        all_possible_mutants: dict[int, list[tuple[str, int, int]]] = {}
-        for m in re.finditer(";", code):
-            end = m.start()
-            for start in re.finditer(r"\n\\", code[0:end]):
-                start = start.start()
-                if "clip" in code[start : (start + 6)]:
-                    continue  # skip clip statement
-                start = start + 1
-                mutants_for_feature = all_possible_mutants.get(start, [])
-                mutants_for_feature.append(
-                    (code[:start] + code[m.end() :], start, (m.end() - start))
-                )
-                all_possible_mutants[start] = mutants_for_feature
-        max_mutants_per_feature = int(self.max_mutants / len(all_possible_mutants))
-        for char_nb, mutants in all_possible_mutants.items():
-            for mutant in mutants[:max_mutants_per_feature]:
-                try:
-
-                    image = self.renderer.from_string_to_image(mutant[0])
-                    if (
-                        image.width != original_image.width
-                        or image.height != original_image.height
-                    ):
-                        # if the new image has a different size the mutant gets ignored for now
-                        continue
-                    valid_mutants.append(
-                        TexMutant(
-                            mutant[1],
-                            mutant[0],
-                            image,
-                            code,
-                            [(mutant[1], mutant[1] + mutant[2])],
-                        )
-                    )
-
-                    valid_mutants.append((mutant[0], image, mutant[1], mutant[2]))
-                except TexRendererException as e:
-                    logger.info("non valid mutant, skipping")
+        index = TikzIndex(code)
+        all_possible_mutants: dict[int, int] = {}  # index of the first ";" after each start
+        for line_start in index.line_starts:
+            start = line_start + 1
+            if index.is_clip(start):
+                continue  # skip clip statement
+            first_end = bisect.bisect_left(index.semicolons, start + 1)
+            if first_end < len(index.semicolons):
+                all_possible_mutants[start] = first_end
+
+        candidate_mutants: list[CompactTexMutant] = []
+        depth = 0
+        while all_possible_mutants and len(candidate_mutants) < self.max_mutants:
+            for start, first_end in list(all_possible_mutants.items()):
+                if first_end + depth >= len(index.semicolons):
+                    del all_possible_mutants[start]
                     continue
-
-        return valid_mutants
+                end = index.semicolons[first_end + depth]
+                candidate_mutants.append(
+                    CompactTexMutant(start, code, [(start, end + 1)])
+                )
+                if len(candidate_mutants) == self.max_mutants:
+                    break
+            depth += 1
+        yield candidate_mutants
@@ -0,0 +1,159 @@
+"""Structural index of TikZ codes, shared by the mutant creators
+
+The code is tokenized once, in linear time, to find its commands, the ";" terminating them,
+the lines starting with a command, the scopes and the named node/coordinate definitions.
+Comments and escaped characters are skipped.
+"""
+
+import bisect
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+
+DEFINITION_PATTERNS = [
+    r"\\coordinate(?:[\[\[a-zA-Z0-9]+\])?\s\(([a-zA-Z0-9]+)\)",
+    r"\\node(?:[\[\[a-zA-Z0-9]+\])?\s\(([\[a-zA-Z0-9]+)\)",
+]
+PATH_COMMANDS = ["fill", "draw", "filldraw", "shade", "shadedraw"]
+
+_TOKEN_PATTERN = re.compile(
+    r"(?P<begin_scope>\\begin\{scope\})"
+    r"|(?P<end_scope>\\end\{scope\})"
+    r"|(?P<scoped>\\scoped\{)"
+    r"|\\(?P<command>[a-zA-Z@]+)"
+    r"|\\[^a-zA-Z@]"  # escaped character
+    r"|(?P<comment>%[^\n]*)"
+    r"|(?P<open>\{)"
+    r"|(?P<close>\})"
+    r"|(?P<semicolon>;)"
+    r"|(?P<line_command>\n(?=\\))",
+)
+
+_COORDINATE_PATTERN = re.compile(r"\((.*?)\)")
+
+
+@dataclass
+class TikzCommand:
+    """A command of the code"""
+
+    name: str
+    start: int  # position of the backslash
+    end: int  # position after the command name
+
+
+@dataclass
+class TikzDefinition:
+    """A named node or coordinate definition"""
+
+    name: str
+    start: int
+    end: int  # position after the name and its parenthesis
+
+
+class TikzIndex:
+    """Index of the structure of a TikZ code, built in one pass"""
+
+    def __init__(self, code: str, definition_patterns: list[str] = None):
+        """
+        Args:
+            code (str): indexed code
+            definition_patterns (list[str], optional): regexes matching a definition at a command,
+                with the defined name as first group. Defaults to DEFINITION_PATTERNS.
+        """
+        self.code = code
+        self.commands: list[TikzCommand] = []
+        self.definitions: list[TikzDefinition] = []
+        self.semicolons: list[int] = []
+        self.line_starts: list[int] = []  # positions of the "\n" before a command
+        self.scopes: list[tuple[int, int]] = []
+
+        definition_patterns = [
+            re.compile(pattern)
+            for pattern in (definition_patterns or DEFINITION_PATTERNS)
+        ]
+        scope_stack: list[tuple[str, int]] = []
+        in_scopes = False  # braces are only tracked from the first scope on
+        for token in _TOKEN_PATTERN.finditer(code):
+            kind = token.lastgroup
+            position = token.start()
+            if kind == "command":
+                self.commands.append(
+                    TikzCommand(token.group("command"), position, token.end())
+                )
+                for pattern in definition_patterns:
+                    definition = pattern.match(code, position)
+                    if definition is not None:
+                        self.definitions.append(
+                            TikzDefinition(
+                                definition.group(1), position, definition.end()
+                            )
+                        )
+                        break
+            elif kind == "semicolon":
+                self.semicolons.append(position)
+            elif kind == "line_command":
+                self.line_starts.append(position)
+            elif kind in ("begin_scope", "scoped"):
+                scope_stack.append((kind, position))
+                in_scopes = True
+            elif kind == "open" and in_scopes:
+                scope_stack.append(("ignored", position))
+            elif kind == "close" and scope_stack:
+                entering_scope = scope_stack.pop()
+                if entering_scope[0] != "ignored":
+                    self.scopes.append((entering_scope[1], token.end()))
+            elif kind == "end_scope" and scope_stack:
+                entering_scope = scope_stack.pop()
+                self.scopes.append((entering_scope[1], token.end()))
+
+    def commands_named(self, names: list[str]) -> list[TikzCommand]:
+        names = set(names)
+        return [command for command in self.commands if command.name in names]
+
+    def name_usages(self, command_names: list[str]) -> dict[str, list[TikzCommand]]:
+        """Inverted index from the names between parentheses, e.g. (a) or (a.north), to the commands using them
+
+        Args:
+            command_names (list[str]): names of the indexed commands, e.g. PATH_COMMANDS
+
+        Returns:
+            dict[str, list[TikzCommand]]: commands using each name, in the order of the code
+        """
+        usages: dict[str, list[TikzCommand]] = defaultdict(list)
+        for command in self.commands_named(command_names):
+            end = self.terminator(command.start)
+            if end == -1:
+                continue
+            used_names = {
+                coordinate.split(".")[0]
+                for coordinate in _COORDINATE_PATTERN.findall(
+                    self.code, command.start, end
+                )
+            }
+            for name in used_names:
+                usages[name].append(command)
+        return usages
+
+    def terminator(self, position: int) -> int:
+        """Position of the first ";" at or after the position, -1 if there is none"""
+        index = bisect.bisect_left(self.semicolons, position)
+        return self.semicolons[index] if index < len(self.semicolons) else -1
+
+    def is_clip(self, start: int) -> bool:
+        """Whether the statement starting at the position is a clip statement"""
+        return self.code.startswith("\\clip", start)
+
+    def statements(self) -> list[tuple[int, int]]:
+        """(start, end) spans of the statements ending with a ";", without the ";", except the clip statements"""
+        spans = []
+        line_index = -1
+        for end in self.semicolons:
+            while (
+                line_index + 1 < len(self.line_starts)
+                and self.line_starts[line_index + 1] <= end - 2
+            ):
+                line_index += 1
+            start = self.line_starts[line_index] + 1 if line_index >= 0 else 0
+            if not self.is_clip(start):
+                spans.append((start, end))
+        return spans
@@ -0,0 +1,124 @@
+"""Rendering of several codes sharing a preamble as the pages of one document
+
+Each code is wrapped in a group, between markers written to the log, so that the pages
+and the errors of the compilation can be mapped back to the codes.
+"""
+
+from dataclasses import dataclass
+import re
+
+BATCH_MARKER = "VIFBATCH"
+
+# commands that cannot be used after \begin{document}
+PREAMBLE_ONLY_COMMANDS = (
+    "\\documentclass",
+    "\\usepackage",
+    "\\RequirePackage",
+    "\\usetikzlibrary",
+    "\\usepgflibrary",
+)
+
+_MARKER_PATTERN = re.compile(
+    rf"^{BATCH_MARKER}:(begin|end):(\d+):(-?\d+):(\d+):(\S*)$", re.MULTILINE
+)
+
+
+@dataclass
+class BatchSegment:
+    """Part of the batch compilation log belonging to one code"""
+
+    start_page: int
+    log: str = ""
+    end_page: int = None
+    balanced: bool = False
+
+    @property
+    def closed(self) -> bool:
+        return self.end_page is not None
+
+    @property
+    def has_error(self) -> bool:
+        return any(line.startswith("! ") for line in self.log.split("\n"))
+
+
+def split_document(code: str) -> tuple[str, str] | None:
+    """Splits the code following the package loading prefix into its remaining preamble and its body
+
+    Args:
+        code (str): code without its package loading prefix, see split_preamble
+
+    Returns:
+        tuple[str, str] | None: the commands before \\begin{document} and the content of the document,
+            None if the code cannot be part of a batch.
+    """
+    begin = code.find("\\begin{document}")
+    end = code.rfind("\\end{document}")
+    if begin == -1 or end < begin:
+        return None
+    preamble = code[:begin]
+    if any(command in preamble for command in PREAMBLE_ONLY_COMMANDS):
+        return None
+    return preamble, code[begin + len("\\begin{document}") : end]
+
+
+def build_batch_document(prefix: str, parts: list[tuple[str, str]]) -> str:
+    """Builds one document from the split codes, each code in its own group
+
+    Args:
+        prefix (str): shared package loading prefix
+        parts (list[tuple[str, str]]): split codes, as returned by split_document
+
+    Returns:
+        str: the batch document
+    """
+    # pages already shipped out, -1 when the latex kernel does not count them
+    shipped = r"\ifdefined\ReadonlyShipoutCounter\the\ReadonlyShipoutCounter\else -1\fi"
+    state = r"\the\currentgrouplevel:\csname @currenvir\endcsname"
+    chunks = [prefix, "\\begin{document}\n"]
+    for index, (preamble, body) in enumerate(parts):
+        chunks += [
+            f"\\typeout{{{BATCH_MARKER}:begin:{index}:{shipped}:{state}}}\n",
+            "\\begingroup\n",
+            preamble,
+            "\n",
+            body,
+            "\n\\endgroup\n\\clearpage\n",
+            f"\\typeout{{{BATCH_MARKER}:end:{index}:{shipped}:{state}}}\n",
+        ]
+    chunks.append("\\end{document}\n")
+    return "".join(chunks)
+
+
+def parse_batch_log(log: str, size: int) -> list[BatchSegment | None]:
+    """Splits the log of a batch compilation into the segments of each code
+
+    Args:
+        log (str): output of pdflatex
+        size (int): number of codes in the batch
+
+    Returns:
+        list[BatchSegment | None]: segment of each code, None when the compilation stopped before reaching it
+    """
+    segments: list[BatchSegment | None] = [None] * size
+    opened: dict[int, tuple[re.Match, str]] = {}
+    for match in _MARKER_PATTERN.finditer(log):
+        kind, index = match.group(1), int(match.group(2))
+        if index >= size:
+            continue
+        state = match.group(4) + ":" + match.group(5)
+        if kind == "begin":
+            segments[index] = BatchSegment(start_page=int(match.group(3)))
+            opened[index] = (match, state)
+        elif index in opened:
+            begin_match, begin_state = opened.pop(index)
+            segment = segments[index]
+            segment.log = log[begin_match.end() : match.start()]
+            segment.end_page = int(match.group(3))
+            segment.balanced = state == begin_state
+    for index, (begin_match, _) in opened.items():
+        # the compilation stopped within this code
+        next_marker = _MARKER_PATTERN.search(log, begin_match.end())
+        segments[index].log = log[
+            begin_match.end() : next_marker.start() if next_marker else len(log)
+        ]
+    return segments
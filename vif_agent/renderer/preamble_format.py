@@ -0,0 +1,157 @@
+import hashlib
+import os
+import subprocess
+import threading
+import uuid
+
+from loguru import logger
+
+# commands that only load code, and can be dumped in a format
+PRELOADABLE_COMMANDS = (
+    "\\documentclass",
+    "\\usepackage",
+    "\\RequirePackage",
+    "\\usetikzlibrary",
+    "\\usepgflibrary",
+)
+
+FORMAT_LOADING_ERRORS = (
+    "Fatal format file error",
+    "I can't find the format file",
+)
+
+
+def split_preamble(code: str) -> tuple[str, str]:
+    """Splits a latex code into its package loading prefix and the rest of the code
+
+    The prefix is made of the leading \\documentclass/\\usepackage/\\usetikzlibrary... lines,
+    it is what can be dumped in a format. Everything else(\\tikzset, definitions, body) is left in the rest.
+
+    Args:
+        code (str): latex code
+
+    Returns:
+        tuple[str, str]: the loading prefix, empty if the code has no \\documentclass, and the rest of the code
+    """
+    end = 0
+    depth = 0  # open braces and brackets, for options spanning several lines
+    for line in code.splitlines(keepends=True):
+        stripped = line.strip()
+        if (
+            depth == 0
+            and stripped
+            and not stripped.startswith("%")
+            and not stripped.startswith(PRELOADABLE_COMMANDS)
+        ):
+            break
+        if not stripped.startswith("%"):
+            depth += stripped.count("{") + stripped.count("[")
+            depth -= stripped.count("}") + stripped.count("]")
+            depth = max(depth, 0)
+        end += len(line)
+
+    if "\\documentclass" not in code[:end]:
+        return "", code
+    return code[:end], code[end:]
+
+
+class PreambleFormatStore:
+    """Builds and keeps the formats dumped from the preambles of the rendered codes
+
+    Formats are stored in the renderer cache directory, named after the hash of their preamble,
+    so they are reused across renderers and processes.
+    A preamble that fails to be dumped is remembered and never retried.
+    """
+
+    def __init__(self, cache_path: str, timeout: float = 60, engine: str = "pdflatex"):
+        """
+        Args:
+            cache_path (str): directory of the formats
+            timeout (float, optional): timeout of a format dump, in seconds
+            engine (str, optional): "pdflatex", or "latex" for formats of dvi compilations
+        """
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.engine = engine
+        self._formats: dict[str, str | None] = {}
+        self._lock = threading.Lock()
+        # held while a format is dumped, so that the other preambles are not blocked
+        self._format_locks: dict[str, threading.Lock] = {}
+
+    def get_format(self, preamble: str) -> str | None:
+        """Gets the name of the format dumped from the preamble, building it if needed
+
+        Args:
+            preamble (str): package loading prefix, as returned by split_preamble
+
+        Returns:
+            str | None: name of the format, usable with -fmt, None if the preamble cannot be dumped
+        """
+        # the pdflatex formats keep the names they had before the other engines
+        hashed = preamble if self.engine == "pdflatex" else self.engine + preamble
+        format_name = "preamble_" + hashlib.sha256(hashed.encode()).hexdigest()[:16]
+        with self._lock:
+            if format_name in self._formats:
+                return self._formats[format_name]
+            format_lock = self._format_locks.setdefault(format_name, threading.Lock())
+
+        with format_lock:
+            with self._lock:
+                if format_name in self._formats:  # built while waiting for the lock
+                    return self._formats[format_name]
+            if os.path.exists(self.format_path(format_name)):
+                built = format_name
+            else:
+                built = self._build(format_name, preamble)
+            with self._lock:
+                self._formats[format_name] = built
+                return built
+
+    def invalidate(self, format_name: str):
+        """Marks a format as unusable, e.g. when pdflatex was updated since it was dumped"""
+        logger.warning(f"format {format_name} cannot be loaded, not using it anymore")
+        with self._lock:
+            self._formats[format_name] = None
+        format_path = self.format_path(format_name)
+        os.path.exists(format_path) and os.remove(format_path)
+
+    def format_path(self, format_name: str) -> str:
+        return os.path.join(self.cache_path, format_name + ".fmt")
+
+    def _build(self, format_name: str, preamble: str) -> str | None:
+        # unique job name so that concurrent processes do not write the same files
+        job_name = f"{format_name}_{uuid.uuid4()}"
+        job_path = os.path.join(self.cache_path, job_name)
+        with open(job_path + ".tex", "w") as preamble_file:
+            preamble_file.write(preamble + "\n\\dump\n")
+
+        logger.info(f"dumping preamble format {format_name}")
+        try:
+            output = subprocess.run(
+                [
+                    self.engine,
+                    "-ini",
+                    "-halt-on-error",
+                    "-interaction=nonstopmode",
+                    f"-jobname={job_name}",
+                    "-output-directory",
+                    self.cache_path,
+                    "&" + self.engine,
+                    job_path + ".tex",
+                ],
+                timeout=self.timeout,
+                capture_output=True,
+            )
+            built = output.returncode == 0 and os.path.exists(job_path + ".fmt")
+        except subprocess.TimeoutExpired:
+            built = False
+
+        if built:
+            os.replace(job_path + ".fmt", self.format_path(format_name))
+        else:
+            logger.warning(
+                f"preamble format {format_name} could not be dumped, using full compilations"
+            )
+        for ext in ["tex", "log", "fmt"]:
+            os.path.exists(f"{job_path}.{ext}") and os.remove(f"{job_path}.{ext}")
+        return format_name if built else None
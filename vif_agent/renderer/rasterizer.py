@@ -0,0 +1,284 @@
+"""Rasterizers of the compiled documents, pdfs kept in memory or dvis
+
+Every pdf backend renders the pages with the geometry of pdftoppm, ceil(page size * dpi / 72) pixels per side,
+in "RGB" or, in grayscale, in "L" mode.
+"""
+
+import glob
+import io
+import math
+import os
+import subprocess
+import tempfile
+import threading
+from collections.abc import Callable
+
+import PIL.Image
+from pdf2image.exceptions import PDFPageCountError
+
+_PNM_MODES = {b"P6": ("RGB", 3), b"P5": ("L", 1)}
+
+DEFAULT_DPI = 200  # default of pdf2image
+
+# pdfium is not thread safe, pypdfium2 forbids concurrent calls even on different documents
+_PDFIUM_LOCK = threading.Lock()
+
+
+def rasterize_pdf_bytes(
+    pdf: bytes,
+    first_page: int = 1,
+    last_page: int = 1,
+    dpi: int = DEFAULT_DPI,
+    grayscale: bool = False,
+) -> list[PIL.Image.Image]:
+    """Rasterizes pages of a pdf kept in memory
+
+    The pdf is piped to pdftoppm, which writes the pages to its standard output,
+    so no file is written.
+
+    Args:
+        pdf (bytes): content of the pdf
+        first_page (int, optional): first rasterized page, starting at 1
+        last_page (int, optional): last rasterized page, included
+        dpi (int, optional): resolution of the images
+        grayscale (bool, optional): rasterizes to "L" images instead of "RGB" images
+
+    Raises:
+        PDFPageCountError: the pdf has no such pages or cannot be read
+
+    Returns:
+        list[PIL.Image.Image]: the rasterized pages
+    """
+    output = subprocess.run(
+        [
+            "pdftoppm",
+            "-r",
+            str(dpi),
+            "-f",
+            str(first_page),
+            "-l",
+            str(last_page),
+        ]
+        + (["-gray"] if grayscale else [])
+        + ["-"],
+        input=pdf,
+        capture_output=True,
+    )
+    if output.returncode != 0 or not output.stdout:
+        raise PDFPageCountError(
+            f"Unable to rasterize the pdf.\n{output.stderr.decode(errors='replace')}"
+        )
+    return parse_pnm_stream(output.stdout)
+
+
+def rasterize_pdf_bytes_cairo(
+    pdf: bytes,
+    first_page: int = 1,
+    last_page: int = 1,
+    dpi: int = DEFAULT_DPI,
+    grayscale: bool = False,
+) -> list[PIL.Image.Image]:
+    """Rasterizes pages of a pdf kept in memory with pdftocairo, see rasterize_pdf_bytes
+
+    The pdf is piped to pdftocairo, which writes png pages to a temporary directory, in /dev/shm when available.
+    """
+    with tempfile.TemporaryDirectory(prefix="varbench_", dir=_shm_dir()) as tmp_dir:
+        output = subprocess.run(
+            [
+                "pdftocairo",
+                "-png",
+                "-r",
+                str(dpi),
+                "-f",
+                str(first_page),
+                "-l",
+                str(last_page),
+            ]
+            + (["-gray"] if grayscale else [])
+            + ["-", os.path.join(tmp_dir, "page")],
+            input=pdf,
+            capture_output=True,
+        )
+        # pages are named page-1.png, or page-01.png etc. depending on the page count
+        page_files = sorted(
+            glob.glob(os.path.join(tmp_dir, "page-*.png")),
+            key=lambda page_file: int(page_file.rsplit("-", 1)[1][:-4]),
+        )
+        if output.returncode != 0 or not page_files:
+            raise PDFPageCountError(
+                f"Unable to rasterize the pdf.\n{output.stderr.decode(errors='replace')}"
+            )
+        mode = "L" if grayscale else "RGB"
+        images = []
+        for page_file in page_files:
+            with PIL.Image.open(page_file) as page:
+                images.append(page.convert(mode))
+        return images
+
+
+def rasterize_pdf_bytes_pdfium(
+    pdf: bytes,
+    first_page: int = 1,
+    last_page: int = 1,
+    dpi: int = DEFAULT_DPI,
+    grayscale: bool = False,
+) -> list[PIL.Image.Image]:
+    """Rasterizes pages of a pdf kept in memory with pdfium, in process, see rasterize_pdf_bytes
+
+    Requires pypdfium2. The renders of the process are serialized by a lock, as pdfium is not thread safe.
+    """
+    import pypdfium2  # optional dependency, only needed by this backend
+
+    with _PDFIUM_LOCK:
+        return _rasterize_pdfium(pypdfium2, pdf, first_page, last_page, dpi, grayscale)
+
+
+def _rasterize_pdfium(
+    pypdfium2, pdf: bytes, first_page: int, last_page: int, dpi: int, grayscale: bool
+) -> list[PIL.Image.Image]:
+    """rasterize_pdf_bytes_pdfium, the caller must hold _PDFIUM_LOCK"""
+    try:
+        document = pypdfium2.PdfDocument(pdf)
+    except pypdfium2.PdfiumError as e:
+        raise PDFPageCountError(f"Unable to rasterize the pdf.\n{e}")
+    try:
+        if first_page < 1 or last_page > len(document) or first_page > last_page:
+            raise PDFPageCountError(
+                f"Unable to rasterize the pages {first_page} to {last_page} of a pdf of {len(document)} pages"
+            )
+        images = []
+        for page_index in range(first_page - 1, last_page):
+            page = document[page_index]
+            width, height = page.get_size()
+            size = (math.ceil(width * dpi / 72), math.ceil(height * dpi / 72))
+            image = (
+                page.render(scale=dpi / 72, grayscale=grayscale)
+                .to_pil()
+                .convert("L" if grayscale else "RGB")
+            )
+            if image.size != size:
+                # pdfium rounds the size of the bitmap, padding or cropping to the size of pdftoppm
+                fitted = PIL.Image.new(image.mode, size, "white")
+                fitted.paste(image, (0, 0))
+                image = fitted
+            images.append(image)
+            page.close()
+        return images
+    finally:
+        document.close()
+
+
+def rasterize_dvi(
+    dvi_path: str,
+    first_page: int = 1,
+    last_page: int = 1,
+    dpi: int = DEFAULT_DPI,
+    grayscale: bool = False,
+) -> list[PIL.Image.Image]:
+    """Rasterizes pages of a dvi compiled with the dvisvgm pgf driver
+
+    The pages are converted to svg by dvisvgm, with the glyphs as paths and the size of the papersize special
+    (set by the standalone class), and the svgs are rasterized by rsvg-convert, writing to its standard output.
+
+    Args:
+        dvi_path (str): path of the dvi
+        first_page (int, optional): first rasterized page, starting at 1
+        last_page (int, optional): last rasterized page, included
+        dpi (int, optional): resolution of the images
+        grayscale (bool, optional): rasterizes to "L" images instead of "RGB" images
+
+    Raises:
+        PDFPageCountError: the dvi has no such pages or cannot be converted, as for the pdf rasterizers
+
+    Returns:
+        list[PIL.Image.Image]: the rasterized pages
+    """
+    with tempfile.TemporaryDirectory(prefix="varbench_", dir=_shm_dir()) as tmp_dir:
+        output = subprocess.run(
+            [
+                "dvisvgm",
+                "--no-fonts",
+                "--bbox=papersize",
+                f"--page={first_page}-{last_page}",
+                "--output=" + os.path.join(tmp_dir, "page-%p.svg"),
+                dvi_path,
+            ],
+            capture_output=True,
+        )
+        page_files = sorted(
+            glob.glob(os.path.join(tmp_dir, "page-*.svg")),
+            key=lambda page_file: int(page_file.rsplit("-", 1)[1][:-4]),
+        )
+        if output.returncode != 0 or len(page_files) != last_page - first_page + 1:
+            raise PDFPageCountError(
+                f"Unable to convert the dvi.\n{output.stderr.decode(errors='replace')}"
+            )
+
+        mode = "L" if grayscale else "RGB"
+        images = []
+        for page_file in page_files:
+            output = subprocess.run(
+                [
+                    "rsvg-convert",
+                    f"--dpi-x={dpi}",
+                    f"--dpi-y={dpi}",
+                    "--background-color=white",
+                    "--format=png",
+                    page_file,
+                ],
+                capture_output=True,
+            )
+            if output.returncode != 0:
+                raise PDFPageCountError(
+                    f"Unable to rasterize the dvi.\n{output.stderr.decode(errors='replace')}"
+                )
+            with PIL.Image.open(io.BytesIO(output.stdout)) as page:
+                images.append(page.convert(mode))
+        return images
+
+
+type Rasterizer = Callable[[bytes, int, int, int, bool], list[PIL.Image.Image]]
+
+RASTERIZERS: dict[str, Rasterizer] = {
+    "pdftoppm": rasterize_pdf_bytes,
+    "pdftocairo": rasterize_pdf_bytes_cairo,
+    "pdfium": rasterize_pdf_bytes_pdfium,
+}
+
+
+def _shm_dir() -> str | None:
+    shm = "/dev/shm"
+    return shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else None
+
+
+def parse_pnm_stream(data: bytes) -> list[PIL.Image.Image]:
+    """Parses the binary ppm/pgm images concatenated by pdftoppm"""
+    images = []
+    position = 0
+    while True:
+        while position < len(data) and data[position : position + 1].isspace():
+            position += 1
+        if position >= len(data):
+            return images
+
+        # header: magic number, width, height and maximum value
+        tokens = []
+        while len(tokens) < 4:
+            while data[position : position + 1].isspace():
+                position += 1
+            end = position
+            while end < len(data) and not data[end : end + 1].isspace():
+                end += 1
+            tokens.append(data[position:end])
+            position = end
+        position += 1  # single whitespace before the pixels
+
+        mode, bands = _PNM_MODES[tokens[0]]
+        width, height = int(tokens[1]), int(tokens[2])
+        pixel_bytes = width * height * bands
+        images.append(
+            PIL.Image.frombytes(
+                mode, (width, height), data[position : position + pixel_bytes]
+            )
+        )
+        position += pixel_bytes
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import PIL.Image
+from loguru import logger
+
+from vif_agent.disk_cache import DiskLRU
+
+
+@dataclass
+class RenderFailure:
+    """A cached failed render, stored instead of an image"""
+
+    exception_type: str
+    message: str
+
+
+type CacheEntry = PIL.Image.Image | RenderFailure
+
+
+class RenderCache:
+    """Content-addressed cache of rendered images
+
+    Entries are keyed on a hash of the rendered source and of the renderer settings.
+    They are stored on disk (png for images, text for failures) with an in-memory LRU in front.
+    When the disk budget is exceeded, the least recently used files are evicted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        max_bytes: int = 1024**3,
+        max_memory_bytes: int = 256 * 1024**2,
+    ):
+        """
+        Args:
+            cache_dir (str, optional): directory of the on-disk cache, defaults to ~/.cache/varbench/render_cache
+            max_bytes (int, optional): budget of the on-disk cache, in bytes
+            max_memory_bytes (int, optional): budget of the in-memory LRU, in bytes of decoded images
+        """
+        self.cache_dir = cache_dir or os.path.join(
+            os.environ.get("HOME"), ".cache/varbench", "render_cache"
+        )
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = DiskLRU(self.cache_dir, max_bytes)
+
+    @property
+    def evictions(self) -> int:
+        return self._disk.evictions
+
+    @staticmethod
+    def key(source: str, settings: dict) -> str:
+        """Computes the cache key of a source rendered with the given settings"""
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(settings, sort_keys=True).encode())
+        hasher.update(b"\0")
+        hasher.update(source.encode())
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> CacheEntry | None:
+        """Gets a cached entry, None if the key is not cached"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry.copy() if isinstance(entry, PIL.Image.Image) else entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+        return entry.copy() if isinstance(entry, PIL.Image.Image) else entry
+
+    def put(self, key: str, entry: CacheEntry):
+        """Stores an image or a failure in the cache"""
+        if isinstance(entry, PIL.Image.Image):
+            self._disk.write(
+                self._path(key, "png"),
+                lambda tmp_path: entry.save(tmp_path, format="PNG"),
+            )
+        else:
+
+            def write_failure(tmp_path: str):
+                with open(tmp_path, "w") as failure_file:
+                    failure_file.write(entry.exception_type + "\n" + entry.message)
+
+            self._disk.write(self._path(key, "err"), write_failure)
+
+        with self._lock:
+            self._remember(
+                key, entry.copy() if isinstance(entry, PIL.Image.Image) else entry
+            )
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_bytes": self._disk.disk_bytes,
+            "memory_bytes": self._memory_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        self._disk.clear()
+
+    def _path(self, key: str, ext: str) -> str:
+        return self._disk.path(f"{key}.{ext}")
+
+    def _read_disk(self, key: str) -> CacheEntry | None:
+        image_path = self._path(key, "png")
+        failure_path = self._path(key, "err")
+        try:
+            if os.path.exists(image_path):
+                with PIL.Image.open(image_path) as image:
+                    image.load()
+                    entry = image.copy()
+                self._disk.touch(image_path)
+                return entry
+            if os.path.exists(failure_path):
+                with open(failure_path) as failure_file:
+                    exception_type, _, message = failure_file.read().partition("\n")
+                self._disk.touch(failure_path)
+                return RenderFailure(exception_type, message)
+        except (OSError, PIL.UnidentifiedImageError) as e:
+            # evicted or corrupted in the meantime, considered as a miss
+            logger.debug(f"unreadable render cache entry {key}: {e!r}")
+        return None
+
+    @staticmethod
+    def _entry_size(entry: CacheEntry) -> int:
+        if isinstance(entry, PIL.Image.Image):
+            return entry.width * entry.height * len(entry.getbands())
+        return len(entry.message)
+
+    def _remember(self, key: str, entry: CacheEntry):
+        """adds the entry to the in-memory lru, caller must hold the lock"""
+        if key in self._memory:
+            self._memory_bytes -= self._entry_size(self._memory.pop(key))
+        self._memory[key] = entry
+        self._memory_bytes += self._entry_size(entry)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= self._entry_size(evicted)
@@ -0,0 +1,308 @@
+"""Local render service shared by several agents
+
+The server keeps warm renderers(dumped preamble formats, work directories, cache) behind a unix socket,
+and renders the jobs by priority: interactive renders of base images go before bulk mutant renders.
+
+Messages are json lines, requests {"id", "codes", "priority"} and responses {"id", "results"},
+or {"id", "error"} for a malformed request.
+A request may give the "baseline" of the adaptive timeouts of its codes, see TexRenderer.render_original,
+the "original_code" of its mutants, see TexRenderer.uses_dvi,
+and an "original" request renders its single code with TexRenderer.render_original, answering its "baseline" too.
+
+Usage:
+    python -m vif_agent.renderer.render_server --socket ~/.cache/varbench/render.sock
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+
+import PIL.Image
+from loguru import logger
+
+from vif_agent.renderer.rasterizer import DEFAULT_DPI, RASTERIZERS
+from vif_agent.renderer.render_cache import RenderCache
+from vif_agent.renderer.tex_renderer import (
+    _FAILURE_TYPES,
+    TexRenderer,
+    TexRendererException,
+)
+
+DEFAULT_SOCKET_PATH = os.path.join(
+    os.environ.get("HOME"), ".cache/varbench", "render.sock"
+)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+
+def encode_result(result: PIL.Image.Image | TexRendererException) -> dict:
+    if isinstance(result, TexRendererException):
+        return {"error": type(result).__name__, "message": result.message}
+    return {
+        "mode": result.mode,
+        "size": result.size,
+        "data": base64.b64encode(result.tobytes()).decode(),
+    }
+
+
+def decode_result(encoded: dict) -> PIL.Image.Image | TexRendererException:
+    if "error" in encoded:
+        exception_type = _FAILURE_TYPES.get(encoded["error"], TexRendererException)
+        return exception_type(encoded["message"])
+    return PIL.Image.frombytes(
+        encoded["mode"], tuple(encoded["size"]), base64.b64decode(encoded["data"])
+    )
+
+
+class RenderServer:
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        workers: int = None,
+        renderer: TexRenderer = None,
+    ):
+        """
+        Args:
+            socket_path (str, optional): path of the unix socket the server listens on
+            workers (int, optional): number of concurrent render jobs, defaults to the number of cores
+            renderer (TexRenderer, optional): renderer shared by the workers, defaults to an in-memory renderer using preamble formats
+        """
+        self.socket_path = socket_path
+        self.workers = workers or os.cpu_count() or 1
+        self.renderer = renderer or TexRenderer(preamble_format=True, in_memory=True)
+        self.jobs: queue.PriorityQueue = queue.PriorityQueue()
+        self._sequence = itertools.count()  # first in first out within a priority
+        self._listener: socket.socket = None
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # stale socket of a previous server
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen()
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        logger.info(
+            f"render server listening on {self.socket_path} with {self.workers} workers"
+        )
+
+        while True:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                break  # shut down
+            threading.Thread(
+                target=self._handle_connection, args=(connection,), daemon=True
+            ).start()
+
+    def shutdown(self):
+        for _ in range(self.workers):
+            self.jobs.put((float("inf"), next(self._sequence), None, None, None))
+        if self._listener is not None:
+            self._listener.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.renderer.close()
+
+    def _handle_connection(self, connection: socket.socket):
+        send_lock = threading.Lock()
+        with connection, connection.makefile("rb") as requests:
+            for line in requests:
+                request = None
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request.get("codes"), list):
+                        raise ValueError("no list of codes")
+                except (ValueError, AttributeError) as e:
+                    logger.warning(f"malformed render request: {e!r}")
+                    response = {
+                        "id": request.get("id") if isinstance(request, dict) else None,
+                        "error": f"malformed request: {e!r}",
+                    }
+                    try:
+                        with send_lock:
+                            connection.sendall(json.dumps(response).encode() + b"\n")
+                    except OSError:
+                        return  # client disconnected
+                    continue
+                self.jobs.put(
+                    (
+                        request.get("priority", PRIORITY_INTERACTIVE),
+                        next(self._sequence),
+                        request,
+                        connection,
+                        send_lock,
+                    )
+                )
+
+    def _work(self):
+        while True:
+            _, _, request, connection, send_lock = self.jobs.get()
+            if request is None:
+                return
+            baseline = None
+            try:
+                if request.get("original"):
+                    try:
+                        image, baseline = self.renderer.render_original(
+                            request["codes"][0]
+                        )
+                        results = [image]
+                    except TexRendererException as e:
+                        results = [e]
+                else:
+                    results = self.renderer.from_strings_to_images(
+                        request["codes"],
+                        request.get("baseline"),
+                        request.get("original_code"),
+                    )
+            except Exception as e:
+                logger.exception("render job failed")
+                results = [TexRendererException(repr(e))] * len(request["codes"])
+            response = {
+                "id": request.get("id"),
+                "results": [encode_result(result) for result in results],
+                "baseline": baseline,
+            }
+            try:
+                with send_lock:
+                    connection.sendall(json.dumps(response).encode() + b"\n")
+            except OSError:
+                logger.debug("client disconnected before its render finished")
+
+
+class RenderClient:
+    """Renders codes through a RenderServer
+
+    Usable as the code_renderer of a VifAgent, and as the renderer of a TexMutantCreator.
+    """
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        priority: int = PRIORITY_INTERACTIVE,
+        timeout: float = None,
+    ):
+        """
+        Args:
+            socket_path (str, optional): path of the unix socket of the server
+            priority (int, optional): priority of the renders, lower goes first. Use PRIORITY_BULK for mutants.
+            timeout (float, optional): maximum time waiting for the server, in seconds
+        """
+        self.socket_path = socket_path
+        self.priority = priority
+        self.timeout = timeout
+        self._ids = itertools.count()
+
+    def __call__(self, input_string: str) -> PIL.Image.Image:
+        return self.from_string_to_image(input_string)
+
+    def from_string_to_image(self, input_string: str) -> PIL.Image.Image:
+        result = self.from_strings_to_images([input_string])[0]
+        if isinstance(result, TexRendererException):
+            raise result
+        return result
+
+    def render_original(
+        self, input_string: str
+    ) -> tuple[PIL.Image.Image, float | None]:
+        """Renders the original code of mutants, see TexRenderer.render_original"""
+        response = self._request([input_string], original=True)
+        result = decode_result(response["results"][0])
+        if isinstance(result, TexRendererException):
+            raise result
+        return result, response.get("baseline")
+
+    def from_strings_to_images(
+        self,
+        input_strings: list[str],
+        baseline: float = None,
+        original_code: str = None,
+    ) -> list[PIL.Image.Image | TexRendererException]:
+        response = self._request(
+            input_strings, baseline=baseline, original_code=original_code
+        )
+        return [decode_result(result) for result in response["results"]]
+
+    def _request(self, input_strings: list[str], **options) -> dict:
+        request = {
+            "id": next(self._ids),
+            "codes": input_strings,
+            "priority": self.priority,
+            **options,
+        }
+        # one connection per call, so that the client can be shared between threads
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            connection.sendall(json.dumps(request).encode() + b"\n")
+            with connection.makefile("rb") as responses:
+                line = responses.readline()
+        if not line:
+            raise TexRendererException("render server closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise TexRendererException(response["error"])
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="render server",
+        description="Serves TeX renders to the agents of this host through a unix socket",
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--cache", action="store_true", help="caches the renders on disk"
+    )
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI)
+    parser.add_argument(
+        "--grayscale", action="store_true", help="renders grayscale images"
+    )
+    parser.add_argument("--rasterizer", choices=list(RASTERIZERS), default="pdftoppm")
+    parser.add_argument(
+        "--dvi",
+        action="store_true",
+        help="compiles to dvi with latex, rasterized with dvisvgm and rsvg-convert",
+    )
+    parser.add_argument(
+        "--timeout-factor",
+        type=float,
+        default=None,
+        help="limits the compilations of mutants to this factor of the compilation of their original code",
+    )
+    parser.add_argument(
+        "--cpu-time-limit", type=int, default=None, help="in seconds, per compilation"
+    )
+    parser.add_argument(
+        "--memory-limit", type=int, default=None, help="in bytes, per compilation"
+    )
+    args = parser.parse_args()
+
+    renderer = TexRenderer(
+        cache=RenderCache() if args.cache else None,
+        preamble_format=True,
+        in_memory=True,
+        dpi=args.dpi,
+        grayscale=args.grayscale,
+        rasterizer=args.rasterizer,
+        dvi=args.dvi,
+        timeout_factor=args.timeout_factor,
+        cpu_time_limit=args.cpu_time_limit,
+        memory_limit=args.memory_limit,
+    )
+    server = RenderServer(args.socket, args.workers, renderer)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,172 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import queue
+import re
+import shutil
+import signal
+import tempfile
+import time
 import uuid
+import weakref
 import PIL.Image
 import os
 import subprocess
 from pdf2image import convert_from_path
 from pdf2image.exceptions import PDFPageCountError
 from loguru import logger
+from vif_agent.renderer.batch import (
+    build_batch_document,
+    parse_batch_log,
+    split_document,
+)
+from vif_agent.renderer.preamble_format import (
+    FORMAT_LOADING_ERRORS,
+    PreambleFormatStore,
+    split_preamble,
+)
+from vif_agent.renderer.rasterizer import DEFAULT_DPI, RASTERIZERS, rasterize_dvi
+from vif_agent.renderer.render_cache import RenderCache, RenderFailure
+
+DVI_DRIVER = "\\def\\pgfsysdriver{pgfsys-dvisvgm.def}\n"
+# return codes of the compilations killed at their cpu time limit
+LIMIT_RETURNCODES = (-signal.SIGXCPU, -signal.SIGKILL)
 
+# preamble constructs of the codes the dvisvgm driver or rasterizer cannot render: external graphics,
+# fadings and shadings libraries, externalization
+PDF_PREAMBLE_PATTERN = re.compile(
+    r"\\usepackage(?:\[[^\]]*\])?\{[^}]*\b(?:graphicx|graphics|pdfpages)\b"
+    r"|\\use(?:tikz|pgf)library(?:\[[^\]]*\])?\{[^}]*\b(?:fadings|shadings|external)\b"
+    r"|\\tikzexternalize"
+)
+# primitives needing the pdf driver, used anywhere in the code: pdf primitives, specials, functional shadings
+PDF_PRIMITIVE_PATTERN = re.compile(
+    r"\\pdf[a-z]+|\\directlua|\\special|\\pgfdeclarefunctionalshading"
+)
 
 
 class TexRenderer:
 
-    def __init__(self, debug=False):
+    def __init__(
+        self,
+        debug=False,
+        cache: RenderCache = None,
+        preamble_format: bool = False,
+        in_memory: bool = False,
+        dpi: int = DEFAULT_DPI,
+        grayscale: bool = False,
+        rasterizer: str = "pdftoppm",
+        dvi: bool = False,
+        rendering_timeout: float = 30,
+        timeout_factor: float = None,
+        min_timeout: float = 5,
+        cpu_time_limit: int = None,
+        memory_limit: int = None,
+    ):
+        """
+        Args:
+            debug (bool, optional): keeps the files of failed compilations
+            cache (RenderCache, optional): cache of the rendered images and failures, no caching if None
+            preamble_format (bool, optional): compiles against a format dumped from the packages loaded in the preamble,
+                built once per preamble. Falls back to full compilations when the preamble cannot be dumped.
+            in_memory (bool, optional): compiles in private work directories reused across renders(in /dev/shm when available)
+                and rasterizes the pdf from memory, instead of creating and deleting files in the cache path for each render.
+            dpi (int, optional): resolution of the rendered images
+            grayscale (bool, optional): renders "L" images instead of "RGB" images
+            rasterizer (str, optional): backend converting the pdfs to images, one of RASTERIZERS: "pdftoppm" (poppler subprocess,
+                through pdf2image unless in_memory), "pdftocairo" (poppler cairo subprocess) or "pdfium" (in process, requires pypdfium2).
+                The backends produce images of the same size. pdfium is not thread safe, its renders are serialized
+                by a lock shared by the whole process: prefer a subprocess backend when rendering from many threads.
+            dvi (bool, optional): compiles with latex and the dvisvgm pgf driver, and rasterizes the dvi with dvisvgm and rsvg-convert,
+                instead of compiling a pdf. Codes whose preamble loads a package or library needing the pdf driver,
+                see PDF_PREAMBLE_PATTERN, are compiled with pdflatex.
+            rendering_timeout (float, optional): maximum compilation time, in seconds
+            timeout_factor (float, optional): when set, the timeout of the mutants of a code is timeout_factor times
+                the compilation time of the code, measured by render_original and given with their renders as baseline,
+                at least min_timeout and at most rendering_timeout. Batches get this timeout for each of their codes.
+            min_timeout (float, optional): minimum adaptive timeout, in seconds
+            cpu_time_limit (int, optional): cpu time limit of a compilation, in seconds, unlimited by default
+            memory_limit (int, optional): address space limit of a compilation, in bytes, unlimited by default
+        """
         self.debug = debug
         self.cache_path = os.path.join(os.environ.get("HOME"), ".cache/varbench")
-        self.rendering_timeout = 30
-        pass
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.rendering_timeout = rendering_timeout
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit = memory_limit
+        self.cache = cache
+        self.preamble_formats = (
+            PreambleFormatStore(self.cache_path) if preamble_format else None
+        )
+        self.dvi_preamble_formats = (
+            PreambleFormatStore(self.cache_path, engine="latex")
+            if preamble_format and dvi
+            else None
+        )
+        self.work_dirs = _WorkDirPool() if in_memory else None
+        self.dpi = dpi
+        self.grayscale = grayscale
+        if rasterizer not in RASTERIZERS:
+            raise ValueError(
+                f"unknown rasterizer {rasterizer}, expected one of {list(RASTERIZERS)}"
+            )
+        self.rasterizer = rasterizer
+        self.dvi = dvi
+
+    def close(self):
+        """Removes the work directories of the renderer"""
+        if self.work_dirs is not None:
+            self.work_dirs.close()
+
+    def settings(self, dvi: bool = False) -> dict:
+        """Settings that change the rendered image, part of the render cache key
+
+        Args:
+            dvi (bool, optional): settings of the codes compiled to dvi, see uses_dvi
+        """
+        settings = (
+            {"compiler": "latex", "rasterizer": "dvisvgm"}
+            if dvi
+            else {
+                "compiler": "pdflatex",
+                "rasterizer": (
+                    "pdf2image" if self.rasterizer == "pdftoppm" else self.rasterizer
+                ),
+            }
+        )
+        # only the non-default options are part of the key, keeping the renders cached before they existed
+        if self.dpi != DEFAULT_DPI:
+            settings["dpi"] = self.dpi
+        if self.grayscale:
+            settings["grayscale"] = True
+        return settings
+
+    def uses_dvi(self, input_string: str, original_code: str = None) -> bool:
+        """Whether the code is compiled to dvi, in dvi mode
+
+        A code whose preamble, before \\begin{document}, loads a package or library needing the pdf driver
+        (graphicx, the fadings library...), or that uses a pdf primitive anywhere (\\pdfliteral, \\special...),
+        is compiled with pdflatex. The primitives of a mutant are looked up in its original code, so that a figure
+        and its mutants, deleting statements of its body, are rasterized the same way whatever the renders before them.
+        A code using a package needing the pdf driver must load it explicitly.
+
+        Args:
+            input_string (str): code to render
+            original_code (str, optional): original code of the mutant, the code itself by default
+        """
+        if not self.dvi:
+            return False
+        begin = input_string.find("\\begin{document}")
+        preamble = input_string[:begin] if begin != -1 else ""
+        if PDF_PREAMBLE_PATTERN.search(preamble):
+            logger.debug("preamble using the pdf driver, compiling with pdflatex")
+            return False
+        if PDF_PRIMITIVE_PATTERN.search(original_code or input_string):
+            logger.debug("code using pdf primitives, compiling with pdflatex")
+            return False
+        return True
 
     def from_to_file(self, input: str, output: str):
         output_cmd = subprocess.run(
@@ -29,7 +181,7 @@ class TexRenderer:
         )
 
         logger.debug("converting to png")
-        image = convert_from_path(pdf_path=output_file_name)[0]
+        image = self._rasterize(output_file_name[: -len(".pdf")])[0]
         image.save(output)
 
     """ def retry_error_callback(retry_state):
@@ -37,55 +189,489 @@ class TexRenderer:
 
     @retry(stop=stop_after_delay(120), retry_error_callback=retry_error_callback)   """
 
-    def from_string_to_image(self, input_string: str) -> PIL.Image.Image:
-        current_temp_file = str(uuid.uuid4()) + ".tex"
-        tmp_file_path = os.path.join(self.cache_path, current_temp_file)
-        file = open(tmp_file_path, "w")
-        file.write(input_string)
-        logger.debug("latex renderer writing to " + tmp_file_path)
-        file.flush()
-        file.close()
-        timeout = False
+    def from_string_to_image(
+        self, input_string: str, baseline: float = None, original_code: str = None
+    ) -> PIL.Image.Image:
+        """
+        Args:
+            input_string (str): code to render
+            baseline (float, optional): compilation time of the original code of the mutant, see render_original
+            original_code (str, optional): original code of the mutant, see uses_dvi
+        """
+        dvi = self.uses_dvi(input_string, original_code)
+        key, cached = self._cache_lookup(input_string, dvi)
+        if isinstance(cached, TexRendererException):
+            raise cached
+        if cached is not None:
+            return cached
+
         try:
-            output = subprocess.run(
-                [
-                    "pdflatex",
-                    "-halt-on-error",
-                    "-interaction=nonstopmode",
-                    "-output-directory",
-                    self.cache_path,
-                    tmp_file_path,
-                ],
-                timeout=self.rendering_timeout,
-                capture_output=True,
+            image = self._render(input_string, baseline, dvi)
+        except TexRendererException as e:
+            self._cache_store(key, e)
+            raise
+        self._cache_store(key, image)
+        return image
+
+    def from_strings_to_images(
+        self,
+        input_strings: list[str],
+        baseline: float = None,
+        original_code: str = None,
+    ) -> list[PIL.Image.Image | TexRendererException]:
+        """Renders several codes, compiling the ones sharing a preamble as the pages of one document
+
+        A code that fails does not prevent the others from being rendered, the compilation is resumed after it.
+        Codes that cannot be batched are rendered one by one.
+        Each code is compiled in a group, but the global definitions of the previous pages persist, e.g. the names
+        of the nodes, the counters or \\gdef: a code using a name it does not define compiles in a batch where
+        it would fail on its own. Render such codes separately.
+
+        Args:
+            input_strings (list[str]): codes to render
+            baseline (float, optional): compilation time of the original code of the mutants, see render_original
+            original_code (str, optional): original code of the mutants, see uses_dvi
+
+        Returns:
+            list[PIL.Image.Image | TexRendererException]: for each code, its image or the exception raised when rendering it
+        """
+        results: list[PIL.Image.Image | TexRendererException] = [None] * len(
+            input_strings
+        )
+        keys: list[str] = [None] * len(input_strings)
+        batches: dict[tuple[str, bool], list[tuple[int, tuple[str, str]]]] = {}
+        for index, input_string in enumerate(input_strings):
+            dvi = self.uses_dvi(input_string, original_code)
+            keys[index], results[index] = self._cache_lookup(input_string, dvi)
+            if results[index] is not None:
+                continue
+            prefix, rest = split_preamble(input_string)
+            parts = split_document(rest) if prefix else None
+            if parts is None:
+                results[index] = self._render_or_exception(input_string, baseline, dvi)
+                self._cache_store(keys[index], results[index])
+                continue
+            batches.setdefault((prefix, dvi), []).append((index, parts))
+
+        for (prefix, dvi), batch in batches.items():
+            indexes = [index for index, _ in batch]
+            batch_results = self._render_batch(
+                prefix,
+                [parts for _, parts in batch],
+                [input_strings[index] for index in indexes],
+                dvi,
+                baseline,
             )
-        except subprocess.TimeoutExpired:
-            timeout = True
-        output_file_name = os.path.join(
-            self.cache_path, os.path.basename(tmp_file_path).replace("tex", "pdf")
+            for index, result in zip(indexes, batch_results):
+                results[index] = result
+                self._cache_store(keys[index], result)
+        return results
+
+    def render_original(
+        self, input_string: str
+    ) -> tuple[PIL.Image.Image, float | None]:
+        """Renders the original code of mutants, measuring its compilation time as the baseline of their timeouts
+
+        The original code itself gets rendering_timeout. With timeout_factor set, it is compiled even when its image
+        is cached, to measure it.
+
+        Returns:
+            tuple[PIL.Image.Image, float | None]: image of the code, and its compilation time in seconds,
+                None without timeout_factor
+        """
+        if self.timeout_factor is None:
+            return self.from_string_to_image(input_string), None
+        dvi = self.uses_dvi(input_string)
+        key = (
+            None
+            if self.cache is None
+            else RenderCache.key(input_string, self.settings(dvi))
         )
-        if timeout or output.returncode != 0:
-            if not self.debug:
-                for ext in ["pdf", "tex", "aux", "log"]:
-                    todel_file = output_file_name.replace("pdf", ext)
-                    os.path.exists(todel_file) and os.remove(todel_file)
-            if timeout:
-                raise TexRendererException("Timeout reached")
-            else:
+        try:
+            image, compile_time = self._render_timed(input_string, dvi=dvi)
+        except TexRendererException as e:
+            self._cache_store(key, e)
+            raise
+        self._cache_store(key, image)
+        return image, compile_time
+
+    def _cache_lookup(
+        self, input_string: str, dvi: bool = False
+    ) -> tuple[str, PIL.Image.Image | TexRendererException | None]:
+        if self.cache is None:
+            return None, None
+        key = RenderCache.key(input_string, self.settings(dvi))
+        cached = self.cache.get(key)
+        if isinstance(cached, RenderFailure):
+            exception_type = _FAILURE_TYPES.get(
+                cached.exception_type, TexRendererException
+            )
+            return key, exception_type(cached.message)
+        return key, cached
+
+    def _cache_store(self, key: str, result: PIL.Image.Image | TexRendererException):
+        if self.cache is None or isinstance(result, RenderingTimeoutException):
+            return  # timeouts depend on the load of the machine, not cached
+        if isinstance(result, TexRendererException):
+            self.cache.put(key, RenderFailure(type(result).__name__, result.message))
+        else:
+            self.cache.put(key, result)
+
+    def _render_or_exception(
+        self, input_string: str, baseline: float = None, dvi: bool = None
+    ) -> PIL.Image.Image | TexRendererException:
+        try:
+            return self._render(input_string, baseline, dvi)
+        except TexRendererException as e:
+            return e
+
+    def _render(
+        self, input_string: str, baseline: float = None, dvi: bool = None
+    ) -> PIL.Image.Image:
+        return self._render_timed(input_string, baseline, dvi)[0]
+
+    def _render_timed(
+        self, input_string: str, baseline: float = None, dvi: bool = None
+    ) -> tuple[PIL.Image.Image, float]:
+        """renders the code, returning its image and its compilation time in seconds
+
+        Args:
+            dvi (bool, optional): whether the code is compiled to dvi, see uses_dvi, decided from the code by default
+        """
+        if dvi is None:
+            dvi = self.uses_dvi(input_string)
+        with self._workspace() as tmp_path:
+            start = time.monotonic()
+            output = self._run_pdflatex(
+                input_string, tmp_path, dvi=dvi, baseline=baseline
+            )
+            compile_time = time.monotonic() - start
+            if output is None or output.returncode in LIMIT_RETURNCODES:
+                raise RenderingTimeoutException("Timeout reached")
+            if output.returncode != 0:
                 raise TexRendererException(
                     output.stderr.decode() + "|" + output.stdout.decode()
                 )
-        logger.debug(f"converting {tmp_file_path} to png")
+            logger.debug(f"converting {tmp_path}.tex to png")
+            try:
+                return self._rasterize(tmp_path, dvi=dvi)[0], compile_time
+            except PDFPageCountError as pe:
+                raise ImageRenderingException(repr(pe))
+
+    def _render_batch(
+        self,
+        prefix: str,
+        parts: list[tuple[str, str]],
+        input_strings: list[str],
+        dvi: bool = False,
+        baseline: float = None,
+    ) -> list[PIL.Image.Image | TexRendererException]:
+        """Renders split codes sharing a prefix as the pages of one document
+
+        Codes up to the first failing one are resolved by a compilation, the remaining ones are rendered in a new batch.
+        """
+        if len(parts) == 1:
+            return [self._render_or_exception(input_strings[0], baseline, dvi)]
+
+        with self._workspace() as tmp_path:
+            output = self._run_pdflatex(
+                build_batch_document(prefix, parts),
+                tmp_path,
+                halt_on_error=False,
+                dvi=dvi,
+                codes=len(parts),
+                baseline=baseline,
+            )
+            if output is not None and output.returncode in LIMIT_RETURNCODES:
+                output = None  # killed at the cpu time limit, as on timeout
+            resolved = [] if output is None else self._resolve_batch(output, len(parts))
+            page_indexes = [result for result in resolved if isinstance(result, int)]
+            if page_indexes:
+                first_page = min(page_indexes)
+                try:
+                    pages = self._rasterize(
+                        tmp_path, first_page + 1, max(page_indexes) + 1, dvi
+                    )
+                    resolved = [
+                        (
+                            pages[result - first_page]
+                            if isinstance(result, int)
+                            else result
+                        )
+                        for result in resolved
+                    ]
+                except PDFPageCountError:
+                    resolved = [
+                        None if isinstance(result, int) else result
+                        for result in resolved
+                    ]
+
+        if output is None:
+            # a code runs away, narrowing it down
+            half = len(parts) // 2
+            return self._render_batch(
+                prefix, parts[:half], input_strings[:half], dvi, baseline
+            ) + self._render_batch(
+                prefix, parts[half:], input_strings[half:], dvi, baseline
+            )
+
+        # codes the batch could not resolve are rendered on their own
+        results = [
+            (
+                result
+                if result is not None
+                else self._render_or_exception(code, baseline, dvi)
+            )
+            for result, code in zip(resolved, input_strings)
+        ]
+        if len(resolved) < len(parts):
+            # the state of the compilation is not reliable after a failure
+            results += self._render_batch(
+                prefix,
+                parts[len(resolved) :],
+                input_strings[len(resolved) :],
+                dvi,
+                baseline,
+            )
+        return results
+
+    @staticmethod
+    def _resolve_batch(
+        output: subprocess.CompletedProcess, size: int
+    ) -> list[int | TexRendererException | None]:
+        """Maps the log of a batch compilation back to each code
+
+        Returns:
+            list[int | TexRendererException | None]: for each code up to the first failing one, the index of its page,
+                its exception, or None when it has to be rendered on its own
+        """
+        log = output.stdout.decode(errors="replace")
+        segments = parse_batch_log(log, size)
+        if segments[0] is None or segments[0].start_page < 0:
+            # the shared part does not compile, or pages cannot be counted
+            return [None] * size
+
+        resolved: list[int | TexRendererException | None] = []
+        for segment in segments:
+            if (
+                segment is None
+                or not segment.closed
+                or segment.has_error
+                or not segment.balanced
+            ):
+                resolved.append(TexRendererException(segment.log if segment else log))
+                break
+            if segment.end_page == segment.start_page:
+                resolved.append(ImageRenderingException("Document has no pages"))
+            else:
+                resolved.append(segment.start_page)
+        return resolved
+
+    @contextmanager
+    def _workspace(self):
+        """Yields the path, without extension, of the files of one compilation, and cleans them up afterwards"""
+        if self.work_dirs is None:
+            tmp_path = os.path.join(self.cache_path, str(uuid.uuid4()))
+            keep_files = False
+            try:
+                yield tmp_path
+            except TexRendererException:
+                keep_files = self.debug
+                raise
+            finally:
+                if not keep_files:
+                    self._remove_files(tmp_path)
+            return
+
+        work_dir = self.work_dirs.acquire()
         try:
-            to_return_image = convert_from_path(pdf_path=output_file_name)[0]
-        except PDFPageCountError as pe:
-            for ext in ["pdf", "tex", "aux", "log"]:
-                todel_file = output_file_name.replace("pdf", ext)
-                os.path.exists(todel_file) and os.remove(todel_file)
-            raise ImageRenderingException(repr(pe))
-        for ext in ["pdf", "tex", "aux", "log"]:
-            os.remove(output_file_name.replace("pdf", ext))
-        return to_return_image
+            yield os.path.join(work_dir, "render")
+        finally:
+            # truncated rather than removed, the next compilation reuses the files
+            for ext in ["pdf", "dvi", "aux"]:
+                reused_file = os.path.join(work_dir, "render." + ext)
+                os.path.exists(reused_file) and os.truncate(reused_file, 0)
+            self.work_dirs.release(work_dir)
+
+    def _rasterize(
+        self, tmp_path: str, first_page: int = 1, last_page: int = 1, dvi: bool = False
+    ) -> list[PIL.Image.Image]:
+        if dvi:
+            return rasterize_dvi(
+                tmp_path + ".dvi", first_page, last_page, self.dpi, self.grayscale
+            )
+        if self.work_dirs is None and self.rasterizer == "pdftoppm":
+            return convert_from_path(
+                pdf_path=tmp_path + ".pdf",
+                first_page=first_page,
+                last_page=last_page,
+                dpi=self.dpi,
+                grayscale=self.grayscale,
+            )
+        with open(tmp_path + ".pdf", "rb") as pdf_file:
+            pdf = pdf_file.read()
+        return RASTERIZERS[self.rasterizer](
+            pdf, first_page, last_page, self.dpi, self.grayscale
+        )
+
+    def _run_pdflatex(
+        self,
+        input_string: str,
+        tmp_path: str,
+        halt_on_error: bool = True,
+        dvi: bool = False,
+        codes: int = 1,
+        baseline: float = None,
+    ) -> subprocess.CompletedProcess | None:
+        """Writes the code to tmp_path.tex and compiles it, against the preamble format if enabled
+
+        Args:
+            dvi (bool, optional): compiles to tmp_path.dvi with latex and the dvisvgm pgf driver
+            codes (int, optional): number of codes in the compiled document, scaling its adaptive timeout
+            baseline (float, optional): compilation time of the original code of the codes, see timeout
+
+        Returns:
+            subprocess.CompletedProcess | None: output of pdflatex, None on timeout
+        """
+        format_name = None
+        compiled_string = DVI_DRIVER + input_string if dvi else input_string
+        preamble_formats = self.dvi_preamble_formats if dvi else self.preamble_formats
+        preamble, body = split_preamble(input_string)
+        if preamble_formats is not None:
+            # the driver is chosen when pgf is loaded, it is part of the dumped preamble
+            format_name = preamble and preamble_formats.get_format(
+                DVI_DRIVER + preamble if dvi else preamble
+            )
+            if format_name:
+                compiled_string = body
+
+        file = open(tmp_path + ".tex", "w")
+        file.write(compiled_string)
+        logger.debug("latex renderer writing to " + tmp_path + ".tex")
+        file.flush()
+        file.close()
+
+        command = ["latex" if dvi else "pdflatex"]
+        env = dict(os.environ, max_print_line="10000")
+        if format_name:
+            command.append(f"-fmt={format_name}")
+            # formats are looked up in the cache path first, then in the default locations
+            env["TEXFORMATS"] = self.cache_path + os.pathsep
+        if halt_on_error:
+            command.append("-halt-on-error")
+        command += [
+            "-interaction=nonstopmode",
+            "-output-directory",
+            os.path.dirname(tmp_path),
+            tmp_path + ".tex",
+        ]
+        output = self._run_limited(command, env, self.timeout(baseline, codes))
+        if output is None:
+            return None
+
+        if format_name and any(
+            error in output.stdout.decode(errors="replace")
+            for error in FORMAT_LOADING_ERRORS
+        ):
+            # compiling again, without the invalidated format
+            preamble_formats.invalidate(format_name)
+            return self._run_pdflatex(
+                input_string, tmp_path, halt_on_error, dvi, codes, baseline
+            )
+        return output
+
+    def timeout(self, baseline: float = None, codes: int = 1) -> float:
+        """Timeout of the compilation of mutants of a code, see timeout_factor
+
+        Args:
+            baseline (float, optional): compilation time of their original code in seconds, rendering_timeout without it
+            codes (int, optional): number of codes compiled together
+
+        Returns:
+            float: the timeout, in seconds
+        """
+        if self.timeout_factor is None or baseline is None:
+            return self.rendering_timeout
+        return min(
+            self.rendering_timeout,
+            max(self.min_timeout, self.timeout_factor * baseline * codes),
+        )
+
+    def _run_limited(
+        self, command: list[str], env: dict, timeout: float
+    ) -> subprocess.CompletedProcess | None:
+        """Runs a command in its own process group, with the resource limits of the renderer
+
+        Returns:
+            subprocess.CompletedProcess | None: output of the command, None on timeout, once the whole group is killed
+        """
+        limits = []
+        if self.cpu_time_limit is not None:
+            # SIGXCPU at the soft limit, SIGKILL one second later if it is ignored
+            limits += [
+                f"ulimit -S -t {self.cpu_time_limit}",
+                f"ulimit -H -t {self.cpu_time_limit + 1}",
+            ]
+        if self.memory_limit is not None:
+            memory_kib = self.memory_limit // 1024
+            limits += [f"ulimit -S -v {memory_kib}", f"ulimit -H -v {memory_kib}"]
+        if limits:
+            # set by a shell replaced by the command, no python code runs in the forked child of a threaded process
+            script = " && ".join(limits) + ' && exec "$@"'
+            command = ["sh", "-c", script, "sh", *command]
+
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass  # exited meanwhile
+            process.communicate()
+            logger.info(f"compilation killed after {timeout:.1f}s")
+            return None
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+    @staticmethod
+    def _remove_files(tmp_path: str):
+        for ext in ["pdf", "dvi", "tex", "aux", "log"]:
+            todel_file = f"{tmp_path}.{ext}"
+            os.path.exists(todel_file) and os.remove(todel_file)
+
+
+class _WorkDirPool:
+    """Private work directories, each used by one compilation at a time and reused afterwards"""
+
+    def __init__(self):
+        shm = "/dev/shm"
+        self.root = tempfile.mkdtemp(
+            prefix="varbench_",
+            dir=shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else None,
+        )
+        self._free: queue.SimpleQueue[str] = queue.SimpleQueue()
+        # removing the directories even when the renderer is not closed
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.root, ignore_errors=True
+        )
+
+    def acquire(self) -> str:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return tempfile.mkdtemp(dir=self.root)
+
+    def release(self, work_dir: str):
+        self._free.put(work_dir)
+
+    def close(self):
+        self._finalizer()
 
 
 class TexRendererException(Exception):
@@ -120,3 +706,17 @@ class TexRendererException(Exception):
 class ImageRenderingException(TexRendererException):
     def extract_error(self) -> str:
         return self.message
+
+
+class RenderingTimeoutException(TexRendererException):
+    pass
+
+
+_FAILURE_TYPES: dict[str, type[TexRendererException]] = {
+    exception_type.__name__: exception_type
+    for exception_type in [
+        TexRendererException,
+        ImageRenderingException,
+        RenderingTimeoutException,
+    ]
+}
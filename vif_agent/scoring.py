@@ -0,0 +1,250 @@
+import hashlib
+from collections import defaultdict
+from typing import Iterable
+
+import numpy as np
+from PIL import Image
+
+from vif_agent.feature import Box2D
+
+
+def intersection(first: Box2D, second: Box2D) -> Box2D | None:
+    """Intersection of two (left, upper, right, lower) boxes, None if they do not overlap"""
+    left, upper = max(first[0], second[0]), max(first[1], second[1])
+    right, lower = min(first[2], second[2]), min(first[3], second[3])
+    if left >= right or upper >= lower:
+        return None
+    return left, upper, right, lower
+
+
+def changed_region(base: np.ndarray, image: Image.Image) -> Box2D:
+    """Computes the bounding box of the pixels of the image that differ from the base
+
+    Args:
+        base (np.ndarray): array of the base image
+        image (Image.Image): image of the same size and mode
+
+    Returns:
+        Box2D: (left, upper, right, lower) box of the changed pixels, the empty box (0, 0, 0, 0) if the images are equal
+    """
+    changed = np.not_equal(base, np.asarray(image))
+    changed_rows = changed.reshape(changed.shape[0], -1).any(axis=1).nonzero()[0]
+    if len(changed_rows) == 0:
+        return 0, 0, 0, 0
+    upper, lower = int(changed_rows[0]), int(changed_rows[-1]) + 1
+    changed_columns = (
+        changed[upper:lower]
+        .any(axis=0)
+        .reshape(changed.shape[1], -1)
+        .any(axis=1)
+        .nonzero()[0]
+    )
+    return int(changed_columns[0]), upper, int(changed_columns[-1]) + 1, lower
+
+
+def image_fingerprint(
+    image: Image.Image, region: Box2D, perceptual: bool = False, hash_size: int = 16
+) -> bytes:
+    """Fingerprints a mutant image by its changed region, outside of which it equals the base image
+
+    Args:
+        image (Image.Image): mutant image
+        region (Box2D): region of the pixels differing from the base image, see changed_region
+        perceptual (bool, optional): fingerprints the region with a difference hash of its grayscale pixels
+            instead of the exact pixels, so that nearly identical regions share their fingerprint
+        hash_size (int, optional): size of the difference hash, in bits per side
+
+    Returns:
+        bytes: the fingerprint, equal for equal mutant images of the same base image
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(repr((perceptual, tuple(region))).encode())
+    left, upper, right, lower = region
+    if left < right and upper < lower:
+        crop = image.crop(region)
+        if perceptual:
+            pixels = np.asarray(
+                crop.convert("L").resize(
+                    (hash_size + 1, hash_size), Image.Resampling.BILINEAR
+                ),
+                dtype=np.int16,
+            )
+            fingerprint.update(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes())
+        else:
+            fingerprint.update(crop.tobytes())
+    return fingerprint.digest()
+
+
+class RegionIndex:
+    """Uniform grid index of rectangular regions, to find the regions overlapping a box"""
+
+    def __init__(self, regions: list[Box2D], cell_size: int = 64):
+        """
+        Args:
+            regions (list[Box2D]): indexed regions, empty regions are never found
+            cell_size (int, optional): size of the grid cells, in pixels
+        """
+        self.regions = regions
+        self.cell_size = cell_size
+        self._cells: dict[tuple[int, int], list[int]] = defaultdict(list)
+        for index, region in enumerate(regions):
+            for cell in self._covered_cells(region):
+                self._cells[cell].append(index)
+
+    def query(self, box: Box2D) -> list[int]:
+        """Gets the indexes of the regions overlapping the box, in increasing order"""
+        found = set()
+        for cell in self._covered_cells(box):
+            for index in self._cells.get(cell, ()):
+                if index not in found and intersection(self.regions[index], box):
+                    found.add(index)
+        return sorted(found)
+
+    def _covered_cells(self, box: Box2D):
+        left, upper, right, lower = box
+        if left >= right or upper >= lower:
+            return
+        for column in range(left // self.cell_size, (right - 1) // self.cell_size + 1):
+            for row in range(
+                upper // self.cell_size, (lower - 1) // self.cell_size + 1
+            ):
+                yield column, row
+
+
+class BoxScorer:
+    """Scores how much mutant images differ from a base image within detected boxes
+
+    The score of a box is the normalized MSE of the box crops divided by the box area, as computed with norm_mse.
+    Each mutant image is converted to an array once, and the squared differences are summed with a summed-area table,
+    so that each box is scored in constant time. When the region changed by the mutant is known, only this region is compared.
+    """
+
+    def __init__(self, base_image: Image.Image, boxes: list[Box2D]):
+        """
+        Args:
+            base_image (Image.Image): image of the original code
+            boxes (list[Box2D]): (left, upper, right, lower) boxes, as given to Image.crop
+        """
+        self.base = np.asarray(base_image)
+        self.height, self.width = self.base.shape[:2]
+        self.channels = 1 if self.base.ndim == 2 else self.base.shape[2]
+        self.max_value = (
+            np.iinfo(self.base.dtype).max
+            if np.issubdtype(self.base.dtype, np.integer)
+            else None
+        )
+
+        self.boxes = [tuple(int(coordinate) for coordinate in box) for box in boxes]
+        # crops of boxes going out of the image are padded with zeros, which only count in the crop size
+        self.regions = [self._clip(box) for box in self.boxes]
+        self.box_areas = np.array(
+            [
+                (right - left) * (lower - upper)
+                for left, upper, right, lower in self.boxes
+            ],
+            dtype=np.float64,
+        )
+        self.base_maxima = [
+            self._region_max(self.base, region) for region in self.regions
+        ]
+
+        # only the part of the image covered by the boxes is compared
+        self.window = (
+            min((region[0] for region in self.regions), default=0),
+            min((region[1] for region in self.regions), default=0),
+            max((region[2] for region in self.regions), default=0),
+            max((region[3] for region in self.regions), default=0),
+        )
+        self._signed_base = self.base.astype(np.int32)
+
+    def score(
+        self,
+        mutant_image: Image.Image,
+        changed_region: Box2D = None,
+        box_indexes: Iterable[int] = None,
+    ) -> np.ndarray:
+        """Scores a mutant image against the boxes
+
+        Args:
+            mutant_image (Image.Image): image of the mutant, same size and mode as the base image
+            changed_region (Box2D, optional): region outside of which the mutant image equals the base image,
+                only this region is compared. Defaults to the whole image.
+            box_indexes (Iterable[int], optional): indexes of the scored boxes, defaults to all of them
+
+        Returns:
+            np.ndarray: score of each box, 0 when the mutant does not change the box or when the box is not scored
+        """
+        mutant = np.asarray(mutant_image)
+        if mutant.shape != self.base.shape:
+            raise ValueError("Images must have the same dimensions")
+
+        scores = np.zeros(len(self.boxes), dtype=np.float64)
+        compared = (
+            self.window
+            if changed_region is None
+            else intersection(changed_region, self.window)
+        )
+        if compared is None:
+            return scores
+
+        compared_left, compared_upper, compared_right, compared_lower = compared
+        difference = (
+            self._signed_base[
+                compared_upper:compared_lower, compared_left:compared_right
+            ]
+            - mutant[compared_upper:compared_lower, compared_left:compared_right]
+        )
+        if difference.ndim == 3:
+            squared_difference = np.einsum("ijk,ijk->ij", difference, difference)
+        else:
+            squared_difference = difference * difference
+        summed_area = np.zeros(
+            (squared_difference.shape[0] + 1, squared_difference.shape[1] + 1),
+            dtype=np.int64,
+        )
+        np.cumsum(squared_difference, axis=0, out=summed_area[1:, 1:])
+        np.cumsum(summed_area[1:, 1:], axis=1, out=summed_area[1:, 1:])
+
+        for index in range(len(self.boxes)) if box_indexes is None else box_indexes:
+            overlap = intersection(self.regions[index], compared)
+            if overlap is None:
+                continue
+            left, upper, right, lower = overlap
+            left, right = left - compared_left, right - compared_left
+            upper, lower = upper - compared_upper, lower - compared_upper
+            box_sum = (
+                summed_area[lower, right]
+                - summed_area[upper, right]
+                - summed_area[lower, left]
+                + summed_area[upper, left]
+            )
+            if box_sum == 0:
+                continue
+            max_value = self.base_maxima[index]
+            if max_value != self.max_value:
+                # the mutant can only raise the normalization value when the base does not reach the maximum
+                max_value = max(
+                    max_value, self._region_max(mutant, self.regions[index])
+                )
+            scores[index] = box_sum / (
+                float(max_value) ** 2
+                * self.box_areas[index]
+                * self.channels
+                * self.box_areas[index]
+            )
+        return scores
+
+    def _clip(self, box: Box2D) -> Box2D:
+        left, upper, right, lower = box
+        if right < left or lower < upper:
+            raise ValueError(f"invalid box {box}")
+        left, right = min(max(left, 0), self.width), min(max(right, 0), self.width)
+        upper, lower = min(max(upper, 0), self.height), min(max(lower, 0), self.height)
+        return left, upper, right, lower
+
+    @staticmethod
+    def _region_max(array: np.ndarray, region: Box2D):
+        left, upper, right, lower = region
+        if right == left or lower == upper:
+            return 0
+        return array[upper:lower, left:right].max()
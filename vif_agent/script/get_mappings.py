@@ -1,39 +1,163 @@
+"""Gets the mappings of a feature from a pickled MappedCode
+
+Usage:
+    python -m vif_agent.script.get_mappings mapping.pickle -f ears
+    python -m vif_agent.script.get_mappings mapping.pickle --serve
+
+In server mode, json-rpc requests are read from stdin, one per line, and answered on stdout:
+    {"jsonrpc": "2.0", "id": 1, "method": "get_cimappings", "params": {"feature": "ears"}}
+    {"jsonrpc": "2.0", "id": 1, "result": [[{"spans": [[0, 10]], "zone": [0, 0, 10, 10]}, 0.5]]}
+The mapping file can be given in the params with "mappingfile", and is reloaded when it changes on disk.
+The params can also limit the mappings with "top_k" and "threshold", see MappedCode.get_cimappings.
+"""
+
 import argparse
-import pickle
 import json
+import os
+import pickle
 import sys
-import torch
+from typing import TextIO
+
+from loguru import logger
 
 from vif_agent.feature import MappedCode
 
+PARSE_ERROR = -32700
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
         if hasattr(obj, "__dataclass_fields__"):
             return obj.__dict__
-        if isinstance(obj, torch.Tensor):
+        if hasattr(obj, "tolist"):  # tensors and arrays, without importing torch
             return obj.tolist()
         return super().default(obj)
 
 
-parser = argparse.ArgumentParser(
-    prog="get mapping script",
-    description="Load a pickle file specified and gets the spans of the feature",
-    epilog="Text at the bottom of help",
-)
+class MappingStore:
+    """Loaded mapped codes, reloaded when their file changes"""
+
+    def __init__(self):
+        self._loaded: dict[str, tuple[tuple[int, int], MappedCode]] = {}
+
+    def get(self, mappingfile: str) -> MappedCode:
+        path = os.path.abspath(mappingfile)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        loaded = self._loaded.get(path)
+        if loaded is None or loaded[0] != version:
+            logger.info(f"loading the mappings of {path}")
+            with open(path, "rb") as mp:
+                self._loaded[path] = (version, pickle.load(mp))
+        return self._loaded[path][1]
+
+
+def serve(
+    store: MappingStore,
+    mappingfile: str = None,
+    requests: TextIO = sys.stdin,
+    responses: TextIO = sys.stdout,
+):
+    """Answers json-rpc requests until the end of the requests or a shutdown request
+
+    Args:
+        store (MappingStore): loaded mapped codes
+        mappingfile (str, optional): mapping file of the requests without "mappingfile" param
+        requests (TextIO, optional): stream of the requests, one per line
+        responses (TextIO, optional): stream of the responses, one per line
+    """
+    if mappingfile is not None:
+        store.get(mappingfile)  # loading ahead of the first request
+
+    for line in requests:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            _respond(responses, None, error=(PARSE_ERROR, str(e)))
+            continue
+
+        request_id = request.get("id")
+        method = request.get("method")
+        params = request.get("params") or {}
+        if method == "shutdown":
+            _respond(responses, request_id, result=None)
+            return
+        if method != "get_cimappings":
+            _respond(responses, request_id, error=(METHOD_NOT_FOUND, str(method)))
+            continue
+        if "feature" not in params or (
+            mappingfile is None and "mappingfile" not in params
+        ):
+            _respond(
+                responses,
+                request_id,
+                error=(INVALID_PARAMS, "feature and mappingfile are required"),
+            )
+            continue
+        try:
+            mapped_code = store.get(params.get("mappingfile", mappingfile))
+            result = mapped_code.get_cimappings(
+                params["feature"],
+                top_k=params.get("top_k"),
+                threshold=params.get("threshold"),
+            )
+        except Exception as e:
+            logger.exception("mapping query failed")
+            _respond(responses, request_id, error=(SERVER_ERROR, repr(e)))
+            continue
+        _respond(responses, request_id, result=result)
+
+
+def _respond(
+    responses: TextIO, request_id, result=None, error: tuple[int, str] = None
+):
+    response = {"jsonrpc": "2.0", "id": request_id}
+    if error is None:
+        response["result"] = result
+    else:
+        response["error"] = {"code": error[0], "message": error[1]}
+    responses.write(json.dumps(response, cls=MyEncoder) + "\n")
+    responses.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="get mapping script",
+        description="Load a pickle file specified and gets the spans of the feature",
+        epilog="Text at the bottom of help",
+    )
+
+    parser.add_argument("mappingfile", nargs="?")
+    parser.add_argument("-f", "--feature", nargs="+")
+    parser.add_argument("-k", "--top-k", type=int, default=None)
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="answers json-rpc queries from stdin, keeping the mappings loaded",
+    )
 
-parser.add_argument("mappingfile")
-parser.add_argument("-f", "--feature", nargs='+')
+    args = parser.parse_args()
+    store = MappingStore()
+    if args.serve:
+        serve(store, args.mappingfile)
+        sys.exit(0)
 
+    if args.mappingfile is None or not args.feature:
+        parser.error("the mapping file and the feature are required")
+    mapped_code = store.get(args.mappingfile)
 
+    feature = " ".join(args.feature)
+    mappings = mapped_code.get_cimappings(feature, top_k=args.top_k)
 
-args = parser.parse_args()
-with open(args.mappingfile, "rb") as mp:
-    mapped_code: MappedCode = pickle.load(mp)
+    print(json.dumps(mappings, cls=MyEncoder))
 
-feature = " ".join(args.feature)
-mappings = mapped_code.get_cimappings(feature)
+    sys.exit(0)
 
-print(json.dumps(mappings, cls=MyEncoder))
 
-sys.exit(0)
+if __name__ == "__main__":
+    main()
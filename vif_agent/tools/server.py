@@ -3,13 +3,19 @@ from vif_agent.feature import CodeImageMapping, MappedCode
 from typing import Any
 from mcp.server.fastmcp import FastMCP
 from mcp.server.fastmcp import FastMCP, Image
+from vif_agent.renderer.render_server import RenderClient
 from vif_agent.renderer.tex_renderer import TexRenderer
 import uuid
 import os
 
 # Create an MCP server
 mcp = FastMCP("Vif")
-renderer = TexRenderer()
+# sharing the render server of the host when there is one
+renderer = (
+    RenderClient(os.environ["VIF_RENDER_SOCKET"])
+    if "VIF_RENDER_SOCKET" in os.environ
+    else TexRenderer()
+)
 
 tmp_edit_folder = os.path.join(".tmp", uuid.uuid4())
 os.mkdir(tmp_edit_folder)